@@ -0,0 +1,123 @@
+# ---------------------------------------------------------
+# !set の対象検索とメンバーキャッシュのメモリのベンチマーク
+# 使い方: python benchmarks/bench_members.py --members 100000
+# 大きなサーバーを模した数のメンバーを作り、
+#   legacy: 全メンバーを discord.Member としてキャッシュし、discord.utils.find で線形に探す (以前の Intents.all() の構成)
+#   index : 名前の索引 (main.MemberIndex) だけを持ち、完全一致・前方一致・あいまい一致で探す
+# のメモリ使用量 (tracemalloc) と1回あたりの検索時間を比べる
+# legacy のメモリにはプレゼンス (状態・アクティビティ) の分は含まないため、実際の差はこれより大きい
+# ---------------------------------------------------------
+import argparse
+import random
+import time
+import tracemalloc
+
+import discord
+from discord.state import ConnectionState
+
+from fakes import percentile
+import main
+
+SYLLABLES = ["ka", "ki", "ku", "ke", "ko", "sa", "shi", "su", "ta", "chi", "na", "ni", "ha", "ma", "mi", "ya", "yu", "ra", "ri", "n"]
+
+def make_payloads(count, rng):
+    payloads = []
+    for index in range(count):
+        username = "".join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 5))) + str(index)
+        payloads.append({
+            "user": {
+                "id": str(10**17 + index),
+                "username": username,
+                "discriminator": "0",
+                "avatar": f"{rng.getrandbits(128):032x}",
+                "global_name": username.capitalize() if rng.random() < 0.7 else None,
+            },
+            "nick": f"ニック{index}" if rng.random() < 0.3 else None,
+            "roles": [],
+            "joined_at": "2024-01-01T00:00:00+00:00",
+            "deaf": False,
+            "mute": False,
+            "flags": 0,
+            "avatar": None,
+        })
+    return payloads
+
+def make_guild(intents):
+    state = ConnectionState(
+        dispatch=lambda *args: None, handlers={}, hooks={}, http=None,
+        intents=intents, member_cache_flags=discord.MemberCacheFlags.from_intents(intents),
+    )
+    data = {"id": "1", "name": "large", "roles": [], "emojis": [], "stickers": [], "channels": [], "members": [], "voice_states": [], "presences": []}
+    return state, discord.Guild(data=data, state=state)
+
+def build_legacy(payloads):
+    state, guild = make_guild(discord.Intents.all())
+    for payload in payloads:
+        guild._add_member(discord.Member(data=payload, guild=guild, state=state))
+    return guild
+
+def build_index(payloads):
+    # 起動時の guild.chunk(cache=False) と同じく、Member は作るが索引に入れた後は捨てる
+    state, guild = make_guild(main.intents)
+    index = main.MemberIndex()
+    index.load(guild.id, (discord.Member(data=payload, guild=guild, state=state) for payload in payloads))
+    return index
+
+def measure_memory(build, payloads):
+    tracemalloc.start()
+    started = time.perf_counter()
+    result = build(payloads)
+    elapsed = time.perf_counter() - started
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, current, peak, elapsed
+
+def make_queries(payloads, count, rng):
+    queries = []
+    for _ in range(count):
+        user = rng.choice(payloads)["user"]
+        kind = rng.random()
+        if kind < 0.5:
+            queries.append(("exact", user["global_name"] or user["username"]))
+        elif kind < 0.8:
+            queries.append(("prefix", user["username"][:max(3, len(user["username"]) - 3)]))
+        else:
+            name = user["username"]
+            position = rng.randrange(len(name))
+            queries.append(("fuzzy", name[:position] + name[position + 1:]))
+    return queries
+
+def time_lookups(function, queries):
+    results = {}
+    for kind, query in queries:
+        started = time.perf_counter()
+        function(query)
+        results.setdefault(kind, []).append((time.perf_counter() - started) * 1000)
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--members", type=int, default=100000)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    payloads = make_payloads(args.members, rng)
+    queries = make_queries(payloads, args.queries, rng)
+
+    print(f"members: {args.members} / queries: {len(queries)}")
+    print(f"{'':>7} {'memory(MB)':>11} {'peak(MB)':>9} {'build(s)':>9}")
+    legacy_guild, current, peak, elapsed = measure_memory(build_legacy, payloads)
+    print(f"{'legacy':>7} {current / 1e6:>11.1f} {peak / 1e6:>9.1f} {elapsed:>9.2f}")
+    index, current, peak, elapsed = measure_memory(build_index, payloads)
+    print(f"{'index':>7} {current / 1e6:>11.1f} {peak / 1e6:>9.1f} {elapsed:>9.2f}")
+
+    # 以前の !set は完全一致のみ (前方一致・あいまい一致は見つからずに最後まで走査する)
+    def legacy_find(name):
+        return discord.utils.find(lambda m: m.display_name == name or m.name == name, legacy_guild.members)
+
+    print(f"\n{'':>7} {'kind':>7} {'mean(ms)':>9} {'p99(ms)':>8}")
+    for name, function in [("legacy", legacy_find), ("index", lambda query: index.search(1, query))]:
+        for kind, times in sorted(time_lookups(function, queries).items()):
+            print(f"{name:>7} {kind:>7} {sum(times) / len(times):>9.3f} {percentile(times, 99):>8.3f}")
@@ -0,0 +1,85 @@
+# ---------------------------------------------------------
+# ミキサーのマイクロベンチマーク
+# 使い方: python benchmarks/bench_mixer.py --frames 2000
+# 同時ソース数を1〜32まで増やしたときの、1フレーム(20ms)あたりのread()所要時間を計測する
+# ducking列は半数を音楽として追加し、読み上げ中のダッキング処理を含めた時間
+# audioopが使えるPython (3.12以前) では旧実装との比較も表示する
+# (numpy の列は read() を計るため、旧実装には無いメトリクスの記録 (1〜2µs) を含む)
+# ---------------------------------------------------------
+import argparse
+import threading
+import time
+
+import numpy as np
+
+import fakes  # noqa: F401 (main.py を import できるようにする)
+import main
+
+try:
+    import audioop
+except ImportError:
+    audioop = None
+
+class LoopingSource(main.discord.AudioSource):
+    # 同じフレームを返し続けるソース (読み出しコストを最小にする)
+    def __init__(self, frame):
+        self.frame = frame
+
+    def read(self):
+        return self.frame
+
+class LegacyMixingAudioSource:
+    # 比較用: audioop.add を使っていた旧実装
+    def __init__(self):
+        self.sources = []
+        self.lock = threading.Lock()
+
+    def add_source(self, source, gain=1.0, kind=None):
+        self.sources.append(source)
+
+    def read(self):
+        mixed = None
+        with self.lock:
+            for source in self.sources[:]:
+                chunk = source.read()
+                if len(chunk) < main.FRAME_SIZE:
+                    chunk += b'\x00' * (main.FRAME_SIZE - len(chunk))
+                mixed = chunk if mixed is None else audioop.add(mixed, chunk, 2)
+        return mixed
+
+def measure(mixer_class, source_count, frames, gain, music_ratio=0.0):
+    rng = np.random.default_rng(source_count)
+    mixer = mixer_class()
+    music_count = int(source_count * music_ratio)
+    for index in range(source_count):
+        frame = rng.integers(-8000, 8000, main.SAMPLES_PER_FRAME, dtype=np.int16).tobytes()
+        kind = main.MUSIC if index < music_count else main.SPEECH
+        mixer.add_source(LoopingSource(frame), gain=gain, kind=kind)
+
+    for _ in range(50):
+        mixer.read()
+    started = time.perf_counter()
+    for _ in range(frames):
+        mixer.read()
+    return (time.perf_counter() - started) / frames * 1e6
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--frames", type=int, default=2000)
+    parser.add_argument("--sources", type=int, nargs="+", default=[1, 2, 4, 8, 16, 32])
+    args = parser.parse_args()
+
+    header = f"{'sources':>7} {'numpy(us)':>10} {'numpy+gain(us)':>15} {'ducking(us)':>12}"
+    if audioop:
+        header += f" {'audioop(us)':>12}"
+    print(header)
+    for source_count in args.sources:
+        line = (
+            f"{source_count:>7} "
+            f"{measure(main.MixingAudioSource, source_count, args.frames, 1.0):>10.1f} "
+            f"{measure(main.MixingAudioSource, source_count, args.frames, 0.8):>15.1f} "
+            f"{measure(main.MixingAudioSource, source_count, args.frames, 1.0, music_ratio=0.5):>12.1f}"
+        )
+        if audioop:
+            line += f" {measure(LegacyMixingAudioSource, source_count, args.frames, 1.0):>12.1f}"
+        print(line)
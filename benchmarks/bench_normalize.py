@@ -0,0 +1,85 @@
+# ---------------------------------------------------------
+# 読み上げテキスト整形のベンチマーク
+# 使い方: python benchmarks/bench_normalize.py --messages 20000
+# 実際のチャットに近いメッセージ (URL・メンション・絵文字・コードブロック・連続文字・長文) を生成し、
+# 1メッセージあたりの整形時間と、VOICEVOXへ送る文字数がどれだけ減るかを計測する
+# legacy列は以前の on_message の判定 (split() を2回行い、URL・伏せ字を含む発言を丸ごと置き換える)
+# ---------------------------------------------------------
+import argparse
+import random
+import time
+from types import SimpleNamespace
+
+from fakes import FakeGuild, percentile
+import main
+
+WORDS = ["おはよう", "今日は", "ゲーム", "やろう", "眠い", "それな", "了解", "まじか", "草", "了解です", "あとで", "行けたら行く"]
+
+def make_guild():
+    guild = FakeGuild(1)
+    for index in range(50):
+        guild.members[1000 + index] = SimpleNamespace(display_name=f"ユーザー{index}")
+        guild.channels[2000 + index] = SimpleNamespace(name=f"雑談{index}")
+        guild.roles[3000 + index] = SimpleNamespace(name=f"ロール{index}")
+    return guild
+
+def make_message(rng):
+    parts = [rng.choice(WORDS) for _ in range(rng.randint(1, 6))]
+    kind = rng.random()
+    if kind < 0.15:
+        parts.insert(rng.randint(0, len(parts)), f"https://example.com/watch?v={rng.getrandbits(64):x}")
+    elif kind < 0.30:
+        parts.insert(0, f"<@{1000 + rng.randint(0, 60)}>")
+    elif kind < 0.40:
+        parts.append(f"<:emoji_{rng.randint(0, 99)}:{rng.getrandbits(60)}>" * rng.randint(1, 3))
+    elif kind < 0.50:
+        parts.append("w" * rng.randint(4, 40))
+    elif kind < 0.55:
+        parts.append("```py\n" + "print('hello')\n" * rng.randint(1, 30) + "```")
+    elif kind < 0.60:
+        parts.append(f"||{rng.choice(WORDS)}||")
+    elif kind < 0.65:
+        parts.append(f"<#{2000 + rng.randint(0, 49)}> に来て")
+    elif kind < 0.70:
+        parts = [rng.choice(WORDS) for _ in range(rng.randint(50, 200))]
+    elif kind < 0.75:
+        parts.append("😂" * rng.randint(1, 5))
+    return " ".join(parts)
+
+def legacy(text):
+    if any(word.startswith("http") for word in text.split()):
+        return "リンク省略"
+    if any(word.startswith("||") for word in text.split()):
+        return "センシティブ発言"
+    return text
+
+def measure(function, corpus):
+    times = []
+    total_chars = 0
+    for text in corpus:
+        started = time.perf_counter()
+        result = function(text)
+        times.append((time.perf_counter() - started) * 1e6)
+        total_chars += len(result)
+    return times, total_chars
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=20000)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    corpus = [make_message(rng) for _ in range(args.messages)]
+    guild = make_guild()
+    input_chars = sum(len(text) for text in corpus)
+
+    print(f"messages: {len(corpus)} / input chars: {input_chars}")
+    print(f"{'':>10} {'mean(us)':>9} {'p50(us)':>8} {'p99(us)':>8} {'chars sent':>11} {'longest':>8}")
+    for name, function in [("legacy", legacy), ("normalize", lambda text: main.normalize_tts_text(text, guild))]:
+        times, total_chars = measure(function, corpus)
+        longest = max(len(function(text)) for text in corpus)
+        print(
+            f"{name:>10} {sum(times) / len(times):>9.2f} {percentile(times, 50):>8.2f} "
+            f"{percentile(times, 99):>8.2f} {total_chars:>11} {longest:>8}"
+        )
@@ -0,0 +1,113 @@
+# ---------------------------------------------------------
+# !play のOpusパススルーのCPUベンチマーク
+# 使い方: python benchmarks/bench_opus.py --streams 1 4 8 16
+#         python benchmarks/bench_opus.py --input music.webm   (ffmpeg側のCPU時間も比較する)
+# 同時に再生しているサーバー数ごとに、1ストリーム・音声1秒あたりのBot側のCPU時間を比べる
+#   pcm:         従来の経路 (ffmpegでPCMへデコード → ミキサー → 20msごとにlibopusでエンコード)
+#   passthrough: Opusのパケットをそのまま送る経路 (エンコードなし)
+#   overlap:     パススルー中に読み上げが重なった時 (デコード → ミキサー → エンコード)
+# libopus (discord.pyの音声機能と同じもの) が必要
+# ---------------------------------------------------------
+import argparse
+import resource
+import sys
+import time
+
+import numpy as np
+
+import fakes  # noqa: F401 (main.py を import できるようにする)
+import main
+
+FRAMES_PER_SECOND = 50
+
+class LoopingSource(main.discord.AudioSource):
+    # 用意したフレーム (PCMまたはOpusのパケット) を繰り返し返す
+    def __init__(self, frames, opus=False):
+        self.frames = frames
+        self.opus = opus
+        self.index = 0
+
+    def read(self):
+        frame = self.frames[self.index % len(self.frames)]
+        self.index += 1
+        return frame
+
+    def is_opus(self):
+        return self.opus
+
+def make_frames(count):
+    rng = np.random.default_rng(0)
+    t = np.arange(main.SAMPLES_PER_FRAME // 2 * count) / main.PCM_SAMPLE_RATE
+    tone = (np.sin(2 * np.pi * 440 * t) * 8000 + rng.normal(0, 500, len(t))).astype("<i2")
+    stereo = np.repeat(tone, 2)
+    pcm_frames = [stereo[i * main.SAMPLES_PER_FRAME:(i + 1) * main.SAMPLES_PER_FRAME].tobytes() for i in range(count)]
+    encoder = main.discord.opus.Encoder()
+    opus_frames = [encoder.encode(frame, encoder.SAMPLES_PER_FRAME) for frame in pcm_frames]
+    return pcm_frames, opus_frames
+
+def measure(mode, stream_count, seconds, pcm_frames, opus_frames):
+    players = []
+    for _ in range(stream_count):
+        mixer = main.MixingAudioSource()
+        if mode == "pcm":
+            mixer.add_source(LoopingSource(pcm_frames), kind=main.MUSIC)
+        else:
+            mixer.add_source(LoopingSource(opus_frames, opus=True), kind=main.MUSIC)
+        if mode == "overlap":
+            mixer.add_source(LoopingSource(pcm_frames), kind=main.SPEECH)
+        players.append((mixer, main.discord.opus.Encoder()))
+
+    frames = int(seconds * FRAMES_PER_SECOND)
+    started = time.process_time()
+    for _ in range(frames):
+        for mixer, encoder in players:
+            # discord.py の再生スレッドと同じく、Opusでなければエンコードしてから送る
+            data = mixer.read()
+            if not mixer.is_opus():
+                encoder.encode(data, encoder.SAMPLES_PER_FRAME)
+    cpu = time.process_time() - started
+    return cpu / stream_count / seconds * 1000
+
+def measure_ffmpeg(path):
+    # ffmpeg (子プロセス) のCPU時間: PCMへのデコードと、Opusのコンテナ詰め替え (codec copy)
+    results = {}
+    for name, factory in [
+        ("decode", lambda: main.discord.FFmpegPCMAudio(path, options="-vn")),
+        ("copy", lambda: main.discord.FFmpegOpusAudio(path, codec="copy", options="-vn")),
+    ]:
+        before = resource.getrusage(resource.RUSAGE_CHILDREN)
+        source = factory()
+        frames = 0
+        while source.read():
+            frames += 1
+        source.cleanup()
+        after = resource.getrusage(resource.RUSAGE_CHILDREN)
+        cpu = (after.ru_utime - before.ru_utime) + (after.ru_stime - before.ru_stime)
+        results[name] = cpu / max(frames / FRAMES_PER_SECOND, 1e-9) * 1000
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--streams", type=int, nargs="+", default=[1, 4, 8, 16])
+    parser.add_argument("--seconds", type=float, default=5.0, help="ストリームごとに処理する音声の長さ (秒)")
+    parser.add_argument("--input", help="ffmpeg側の比較に使うOpus音声ファイル (webmなど)")
+    args = parser.parse_args()
+
+    if not main.discord.opus.is_loaded() and not main.discord.opus._load_default():
+        print("libopusが見つからないため計測できません。")
+        sys.exit(1)
+
+    pcm_frames, opus_frames = make_frames(FRAMES_PER_SECOND)
+    print("Bot側のCPU時間 (1ストリーム・音声1秒あたり ms)")
+    print(f"{'streams':>7} {'pcm':>8} {'passthrough':>12} {'overlap':>8}")
+    for stream_count in args.streams:
+        print(
+            f"{stream_count:>7} "
+            f"{measure('pcm', stream_count, args.seconds, pcm_frames, opus_frames):>8.2f} "
+            f"{measure('passthrough', stream_count, args.seconds, pcm_frames, opus_frames):>12.2f} "
+            f"{measure('overlap', stream_count, args.seconds, pcm_frames, opus_frames):>8.2f}"
+        )
+
+    if args.input:
+        results = measure_ffmpeg(args.input)
+        print(f"ffmpeg側のCPU時間 (音声1秒あたり ms): decode {results['decode']:.2f} / copy {results['copy']:.2f}")
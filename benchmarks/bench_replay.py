@@ -0,0 +1,208 @@
+# ---------------------------------------------------------
+# メッセージから音声までの経路をオフラインで再生するベンチマーク
+# 使い方: python benchmarks/bench_replay.py --guilds 4 --messages 50 --rate 1.0
+#         python benchmarks/bench_replay.py --record trace.jsonl   (生成したイベント列を保存)
+#         python benchmarks/bench_replay.py --trace trace.jsonl    (保存したイベント列を再生)
+# 偽のVOICEVOXエンジンを別プロセスで起動し、on_message / on_voice_state_update に
+# メッセージと入退室のイベントを時刻通りに流す。再生は実時間で read() を呼ぶ偽のボイスクライアントが行う
+# 同じイベント列 (--trace) を使えば、コミット間で数値を比べられる
+# ---------------------------------------------------------
+import argparse
+import asyncio
+import json
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from types import SimpleNamespace
+
+import aiohttp
+
+from fakes import FakeGuild, FakeTextChannel, FakeVoiceChannel, FakeVoiceClient, percentile
+from bench_normalize import make_message
+
+import main
+
+BENCH_DIR = Path(__file__).resolve().parent
+
+class FakeMember:
+    def __init__(self, member_id, display_name, bot=False):
+        self.id = member_id
+        self.display_name = display_name
+        self.bot = bot
+
+def make_trace(guild_count, message_count, rate, join_ratio, seed):
+    # 各サーバーで平均 rate 件/秒のメッセージ (ポアソン到着) と、一定割合の入退室を生成する
+    rng = random.Random(seed)
+    events = []
+    for guild_id in range(1, guild_count + 1):
+        now = 0.0
+        for _ in range(message_count):
+            now += rng.expovariate(rate)
+            user_id = rng.randint(1, 20)
+            if rng.random() < join_ratio:
+                events.append({"t": now, "type": rng.choice(["join", "leave"]), "guild": guild_id, "user": user_id})
+            else:
+                events.append({"t": now, "type": "message", "guild": guild_id, "user": user_id, "content": make_message(rng)})
+    return sorted(events, key=lambda event: event["t"])
+
+async def start_engine(args):
+    # 偽エンジンのCPU時間を計測に含めないよう、別プロセスで起動する
+    process = subprocess.Popen(
+        [
+            sys.executable, str(BENCH_DIR / "fake_voicevox.py"), "--ports", str(args.port),
+            "--latency", str(args.latency), "--per-char", str(args.per_char),
+            "--speech-per-char", str(args.speech_per_char),
+        ],
+        stdout=subprocess.DEVNULL,
+    )
+    url = f"http://127.0.0.1:{args.port}"
+    async with aiohttp.ClientSession() as session:
+        for _ in range(100):
+            try:
+                async with session.get(f"{url}/version") as res:
+                    if res.status == 200:
+                        return process, url
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(0.1)
+    process.kill()
+    raise RuntimeError("偽のVOICEVOXエンジンが起動しませんでした")
+
+def setup_guilds(guild_count):
+    guilds = {}
+    for guild_id in range(1, guild_count + 1):
+        guild = FakeGuild(guild_id)
+        voice_channel = FakeVoiceChannel(100 + guild_id, guild, [FakeMember(0, "Agora", bot=True)])
+        guild.voice_client = FakeVoiceClient(guild, voice_channel)
+        for user_id in range(1, 21):
+            guild.members[user_id] = FakeMember(user_id, f"ユーザー{user_id}")
+        # 退室イベントで全員いなくなって切断されないよう、常に誰かがいる状態にしておく
+        voice_channel.members.extend(guild.members.values())
+        text_channel = FakeTextChannel(guild_id, guild)
+        main.open_session(guild, text_channel)
+        guilds[guild_id] = (guild, voice_channel, text_channel)
+    return guilds
+
+async def dispatch(event, guilds):
+    guild, voice_channel, text_channel = guilds[event["guild"]]
+    member = guild.members[event["user"]]
+    if event["type"] == "message":
+        message = SimpleNamespace(
+            author=member, content=event["content"], guild=guild, channel=text_channel, attachments=[],
+        )
+        await main.on_message(message)
+    elif event["type"] == "join":
+        await main.on_voice_state_update(member, SimpleNamespace(channel=None), SimpleNamespace(channel=voice_channel))
+    else:
+        await main.on_voice_state_update(member, SimpleNamespace(channel=voice_channel), SimpleNamespace(channel=None))
+
+async def main_async(args):
+    if args.trace:
+        with open(args.trace, encoding="utf-8") as f:
+            events = [json.loads(line) for line in f if line.strip()]
+    else:
+        events = make_trace(args.guilds, args.messages, args.rate, args.join_ratio, args.seed)
+    if args.record:
+        with open(args.record, "w", encoding="utf-8") as f:
+            for event in events:
+                f.write(json.dumps(event, ensure_ascii=False) + "\n")
+    guild_count = max(event["guild"] for event in events)
+
+    process, url = await start_engine(args)
+    temp_dir = tempfile.TemporaryDirectory()
+    try:
+        # Discord・実際の設定DB・キャッシュに触れないよう差し替える
+        main.settings_store = main.SettingsStore(Path(temp_dir.name) / "settings.db")
+        main.voicevox = main.VoicevoxPool([(url, 1)], max_concurrency=args.concurrency)
+        main.tts_cache = main.TTSCache(main.TTS_CACHE_MAX_MB * 1024 * 1024)
+        async def process_commands(message):
+            pass
+        main.bot.process_commands = process_commands
+
+        latencies = []
+        main.METRIC_TTS_FIRST_AUDIO.observe = lambda value, **labels: latencies.append(value)
+        enqueued = 0
+        put = main.TTSQueue.put
+        def counting_put(self, text, style_id):
+            nonlocal enqueued
+            enqueued += 1
+            return put(self, text, style_id)
+        main.TTSQueue.put = counting_put
+
+        guilds = setup_guilds(guild_count)
+        cpu_started = time.process_time()
+        started = time.perf_counter()
+        for event in events:
+            delay = started + event["t"] - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            await dispatch(event, guilds)
+
+        # 積んだ発言が全て再生される (または破棄・結合される) まで待つ
+        def settled():
+            return len(latencies) + sum(
+                session.tts_queue.dropped + session.tts_queue.merged for session in main.sessions.values()
+            )
+        deadline = time.perf_counter() + args.drain_timeout
+        while time.perf_counter() < deadline and settled() < enqueued:
+            await asyncio.sleep(0.05)
+        wall = time.perf_counter() - started
+        cpu = time.process_time() - cpu_started
+
+        voice_clients = [guild.voice_client for guild, _, _ in guilds.values()]
+        dropped = sum(session.tts_queue.dropped for session in main.sessions.values())
+        late_frames = sum(voice_client.late_frames for voice_client in voice_clients)
+        frames = sum(voice_client.frames for voice_client in voice_clients)
+        for guild, _, _ in guilds.values():
+            main.close_session(guild)
+            await guild.voice_client.disconnect()
+        await main.voicevox.close()
+        main.settings_store.close()
+    finally:
+        process.terminate()
+        process.wait()
+        temp_dir.cleanup()
+
+    result = {
+        "events": len(events),
+        "enqueued": enqueued,
+        "played": len(latencies),
+        "dropped_utterances": dropped,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "max_ms": max(latencies, default=0) * 1000,
+        "frames": frames,
+        "late_frames": late_frames,
+        "cpu_ms_per_event": cpu / len(events) * 1000,
+        "wall_s": wall,
+    }
+    print(
+        f"events {result['events']} / enqueued {result['enqueued']} / played {result['played']} / dropped {result['dropped_utterances']}\n"
+        f"time to audio: p50 {result['p50_ms']:.0f} ms / p99 {result['p99_ms']:.0f} ms / max {result['max_ms']:.0f} ms\n"
+        f"frames {result['frames']} / late {result['late_frames']}\n"
+        f"CPU {result['cpu_ms_per_event']:.2f} ms/event / wall {result['wall_s']:.1f} s"
+    )
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(result, f, indent=2)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--guilds", type=int, default=4)
+    parser.add_argument("--messages", type=int, default=30, help="サーバーごとのイベント数")
+    parser.add_argument("--rate", type=float, default=0.3, help="サーバーごとの1秒あたりのイベント数")
+    parser.add_argument("--join-ratio", type=float, default=0.1, help="イベントのうち入退室の割合")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--trace", help="再生するイベント列 (JSONL)")
+    parser.add_argument("--record", help="イベント列をJSONLで保存する")
+    parser.add_argument("--json", help="結果をJSONで保存する")
+    parser.add_argument("--port", type=int, default=50199)
+    parser.add_argument("--latency", type=float, default=0.05, help="1リクエストあたりの固定の合成時間 (秒)")
+    parser.add_argument("--per-char", type=float, default=0.005, help="1文字あたりの合成時間 (秒)")
+    parser.add_argument("--speech-per-char", type=float, default=0.05, help="1文字あたりの音声の長さ (秒)")
+    parser.add_argument("--concurrency", type=int, default=main.VOICEVOX_MAX_CONCURRENCY)
+    parser.add_argument("--drain-timeout", type=float, default=120.0)
+    asyncio.run(main_async(parser.parse_args()))
@@ -0,0 +1,90 @@
+# ---------------------------------------------------------
+# 同時セッション数と読み上げ遅延の負荷テスト
+# 使い方: python benchmarks/bench_sessions.py --sessions 1 4 16 --messages 20
+# VOICEVOXは固定遅延のスタブに置き換え、発言から最初の音声フレームまでの時間を計測する
+# ---------------------------------------------------------
+import argparse
+import asyncio
+import time
+
+from fakes import FakeGuild, FakeTextChannel, FakeVoiceClient, percentile
+
+import main
+
+UTTERANCE_SECONDS = 0.5
+
+class TimedPCMSource(main.PCMAudioSource):
+    def __init__(self, pcm, on_first_read):
+        super().__init__(pcm)
+        self._on_first_read = on_first_read
+
+    def read(self):
+        if self._on_first_read:
+            self._on_first_read()
+            self._on_first_read = None
+        return super().read()
+
+async def run_scenario(session_count, message_count, interval, synth_latency):
+    enqueued = {}
+    latencies = []
+    pcm = b"\x01\x00" * int(main.PCM_SAMPLE_RATE * main.PCM_CHANNELS * UTTERANCE_SECONDS)
+
+    async def fake_create_tts_source(text, character_id, april_fool=False):
+        # エンジンの同時実行数制限はそのまま使い、合成時間だけを固定値で模擬する
+        async with main.voicevox.nodes[0].semaphore:
+            await asyncio.sleep(synth_latency)
+
+        def record():
+            latencies.append(time.perf_counter() - enqueued[text])
+        return TimedPCMSource(pcm, record)
+
+    main.create_tts_source = fake_create_tts_source
+    # 偽のギルドのセッションを data/settings.db に保存しない
+    main.SESSION_RESUME = False
+
+    voice_clients = []
+    for index in range(session_count):
+        guild = FakeGuild(index + 1)
+        guild.voice_client = FakeVoiceClient(guild)
+        voice_clients.append(guild.voice_client)
+        main.open_session(guild, FakeTextChannel(index + 1, guild))
+
+    for message_index in range(message_count):
+        for voice_client in voice_clients:
+            text = f"{voice_client.guild.id}-{message_index}"
+            enqueued[text] = time.perf_counter()
+            await main.generate_and_play_tts(voice_client, text, main.CHARACTER_MAP[main.DEFAULT_CHARACTER])
+        await asyncio.sleep(interval)
+
+    # 最後の発言の再生が終わるまで待つ
+    deadline = time.perf_counter() + message_count * (UTTERANCE_SECONDS + synth_latency) + 10
+    while len(latencies) < len(enqueued) and time.perf_counter() < deadline:
+        await asyncio.sleep(0.1)
+
+    dropped = sum(session.tts_queue.dropped for session in main.sessions.values())
+    late_frames = sum(voice_client.late_frames for voice_client in voice_clients)
+    for voice_client in voice_clients:
+        main.close_session(voice_client.guild)
+        await voice_client.disconnect()
+
+    return latencies, dropped, late_frames
+
+async def main_async(args):
+    print(f"{'sessions':>8} {'played':>7} {'dropped':>8} {'p50(ms)':>9} {'p99(ms)':>9} {'max(ms)':>9} {'late':>6}")
+    for session_count in args.sessions:
+        latencies, dropped, late_frames = await run_scenario(
+            session_count, args.messages, args.interval, args.synth_latency
+        )
+        print(
+            f"{session_count:>8} {len(latencies):>7} {dropped:>8} "
+            f"{percentile(latencies, 50) * 1000:>9.1f} {percentile(latencies, 99) * 1000:>9.1f} "
+            f"{max(latencies, default=0) * 1000:>9.1f} {late_frames:>6}"
+        )
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sessions", type=int, nargs="+", default=[1, 2, 4, 8, 16, 32])
+    parser.add_argument("--messages", type=int, default=20)
+    parser.add_argument("--interval", type=float, default=0.6, help="各セッションの発言間隔 (秒)")
+    parser.add_argument("--synth-latency", type=float, default=0.15, help="模擬する合成時間 (秒)")
+    asyncio.run(main_async(parser.parse_args()))
@@ -0,0 +1,95 @@
+# ---------------------------------------------------------
+# 長文の文ごと合成 (ストリーミング) のベンチマーク
+# 使い方: python benchmarks/bench_streaming.py --sentences 1 2 4
+# VOICEVOXは文字数に比例して時間のかかるスタブに置き換え、同じ長文を
+# 一括で合成した場合 (tts_streaming: false) と文ごとに合成した場合で、
+# 発言から最初の音声フレームまでの時間・再生完了までの時間・合成待ちで挟まった無音フレーム数を比べる
+# ---------------------------------------------------------
+import argparse
+import asyncio
+import time
+import wave
+from io import BytesIO
+
+from fakes import FakeGuild, FakeTextChannel, FakeVoiceClient
+
+import main
+
+SENTENCE = "今日はみんなでゲームをする予定なので、夜の九時くらいに集まってほしいのだ。"
+VOICEVOX_SAMPLE_RATE = 24000
+
+def make_wav(seconds):
+    output = BytesIO()
+    with wave.open(output, "wb") as wf:
+        wf.setnchannels(1)
+        wf.setsampwidth(2)
+        wf.setframerate(VOICEVOX_SAMPLE_RATE)
+        wf.writeframes(b"\x00\x00" * int(VOICEVOX_SAMPLE_RATE * seconds))
+    return output.getvalue()
+
+def install_stub(overhead, per_char, speech_per_char):
+    async def synthesize(text, speaker):
+        # 同時実行数の制限は実物と同じセマフォを使う
+        async with main.voicevox.nodes[0].semaphore:
+            await asyncio.sleep(overhead + per_char * len(text))
+        return make_wav(speech_per_char * len(text))
+    main.voicevox.synthesize = synthesize
+
+streaming_sources = []
+
+def install_source_recorder():
+    # 合成待ちの無音フレーム数を読むため、作られたストリーミングソースを記録しておく
+    create_streaming_source = main.create_streaming_source
+    async def recording_create_streaming_source(chunks, character_id):
+        source = await create_streaming_source(chunks, character_id)
+        streaming_sources.append(source)
+        return source
+    main.create_streaming_source = recording_create_streaming_source
+
+async def run_once(text, streaming):
+    main.TTS_STREAMING = streaming
+    # 偽のギルドのセッションを data/settings.db に保存しない
+    main.SESSION_RESUME = False
+    # 毎回キャッシュを使わずに合成させる
+    main.tts_cache.invalidate()
+
+    guild = FakeGuild(1)
+    guild.voice_client = FakeVoiceClient(guild)
+    session = main.open_session(guild, FakeTextChannel(1, guild))
+    streaming_sources.clear()
+    started = time.perf_counter()
+    await main.generate_and_play_tts(guild.voice_client, text, main.CHARACTER_MAP[main.DEFAULT_CHARACTER])
+
+    while session.tts_queue.played == 0 or guild.voice_client.is_playing():
+        await asyncio.sleep(0.01)
+    finished = time.perf_counter() - started
+
+    stats = session.tts_queue.stats()
+    underruns = sum(source.underruns for source in streaming_sources)
+    main.close_session(guild)
+    await guild.voice_client.disconnect()
+    return stats["max_first_audio"], finished, underruns
+
+async def main_async(args):
+    install_stub(args.overhead, args.per_char, args.speech_per_char)
+    install_source_recorder()
+    print(
+        f"{'sentences':>9} {'chars':>6} {'batch first(ms)':>16} {'stream first(ms)':>17} "
+        f"{'batch total(s)':>15} {'stream total(s)':>16} {'underruns':>10}"
+    )
+    for count in args.sentences:
+        text = SENTENCE * count
+        batch_first, batch_total, _ = await run_once(text, False)
+        stream_first, stream_total, underruns = await run_once(text, True)
+        print(
+            f"{count:>9} {len(text):>6} {batch_first * 1000:>16.0f} {stream_first * 1000:>17.0f} "
+            f"{batch_total:>15.2f} {stream_total:>16.2f} {underruns:>10}"
+        )
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sentences", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--overhead", type=float, default=0.05, help="1リクエストあたりの固定の合成時間 (秒)")
+    parser.add_argument("--per-char", type=float, default=0.01, help="1文字あたりの合成時間 (秒)")
+    parser.add_argument("--speech-per-char", type=float, default=0.12, help="1文字あたりの音声の長さ (秒)")
+    asyncio.run(main_async(parser.parse_args()))
@@ -0,0 +1,103 @@
+# ---------------------------------------------------------
+# 複数VOICEVOXエンジンの負荷分散・フェイルオーバーの確認
+# 使い方: python benchmarks/bench_voicevox_pool.py --requests 300 --concurrency 8
+# ローカルに偽のエンジンを3台立て (1台は合成が一定確率で失敗、1台は途中で停止して辞書が空の状態で復帰)、
+# 呼び出し側から見た失敗数・遅延・エンジンごとの振り分け数と、辞書が全エンジンで揃っているかを表示する
+# ---------------------------------------------------------
+import argparse
+import asyncio
+import tempfile
+import time
+from pathlib import Path
+
+from fakes import percentile
+from fake_voicevox import FakeVoicevoxEngine
+
+import main
+
+WORDS = [("Agora", "アゴラ"), ("VOICEVOX", "ボイスボックス"), ("yt-dlp", "ワイティーディーエルピー")]
+
+async def main_async(args):
+    engines = [
+        FakeVoicevoxEngine(latency=args.latency, seed=0),
+        FakeVoicevoxEngine(latency=args.latency, seed=1),
+        FakeVoicevoxEngine(latency=args.latency, failure_rate=args.failure_rate, seed=2),
+    ]
+    for engine in engines:
+        await engine.start()
+
+    # 実際の設定DBを汚さないよう、一時ディレクトリのDBを使う
+    temp_dir = tempfile.TemporaryDirectory()
+    main.settings_store = main.SettingsStore(Path(temp_dir.name) / "settings.db")
+
+    pool = main.VoicevoxPool(
+        [(engines[0].url, 2), (engines[1].url, 1), (engines[2].url, 1)],
+        max_concurrency=2,
+        failure_threshold=3,
+        cooldown=args.cooldown,
+        health_interval=args.health_interval,
+    )
+    main.voicevox = pool
+    await pool.check_health()
+    pool.on_recovered = lambda node: asyncio.create_task(main.resync_engine(node))
+    pool.start_health_checks()
+
+    for word, pronunciation in WORDS:
+        word_uuid = await pool.add_user_dict_word(word, pronunciation)
+        await main.settings_store.set_dict_word(word, word_uuid, pronunciation)
+
+    latencies = []
+    errors = 0
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def request(index):
+        nonlocal errors
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                await pool.synthesize(f"テストメッセージ{index}", 3)
+                latencies.append(time.perf_counter() - started)
+            except Exception:
+                errors += 1
+
+    async def outage():
+        # 途中でエンジン2を止め、辞書が空の状態で復帰させる
+        await asyncio.sleep(args.outage_at)
+        engines[1].down = True
+        await asyncio.sleep(args.outage_seconds)
+        engines[1].restart()
+
+    started = time.perf_counter()
+    outage_task = asyncio.create_task(outage())
+    await asyncio.gather(*(request(index) for index in range(args.requests)))
+    elapsed = time.perf_counter() - started
+    await outage_task
+    # 復帰後のヘルスチェックと辞書の同期を待つ
+    await asyncio.sleep(args.health_interval * 3)
+
+    print(f"requests: {args.requests} / errors: {errors} / {elapsed:.2f} s ({args.requests / elapsed:.1f} req/s)")
+    print(f"latency p50 {percentile(latencies, 50) * 1000:.0f} ms / p99 {percentile(latencies, 99) * 1000:.0f} ms")
+    print(f"{'engine':>24} {'weight':>6} {'requests':>9} {'failures':>9} {'synthesized':>12} {'dict words':>11}")
+    for node, engine in zip(pool.nodes, engines):
+        print(
+            f"{node.base_url:>24} {node.weight:>6} {node.requests:>9} {node.failures:>9} "
+            f"{engine.syntheses:>12} {len(engine.user_dict):>11}/{len(WORDS)}"
+        )
+
+    await pool.close()
+    for engine in engines:
+        await engine.stop()
+    main.settings_store.close()
+    temp_dir.cleanup()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=300)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--latency", type=float, default=0.05, help="1リクエストあたりの固定の合成時間 (秒)")
+    parser.add_argument("--failure-rate", type=float, default=0.3, help="エンジン3の合成が失敗する確率")
+    parser.add_argument("--outage-at", type=float, default=0.5, help="エンジン2を止めるまでの秒数")
+    parser.add_argument("--outage-seconds", type=float, default=1.5, help="エンジン2を止めておく秒数")
+    parser.add_argument("--cooldown", type=float, default=2.0)
+    parser.add_argument("--health-interval", type=float, default=0.5)
+    asyncio.run(main_async(parser.parse_args()))
@@ -0,0 +1,148 @@
+# ---------------------------------------------------------
+# ローカルで動かすVOICEVOXエンジンの代替品 (負荷分散・フェイルオーバーの確認用)
+# 使い方: python benchmarks/fake_voicevox.py --ports 50121 50122
+# 起動後、config.yaml の VOICEVOX_URL に http://127.0.0.1:50121 などを並べるとBotから使える
+# 合成時間は文字数に比例し、無音のWAV (24kHz/モノラル) を返す
+# ---------------------------------------------------------
+import argparse
+import asyncio
+import random
+import uuid
+import wave
+from io import BytesIO
+
+from aiohttp import web
+
+SAMPLE_RATE = 24000
+
+def make_wav(seconds):
+    output = BytesIO()
+    with wave.open(output, "wb") as wf:
+        wf.setnchannels(1)
+        wf.setsampwidth(2)
+        wf.setframerate(SAMPLE_RATE)
+        wf.writeframes(b"\x00\x00" * int(SAMPLE_RATE * seconds))
+    return output.getvalue()
+
+class FakeVoicevoxEngine:
+    def __init__(self, port=0, latency=0.05, per_char=0.005, speech_per_char=0.12, failure_rate=0.0, seed=None):
+        self.port = port
+        self.latency = latency
+        self.per_char = per_char
+        self.speech_per_char = speech_per_char
+        self.failure_rate = failure_rate
+        self.random = random.Random(seed)
+        # down にすると全てのリクエストに503を返す (エンジンの再起動中を模擬する)
+        self.down = False
+        self.user_dict = {}
+        self.syntheses = 0
+        self._runner = None
+
+        self.app = web.Application()
+        self.app.add_routes([
+            web.get("/version", self.version),
+            web.post("/audio_query", self.audio_query),
+            web.post("/synthesis", self.synthesis),
+            web.get("/user_dict", self.get_user_dict),
+            web.post("/import_user_dict", self.import_user_dict),
+            web.post("/user_dict_word", self.add_user_dict_word),
+            web.delete("/user_dict_word/{word_uuid}", self.delete_user_dict_word),
+        ])
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.port}"
+
+    async def start(self):
+        self._runner = web.AppRunner(self.app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, "127.0.0.1", self.port)
+        await site.start()
+        self.port = self._runner.addresses[0][1]
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    def restart(self):
+        # コンテナの作り直しと同じく、辞書が空の状態で復帰させる
+        self.user_dict.clear()
+        self.down = False
+
+    def _check(self):
+        if self.down:
+            raise web.HTTPServiceUnavailable()
+
+    async def version(self, request):
+        self._check()
+        return web.json_response("0.0.0-fake")
+
+    async def audio_query(self, request):
+        self._check()
+        return web.json_response({"text": request.query["text"], "speaker": int(request.query["speaker"])})
+
+    async def synthesis(self, request):
+        self._check()
+        audio_query = await request.json()
+        text = audio_query["text"]
+        await asyncio.sleep(self.latency + self.per_char * len(text))
+        if self.random.random() < self.failure_rate:
+            raise web.HTTPInternalServerError()
+        self.syntheses += 1
+        return web.Response(body=make_wav(self.speech_per_char * len(text)), content_type="audio/wav")
+
+    async def get_user_dict(self, request):
+        self._check()
+        return web.json_response(self.user_dict)
+
+    async def import_user_dict(self, request):
+        self._check()
+        words = await request.json()
+        if request.query.get("override") == "true":
+            self.user_dict.update(words)
+        else:
+            for word_uuid, word in words.items():
+                self.user_dict.setdefault(word_uuid, word)
+        return web.Response(status=204)
+
+    async def add_user_dict_word(self, request):
+        self._check()
+        word_uuid = str(uuid.uuid4())
+        self.user_dict[word_uuid] = {
+            "surface": request.query["surface"],
+            "pronunciation": request.query["pronunciation"],
+            "accent_type": int(request.query.get("accent_type", 0)),
+        }
+        return web.json_response(word_uuid)
+
+    async def delete_user_dict_word(self, request):
+        self._check()
+        if self.user_dict.pop(request.match_info["word_uuid"], None) is None:
+            raise web.HTTPUnprocessableEntity()
+        return web.Response(status=204)
+
+async def main_async(args):
+    engines = [
+        FakeVoicevoxEngine(
+            port, latency=args.latency, per_char=args.per_char,
+            speech_per_char=args.speech_per_char, failure_rate=args.failure_rate,
+        )
+        for port in args.ports
+    ]
+    for engine in engines:
+        await engine.start()
+        print(f"fake VOICEVOX: {engine.url}", flush=True)
+    await asyncio.Event().wait()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--ports", type=int, nargs="+", default=[50121])
+    parser.add_argument("--latency", type=float, default=0.05, help="1リクエストあたりの固定の合成時間 (秒)")
+    parser.add_argument("--per-char", type=float, default=0.005, help="1文字あたりの合成時間 (秒)")
+    parser.add_argument("--speech-per-char", type=float, default=0.12, help="1文字あたりの音声の長さ (秒)")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="合成が500で失敗する確率")
+    try:
+        asyncio.run(main_async(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,122 @@
+# ---------------------------------------------------------
+# ベンチマーク用のDiscordオブジェクトの代替品
+# ---------------------------------------------------------
+import sys
+import threading
+import time
+from pathlib import Path
+
+# リポジトリ直下の main.py を import できるようにする
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+FRAME_SECONDS = 0.02
+
+class FakeVoiceClient:
+    # discord.pyの再生スレッドの代わりに、AudioSource.read を20msごとに実時間で消費する
+    def __init__(self, guild, channel=None):
+        self.guild = guild
+        self.channel = channel or FakeVoiceChannel(0, guild)
+        self.source = None
+        self.frames = 0
+        self.late_frames = 0
+        self.read_seconds = 0.0
+        self._playing = False
+        self._paused = False
+        self._connected = True
+        self._thread = None
+
+    def is_connected(self):
+        return self._connected
+
+    def is_playing(self):
+        return self._playing and not self._paused
+
+    def is_paused(self):
+        return self._playing and self._paused
+
+    def play(self, source, after=None):
+        if self._playing:
+            raise RuntimeError("Already playing audio.")
+        self.source = source
+        self._playing = True
+        self._paused = False
+        self._thread = threading.Thread(target=self._run, args=(after,), daemon=True)
+        self._thread.start()
+
+    def pause(self):
+        self._paused = True
+
+    def resume(self):
+        self._paused = False
+
+    def stop(self):
+        self._playing = False
+
+    async def disconnect(self, force=False):
+        self.stop()
+        self._connected = False
+
+    async def move_to(self, channel):
+        self.channel = channel
+
+    def _run(self, after):
+        deadline = time.perf_counter()
+        while self._playing and self._connected:
+            if not self._paused:
+                started = time.perf_counter()
+                data = self.source.read()
+                self.read_seconds += time.perf_counter() - started
+                if not data:
+                    break
+                self.frames += 1
+            deadline += FRAME_SECONDS
+            delay = deadline - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                # 20msの送信期限に間に合わなかったフレーム
+                self.late_frames += 1
+        self._playing = False
+        self.source.cleanup()
+        if after:
+            after(None)
+
+class FakeGuild:
+    def __init__(self, guild_id, name=None):
+        self.id = guild_id
+        self.name = name or f"guild-{guild_id}"
+        self.voice_client = None
+        self.members = {}
+        self.roles = {}
+        self.channels = {}
+
+    def get_member(self, member_id):
+        return self.members.get(member_id)
+
+    def get_role(self, role_id):
+        return self.roles.get(role_id)
+
+    def get_channel(self, channel_id):
+        return self.channels.get(channel_id)
+
+class FakeVoiceChannel:
+    def __init__(self, channel_id, guild=None, members=None):
+        self.id = channel_id
+        self.guild = guild
+        self.members = members or []
+
+class FakeTextChannel:
+    def __init__(self, channel_id, guild=None):
+        self.id = channel_id
+        self.guild = guild
+        self.sent = []
+
+    async def send(self, content=None, **kwargs):
+        self.sent.append(content)
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
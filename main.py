@@ -1,24 +1,54 @@
+import time
+# 起動の段階ごとの所要時間を計測する (インポートの時間も含めるため、他のimportより先に記録する)
+STARTUP_STARTED = time.perf_counter()
+
 import discord
 from discord.ext import commands
-import requests
-from io import BytesIO
+import aiohttp
+import aiohttp.web
+from io import BytesIO, StringIO
 import json
-import yt_dlp
-from yt_dlp.utils import DownloadError
 import uuid
 import yaml
 import asyncio
 import urllib.parse
 import shutil
-from gtts import gTTS
-from datetime import datetime
+from datetime import datetime, timezone
 from pathlib import Path
 import os
 import sys
 import logging
 from dotenv import load_dotenv
-import audioop
 import threading
+import itertools
+import contextvars
+import bisect
+import traceback
+import csv
+import sqlite3
+import re
+from concurrent.futures import ThreadPoolExecutor
+import wave
+import hashlib
+import unicodedata
+import difflib
+from collections import OrderedDict, Counter, deque
+import numpy as np
+# yt-dlp (!play / !save) と gTTS (エイプリルフール) は読み込みに時間がかかるため、初めて使う時に読み込む
+
+# ---------------------------------------------------------
+# 起動時間の計測 (imports / config / setup / login / ready)
+# ---------------------------------------------------------
+startup_phases = []
+startup_phase_mark = STARTUP_STARTED
+
+def mark_startup_phase(phase):
+    global startup_phase_mark
+    now = time.perf_counter()
+    startup_phases.append((phase, now - startup_phase_mark))
+    startup_phase_mark = now
+
+mark_startup_phase("imports")
 
 # ---------------------------------------------------------
 # ログ設定
@@ -41,20 +71,31 @@ USER_CHAR_PATH = BASE_PATH / "user_character.json"
 DICT_PATH = BASE_PATH / "user_dict.json"
 VIDEO_DIR = BASE_PATH / "saved_video"
 AUDIO_DIR = BASE_PATH / "saved_audio"
+DATA_DIR = BASE_PATH / "data"
+SAVED_INDEX_PATH = DATA_DIR / "saved_index.json"
+SETTINGS_DB_PATH = DATA_DIR / "settings.db"
 OUTPUT_WAV_PATH = BASE_PATH / "output.wav"
 
 load_dotenv(BASE_PATH / ".env")
 
-for dir_path in [VIDEO_DIR, AUDIO_DIR]:
+for dir_path in [VIDEO_DIR, AUDIO_DIR, DATA_DIR]:
     dir_path.mkdir(exist_ok=True)
 
+# 旧バージョンが残した読み上げ用の一時WAVファイルを掃除する
+for stale_path in [*BASE_PATH.glob("tts_*.wav"), OUTPUT_WAV_PATH]:
+    try:
+        stale_path.unlink(missing_ok=True)
+    except OSError as e:
+        logging.warning(f"一時ファイルの削除に失敗しました: {stale_path} ({e})")
+
 if not CONFIG_PATH.exists():
     logging.critical(f"設定ファイルが見つかりません: {CONFIG_PATH}")
     sys.exit(1)
 
 try:
     with open(CONFIG_PATH, encoding="utf-8") as f:
-        config = yaml.safe_load(f)
+        # C実装のローダーがあればそちらを使う (PyYAMLがlibyamlなしでビルドされている場合は純Python版)
+        config = yaml.load(f, Loader=getattr(yaml, "CSafeLoader", yaml.SafeLoader))
 except Exception as e:
     logging.critical(f"Config読み込みエラー: {e}")
     sys.exit(1)
@@ -64,9 +105,72 @@ DEFAULT_CHARACTER = config["default_character_name"]
 CHARACTER_MAP = config["character_map"]
 AUDIOPLAY = config["audioplay"]
 DEVELOPER_MODE = config.get("developer_mode_**DO_NOT_CHANGE_HERE**", False)
+# VOICEVOXエンジンのURL (リストで複数指定すると負荷分散する。{url: ..., weight: 2} で重み付け)
 VOICEVOX_URL = config["VOICEVOX_URL"]
 # メンテナンスモードの設定読み込み (デフォルトはFalse)
 MAINTENANCE_MODE = config.get("maintenance_mode", False)
+# VOICEVOXへのリクエスト設定 (タイムアウト秒数 / 同時合成数)
+VOICEVOX_TIMEOUT = config.get("voicevox_timeout", 30)
+VOICEVOX_MAX_CONCURRENCY = config.get("voicevox_max_concurrency", 2)
+# 複数エンジン時の設定 (ヘルスチェック間隔秒 / 連続失敗で切り離す回数 / 切り離す秒数)
+VOICEVOX_HEALTH_INTERVAL = config.get("voicevox_health_interval", 10)
+VOICEVOX_FAILURE_THRESHOLD = config.get("voicevox_failure_threshold", 3)
+VOICEVOX_COOLDOWN = config.get("voicevox_cooldown", 30)
+# 合成音声キャッシュの設定 (ディレクトリ指定時のみディスクにも保存)
+TTS_CACHE_MAX_MB = config.get("tts_cache_max_mb", 64)
+TTS_CACHE_DIR = config.get("tts_cache_dir")
+TTS_CACHE_DISK_MAX_MB = config.get("tts_cache_disk_max_mb", 512)
+# 起動時に定型文を事前合成する、デフォルト以外のキャラクター数 (使用者の多い順)
+WARMUP_TOP_CHARACTERS = config.get("warmup_top_characters", 2)
+# 読み上げキューの設定
+# tts_queue_policy: 溢れた時の動作 (drop_oldest: 古い発言を捨てる / drop_newest: 新しい発言を捨てる / merge: 末尾の発言に結合する)
+TTS_QUEUE_MAX = config.get("tts_queue_max", 10)
+TTS_LOOKAHEAD = config.get("tts_lookahead", 3)
+TTS_QUEUE_POLICY = config.get("tts_queue_policy", "drop_oldest")
+# ダッキング (読み上げ中に音楽の音量を自動で下げる) の設定
+DUCK_LEVEL = config.get("duck_level", 0.3)
+DUCK_ATTACK_MS = config.get("duck_attack_ms", 60)
+DUCK_RELEASE_MS = config.get("duck_release_ms", 400)
+# 添付音声ファイルの再生上限 (サイズMB / 再生秒数)
+ATTACHMENT_MAX_MB = config.get("attachment_max_mb", 50)
+ATTACHMENT_MAX_SECONDS = config.get("attachment_max_seconds", 600)
+# !play のURL抽出設定 (抽出スレッド数 / 有効期限が読み取れないURLの保持秒数)
+YTDL_WORKERS = config.get("ytdl_workers", 2)
+STREAM_CACHE_TTL = config.get("stream_cache_ttl", 1800)
+STREAM_CACHE_SIZE = config.get("stream_cache_size", 128)
+# !save の同時ダウンロード数
+SAVE_WORKERS = config.get("save_workers", 2)
+# 保存ファイルの容量上限 (saved_video と saved_audio の合計MB) / 最終利用からの保持日数 (0で無期限)
+SAVED_QUOTA_MB = config.get("saved_quota_mb", 10240)
+SAVED_MAX_AGE_DAYS = config.get("saved_max_age_days", 0)
+# 読み上げテキストの整形 (最大文字数 / 同じ文字の連続を残す数 / カスタム絵文字の扱い name: 名前を読む・strip: 読まない)
+TTS_MAX_LENGTH = config.get("tts_max_length", 100)
+TTS_REPEAT_MAX = config.get("tts_repeat_max", 3)
+TTS_EMOJI = config.get("tts_emoji", "name")
+# 長文を文ごとに分けて合成し、最初の文から再生を始める (短すぎる文は次の文と結合する)
+TTS_STREAMING = config.get("tts_streaming", True)
+TTS_CHUNK_MIN_LENGTH = config.get("tts_chunk_min_length", 15)
+# Prometheus形式のメトリクスを公開するポート (0で無効) / ログに発言ごとのトレースIDを付けるか
+METRICS_PORT = config.get("metrics_port", 0)
+METRICS_HOST = config.get("metrics_host", "127.0.0.1")
+TRACE_LOGGING = config.get("trace_logging", False)
+# イベントループの停止検知 (この時間以上止まったらスタックを記録する。0で無効)
+STALL_THRESHOLD_MS = config.get("stall_threshold_ms", 250)
+# !play でOpusの配信をデコードせずにそのまま送る (読み上げと重なる間だけデコードしてミキサーで合成する)
+OPUS_PASSTHROUGH = config.get("opus_passthrough", True)
+# !play の再生キューの上限曲数 (プレイリストもこの件数までしか展開しない)
+MUSIC_QUEUE_MAX = config.get("music_queue_max", 100)
+# !set の対象検索用に、起動時にサーバーのメンバー一覧を取得して名前の索引を作る (メンバー自体はキャッシュしない)
+MEMBER_INDEX_PRELOAD = config.get("member_index_preload", True)
+# ボイス接続が切れた時・再起動した時に、直前のセッション (接続先・再生中の曲と位置・再生キュー) を自動で復元する
+# (再生位置の保存間隔秒 / 再接続を試みる回数)
+SESSION_RESUME = config.get("session_resume", True)
+SESSION_CHECKPOINT_INTERVAL = config.get("session_checkpoint_interval", 10)
+SESSION_RESUME_ATTEMPTS = config.get("session_resume_attempts", 3)
+# この秒数より前に保存されたセッションは古いものとして復元しない (停止していた間に状況が変わっているため)
+SESSION_MAX_AGE = config.get("session_max_age", 600)
+
+mark_startup_phase("config")
 
 # ---------------------------------------------------------
 # 起動チェック
@@ -76,83 +180,2533 @@ if DEVELOPER_MODE:
         logging.critical("必要なファイルが不足しています: .envファイルが見つかりません。(Developer Mode)")
         sys.exit(1)
 
+# ---------------------------------------------------------
+# メトリクス (Prometheusのテキスト形式) とトレースID
+# ---------------------------------------------------------
+# 発言ごとのトレースID。ログの [%(trace_id)s] に出力する
+trace_id_var = contextvars.ContextVar("trace_id", default="-")
+# 読み上げ対象のメッセージを受け取った時刻 (最初の音声までの時間の起点)
+message_received_var = contextvars.ContextVar("message_received", default=None)
+
+class TraceIdFilter(logging.Filter):
+    def filter(self, record):
+        record.trace_id = trace_id_var.get()
+        return True
+
+if TRACE_LOGGING:
+    for handler in logging.getLogger().handlers:
+        handler.addFilter(TraceIdFilter())
+        handler.setFormatter(logging.Formatter("%(asctime)s [%(levelname)s] [%(trace_id)s] %(message)s"))
+
+def new_trace_id():
+    return uuid.uuid4().hex[:8]
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+class Metric:
+    # 値はラベルの組ごとに保持する。再生スレッドからも更新されるためロックで守る
+    # function を渡すと、値を持たずに取得時に計算する (数値、または [(ラベルのdict, 値), ...] を返す)
+    kind = "untyped"
+
+    def __init__(self, name, description, function=None):
+        self.name = name
+        self.description = description
+        self.function = function
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def samples(self):
+        if self.function is not None:
+            result = self.function()
+            if isinstance(result, (int, float)):
+                return [(self.name, (), result)]
+            return [(self.name, tuple(sorted(labels.items())), value) for labels, value in result]
+        with self.lock:
+            return [(self.name, labels, value) for labels, value in self.values.items()]
+
+class MetricCounter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+class MetricGauge(Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[tuple(sorted(labels.items()))] = value
+
+class MetricHistogram(Metric):
+    kind = "histogram"
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, name, description, buckets=DEFAULT_BUCKETS):
+        super().__init__(name, description)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            state = self.values.get(key)
+            if state is None:
+                # [バケットごとの件数 (累積前), 合計, 件数]
+                state = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    def samples(self):
+        with self.lock:
+            states = [(labels, list(state[0]), state[1], state[2]) for labels, state in self.values.items()]
+        result = []
+        for labels, counts, total, count in states:
+            cumulative = 0
+            for bound, bucket_count in zip((*self.buckets, "+Inf"), counts):
+                cumulative += bucket_count
+                result.append((f"{self.name}_bucket", (*labels, ("le", bound)), cumulative))
+            result.append((f"{self.name}_sum", labels, total))
+            result.append((f"{self.name}_count", labels, count))
+        return result
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, name, description, function=None):
+        return self._register(MetricCounter(name, description, function))
+
+    def gauge(self, name, description, function=None):
+        return self._register(MetricGauge(name, description, function))
+
+    def histogram(self, name, description, buckets=MetricHistogram.DEFAULT_BUCKETS):
+        return self._register(MetricHistogram(name, description, buckets))
+
+    def _register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.description}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            try:
+                samples = metric.samples()
+            except Exception as e:
+                logging.warning(f"Metric error ({metric.name}): {e}")
+                continue
+            for name, labels, value in samples:
+                lines.append(f"{name}{_format_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry()
+METRIC_VOICEVOX_SECONDS = metrics.histogram(
+    "agora_voicevox_request_seconds", "VOICEVOXへのリクエスト時間 (stage: wait=同時実行数の待ち / audio_query / synthesis)"
+)
+METRIC_VOICEVOX_ERRORS = metrics.counter("agora_voicevox_errors_total", "VOICEVOXでの合成の失敗数")
+METRIC_TTS_FIRST_AUDIO = metrics.histogram(
+    "agora_tts_first_audio_seconds", "メッセージの受信から最初の音声フレームが読まれるまでの時間"
+)
+METRIC_MIXER_READ = metrics.histogram(
+    "agora_mixer_read_seconds", "ミキサーの1フレームの処理時間",
+    buckets=(0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.02),
+)
+METRIC_MIXER_OVERRUNS = metrics.counter("agora_mixer_overruns_total", "1フレーム (20ms) 以内に処理が終わらなかった回数")
+METRIC_YTDL_EXTRACT = metrics.histogram("agora_ytdl_extract_seconds", "!play の再生用URLの抽出時間")
+METRIC_DOWNLOAD = metrics.histogram(
+    "agora_download_seconds", "!save のダウンロード時間 (待ち時間を含む)",
+    buckets=(1, 5, 10, 30, 60, 120, 300, 600, 1800),
+)
+METRIC_EVENT_LOOP_LAG = metrics.histogram(
+    "agora_event_loop_lag_seconds", "イベントループの遅れ",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0),
+)
+METRIC_SESSION_RECOVERY = metrics.histogram(
+    "agora_session_recovery_seconds", "ボイス接続の復旧にかかった時間 (reason: restart=再起動 / disconnect=切断 / gateway=再接続)",
+    buckets=(0.5, 1, 2, 5, 10, 30, 60, 120),
+)
+METRIC_STARTUP = metrics.gauge("agora_startup_seconds", "起動の段階ごとの所要時間 (phase: imports / config / setup / login / ready)")
+METRIC_EVENT_LOOP_STALLS = metrics.counter("agora_event_loop_stalls_total", "イベントループが停止した回数 (site: 停止時に実行していた箇所)")
+
+# ---------------------------------------------------------
+# イベントループの停止検知
+# ---------------------------------------------------------
+class LoopWatchdog:
+    # ループ上のタスクが一定間隔で時刻を更新し、監視スレッドがその更新が途絶えていないかを見る
+    # 閾値を超えて止まっていたら、その時点のループのスレッドのスタックを取得して止めている箇所を記録する
+    def __init__(self, threshold, heartbeat_interval=0.1, log_limit=3):
+        self.threshold = threshold
+        self.heartbeat_interval = heartbeat_interval
+        # 同じ箇所のスタックをログに出す回数 (以降は件数だけを数える)
+        self.log_limit = log_limit
+        self.last_beat = time.monotonic()
+        # 箇所ごとの [回数, 合計秒数, 最大秒数]
+        self.sites = {}
+        self.loop_thread_id = None
+        self._stop = threading.Event()
+        self._thread = None
+        self._heartbeat_task = None
+
+    def start(self):
+        self.loop_thread_id = threading.get_ident()
+        self.last_beat = time.monotonic()
+        self._heartbeat_task = asyncio.create_task(self._heartbeat())
+        if self.threshold > 0:
+            self._thread = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._heartbeat_task is not None:
+            self._heartbeat_task.cancel()
+
+    async def _heartbeat(self):
+        while True:
+            started = time.monotonic()
+            await asyncio.sleep(self.heartbeat_interval)
+            now = time.monotonic()
+            self.last_beat = now
+            METRIC_EVENT_LOOP_LAG.observe(max(0.0, now - started - self.heartbeat_interval))
+
+    def _watch(self):
+        check_interval = max(self.threshold / 4, 0.01)
+        stalled_since = None
+        site = None
+        while not self._stop.wait(check_interval):
+            last_beat = self.last_beat
+            stalled = time.monotonic() - last_beat - self.heartbeat_interval
+            if stalled_since is None:
+                if stalled >= self.threshold:
+                    stalled_since = last_beat
+                    site = self._capture(stalled)
+            elif last_beat != stalled_since:
+                # ループが再び動き出した
+                duration = last_beat - stalled_since - self.heartbeat_interval
+                self._record(site, duration)
+                stalled_since = None
+
+    def _capture(self, stalled):
+        frame = sys._current_frames().get(self.loop_thread_id)
+        if frame is None:
+            return "unknown"
+        stack = traceback.extract_stack(frame)
+        del frame
+        site = self._find_site(stack)
+        count = self.sites.get(site, [0])[0]
+        if count < self.log_limit:
+            logging.warning(
+                f"イベントループが{stalled * 1000:.0f}ms以上止まっています ({site}):\n"
+                + "".join(traceback.format_list(stack[-12:])).rstrip()
+            )
+        return site
+
+    @staticmethod
+    def _find_site(stack):
+        # 止めている処理を呼んだ main.py 内の行 (無ければ最も内側のフレーム) を箇所とする
+        for entry in reversed(stack):
+            if entry.filename == __file__:
+                return f"{entry.name}:{entry.lineno}"
+        entry = stack[-1]
+        return f"{Path(entry.filename).name}:{entry.lineno}"
+
+    def _record(self, site, duration):
+        stats = self.sites.setdefault(site, [0, 0.0, 0.0])
+        stats[0] += 1
+        stats[1] += duration
+        stats[2] = max(stats[2], duration)
+        METRIC_EVENT_LOOP_STALLS.inc(site=site)
+        if stats[0] <= self.log_limit:
+            logging.warning(f"イベントループが{duration:.2f}秒止まっていました ({site})")
+
+    def top_sites(self, limit=10):
+        return sorted(self.sites.items(), key=lambda item: item[1][1], reverse=True)[:limit]
+
+loop_watchdog = LoopWatchdog(STALL_THRESHOLD_MS / 1000)
+
+async def start_metrics_server():
+    async def handle_metrics(request):
+        return aiohttp.web.Response(text=metrics.render(), content_type="text/plain", charset="utf-8")
+
+    app = aiohttp.web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    runner = aiohttp.web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await aiohttp.web.TCPSite(runner, METRICS_HOST, METRICS_PORT).start()
+    logging.info(f"メトリクスを公開しました: http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+    return runner
+
+# ---------------------------------------------------------
+# VOICEVOXクライアント (非同期・コネクションプール)
+# ---------------------------------------------------------
+class VoicevoxClient:
+    # 1台のエンジンへのクライアント (負荷分散用の状態も持つ)
+    def __init__(self, base_url, timeout=30, max_concurrency=2, weight=1):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.max_concurrency = max_concurrency
+        self.weight = weight
+        # 合成はエンジンのCPUを占有するため同時実行数を制限する
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self._session = None
+        # 合成待ちを含めた処理中のリクエスト数
+        self.in_flight = 0
+        self.requests = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.healthy = True
+        self.open_until = 0.0
+        # 最後に失敗した時刻 (全エンジンが使えない時に、最も前に失敗したエンジンから試すため)
+        self.last_failure = 0.0
+        self.version = None
+        # 辞書の書き込みに失敗したため、次のヘルスチェックで同期が必要
+        self.needs_dict_sync = False
+
+    def _get_session(self):
+        # セッションはイベントループ上で遅延生成し、keep-aliveで使い回す
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.max_concurrency * 2, keepalive_timeout=60)
+            self._session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+        return self._session
+
+    def is_available(self, now):
+        return self.healthy and now >= self.open_until
+
+    def record_success(self):
+        self.consecutive_failures = 0
+
+    def record_failure(self, threshold, cooldown):
+        self.failures += 1
+        self.consecutive_failures += 1
+        self.last_failure = time.monotonic()
+        # 連続で失敗したら一定時間切り離す (切り離し明けの1回目も失敗すればすぐに再度切り離す)
+        if self.consecutive_failures >= threshold:
+            if self.open_until <= time.monotonic():
+                logging.warning(f"VOICEVOX {self.base_url} を{cooldown}秒間切り離します (連続失敗 {self.consecutive_failures}回)")
+            self.open_until = time.monotonic() + cooldown
+
+    async def synthesize(self, text, speaker):
+        session = self._get_session()
+        self.in_flight += 1
+        self.requests += 1
+        started = time.perf_counter()
+        try:
+            async with self.semaphore:
+                query_started = time.perf_counter()
+                METRIC_VOICEVOX_SECONDS.observe(query_started - started, engine=self.base_url, stage="wait")
+                async with session.post(f"{self.base_url}/audio_query", params={"text": text, "speaker": str(speaker)}) as res:
+                    res.raise_for_status()
+                    audio_query = await res.json()
+
+                synthesis_started = time.perf_counter()
+                METRIC_VOICEVOX_SECONDS.observe(synthesis_started - query_started, engine=self.base_url, stage="audio_query")
+                async with session.post(
+                    f"{self.base_url}/synthesis",
+                    params={"speaker": str(speaker), "enable_interrogative_upspeak": "true"},
+                    json=audio_query,
+                ) as res:
+                    res.raise_for_status()
+                    wav_data = await res.read()
+                METRIC_VOICEVOX_SECONDS.observe(time.perf_counter() - synthesis_started, engine=self.base_url, stage="synthesis")
+                return wav_data
+        finally:
+            self.in_flight -= 1
+
+    async def get_version(self, timeout=5):
+        session = self._get_session()
+        async with session.get(f"{self.base_url}/version", timeout=aiohttp.ClientTimeout(total=timeout)) as res:
+            res.raise_for_status()
+            return await res.json()
+
+    async def add_user_dict_word(self, surface, pronunciation, accent_type=0):
+        session = self._get_session()
+        params = {"surface": surface, "pronunciation": pronunciation, "accent_type": str(accent_type)}
+        async with session.post(f"{self.base_url}/user_dict_word", params=params) as res:
+            res.raise_for_status()
+            return await res.json()
+
+    async def delete_user_dict_word(self, word_uuid):
+        session = self._get_session()
+        async with session.delete(f"{self.base_url}/user_dict_word/{word_uuid}") as res:
+            res.raise_for_status()
+
+    async def get_user_dict(self):
+        # 戻り値: {uuid: 単語情報}
+        session = self._get_session()
+        async with session.get(f"{self.base_url}/user_dict") as res:
+            res.raise_for_status()
+            return await res.json()
+
+    async def import_user_dict(self, words, override=True):
+        # words: {uuid: build_user_dict_word(...)} をまとめて登録する
+        session = self._get_session()
+        params = {"override": "true" if override else "false"}
+        async with session.post(f"{self.base_url}/import_user_dict", params=params, json=words) as res:
+            res.raise_for_status()
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+
+class VoicevoxPool:
+    # 複数エンジンへの振り分け
+    # 合成は (処理中の数 / 重み) が最も小さい正常なエンジンへ送り、失敗したら別のエンジンで再試行する
+    # 辞書の書き込みは全てのエンジンへ送る
+    def __init__(self, engines, timeout=30, max_concurrency=2, failure_threshold=3, cooldown=30, health_interval=10):
+        self.nodes = [
+            VoicevoxClient(url, timeout=timeout, max_concurrency=max_concurrency, weight=weight)
+            for url, weight in engines
+        ]
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.health_interval = health_interval
+        # エンジンが復帰した時 (または辞書の同期が必要な時) に呼ばれるコールバック
+        self.on_recovered = None
+        self._health_task = None
+
+    def _candidates(self, exclude=()):
+        now = time.monotonic()
+        nodes = [node for node in self.nodes if node not in exclude and node.is_available(now)]
+        if not nodes and not exclude:
+            # 全てのエンジンが切り離し中・停止中でも合成を断らず、最も前に失敗したエンジンを1台だけ試す (half-open)
+            # 切り離しやヘルスチェックの間隔のせいで、エンジンが復帰した後も読み上げが止まり続けないようにする
+            return [min(self.nodes, key=lambda node: node.last_failure)]
+        # 同じ負荷なら設定の順番を優先する (sortedは安定ソート)
+        return sorted(nodes, key=lambda node: node.in_flight / node.weight)
+
+    async def synthesize(self, text, speaker):
+        tried = []
+        last_error = None
+        while True:
+            candidates = self._candidates(tried)
+            if not candidates:
+                break
+            node = candidates[0]
+            tried.append(node)
+            try:
+                wav_data = await node.synthesize(text, speaker)
+            except aiohttp.ClientResponseError as e:
+                if e.status < 500:
+                    # 入力の誤りはどのエンジンでも同じ結果になるため再試行しない
+                    node.record_success()
+                    raise
+                last_error = e
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                last_error = e
+            else:
+                node.record_success()
+                if not node.healthy:
+                    # 停止中と判定していたエンジンで合成できた (次のヘルスチェックを待たずに戻す)
+                    self._mark_recovered(node, node.version)
+                return wav_data
+            node.record_failure(self.failure_threshold, self.cooldown)
+            METRIC_VOICEVOX_ERRORS.inc(engine=node.base_url)
+            logging.warning(f"VOICEVOX {node.base_url} での合成に失敗しました: {type(last_error).__name__}: {last_error}")
+
+        raise last_error
+
+    async def _broadcast(self, action, description):
+        # 停止中のエンジンは復帰時の辞書同期で追いつくため、1台でも成功すれば成功とする
+        now = time.monotonic()
+        targets = [node for node in self.nodes if node.is_available(now)] or self.nodes
+        for node in self.nodes:
+            if node not in targets:
+                node.needs_dict_sync = True
+
+        results = await asyncio.gather(*(action(node) for node in targets), return_exceptions=True)
+        errors = [(node, result) for node, result in zip(targets, results) if isinstance(result, Exception)]
+        for node, error in errors:
+            node.needs_dict_sync = True
+            logging.warning(f"VOICEVOX {node.base_url} への{description}に失敗しました: {type(error).__name__}: {error}")
+        if len(errors) == len(targets):
+            raise errors[0][1]
+
+    async def add_user_dict_word(self, surface, pronunciation, accent_type=0, word_uuid=None):
+        # エンジンごとに別のUUIDが振られないよう、UUIDは手元で決めてから全エンジンへ登録する
+        # 登録済みの単語は同じUUIDで上書きする (別のUUIDで登録すると古い方を消せなくなる)
+        word_uuid = word_uuid or str(uuid.uuid4())
+        await self.import_user_dict({word_uuid: build_user_dict_word(surface, pronunciation, accent_type)})
+        return word_uuid
+
+    async def delete_user_dict_word(self, word_uuid):
+        async def delete(node):
+            try:
+                await node.delete_user_dict_word(word_uuid)
+            except aiohttp.ClientResponseError as e:
+                # そのエンジンには既に無い
+                if e.status not in (404, 422):
+                    raise
+        await self._broadcast(delete, "辞書の削除")
+
+    async def import_user_dict(self, words, override=True):
+        await self._broadcast(lambda node: node.import_user_dict(words, override), "辞書の登録")
+
+    async def check_health(self):
+        await asyncio.gather(*(self._probe(node) for node in self.nodes))
+
+    async def _probe(self, node):
+        try:
+            version = await node.get_version()
+        except Exception as e:
+            if node.healthy:
+                logging.warning(f"VOICEVOX {node.base_url} が応答しません: {type(e).__name__}: {e}")
+            node.healthy = False
+            node.last_failure = time.monotonic()
+            return
+
+        # (合成の失敗による切り離しは /version が応答しても解除せず、切り離し時間の経過を待つ)
+        if not node.healthy:
+            self._mark_recovered(node, version)
+        else:
+            node.version = version
+            if node.needs_dict_sync and self.on_recovered:
+                self.on_recovered(node)
+
+    def _mark_recovered(self, node, version):
+        # 停止からの復帰はエンジンの再起動の可能性があるため、辞書を同期し直す
+        logging.info(f"VOICEVOX {node.base_url} が復帰しました (version {version})")
+        node.healthy = True
+        node.version = version
+        if self.on_recovered:
+            self.on_recovered(node)
+
+    def start_health_checks(self):
+        if self._health_task is None:
+            self._health_task = asyncio.create_task(self._health_loop())
+
+    async def _health_loop(self):
+        while True:
+            await asyncio.sleep(self.health_interval)
+            try:
+                await self.check_health()
+            except Exception as e:
+                logging.error(f"VOICEVOX health check error: {e}")
+
+    async def close(self):
+        if self._health_task is not None:
+            self._health_task.cancel()
+        for node in self.nodes:
+            await node.close()
+
+def parse_voicevox_engines(value):
+    # "http://..." / ["http://...", {url: "http://...", weight: 2}] のどちらの書き方も受け付ける
+    entries = value if isinstance(value, list) else [value]
+    engines = []
+    for entry in entries:
+        if isinstance(entry, dict):
+            engines.append((entry["url"], entry.get("weight", 1)))
+        else:
+            engines.append((entry, 1))
+    return engines
+
+def build_user_dict_word(surface, pronunciation, accent_type=0, priority=5):
+    # VOICEVOXのUserDictWord形式 (固有名詞として登録する。/user_dict_word と同じ既定値)
+    return {
+        "surface": surface,
+        "priority": priority,
+        "context_id": 1348,
+        "part_of_speech": "名詞",
+        "part_of_speech_detail_1": "固有名詞",
+        "part_of_speech_detail_2": "一般",
+        "part_of_speech_detail_3": "*",
+        "inflectional_type": "*",
+        "inflectional_form": "*",
+        "stem": "*",
+        "yomi": pronunciation,
+        "pronunciation": pronunciation,
+        "accent_type": accent_type,
+        "accent_associative_rule": "*",
+    }
+
+voicevox = VoicevoxPool(
+    parse_voicevox_engines(VOICEVOX_URL),
+    timeout=VOICEVOX_TIMEOUT,
+    max_concurrency=VOICEVOX_MAX_CONCURRENCY,
+    failure_threshold=VOICEVOX_FAILURE_THRESHOLD,
+    cooldown=VOICEVOX_COOLDOWN,
+    health_interval=VOICEVOX_HEALTH_INTERVAL,
+)
+
+# ---------------------------------------------------------
+# PCM変換 (合成音声をメモリ上で再生用フォーマットへ変換)
+# ---------------------------------------------------------
+# Discordへ送る形式: 48kHz / 16bit / ステレオ、20msで1フレーム
+PCM_SAMPLE_RATE = 48000
+PCM_CHANNELS = 2
+FRAME_SIZE = 3840
+
+def wav_to_pcm(wav_data):
+    with wave.open(BytesIO(wav_data), "rb") as wf:
+        channels = wf.getnchannels()
+        sample_width = wf.getsampwidth()
+        sample_rate = wf.getframerate()
+        frames = wf.readframes(wf.getnframes())
+
+    if sample_width != 2:
+        raise ValueError(f"未対応のサンプル幅です: {sample_width * 8}bit")
+
+    samples = np.frombuffer(frames, dtype="<i2").reshape(-1, channels)
+
+    # VOICEVOXの出力(通常24kHz/モノラル)を48kHzへ線形補間でリサンプリング
+    if sample_rate != PCM_SAMPLE_RATE and len(samples) > 0:
+        out_len = int(len(samples) * PCM_SAMPLE_RATE / sample_rate)
+        positions = np.arange(out_len) * (sample_rate / PCM_SAMPLE_RATE)
+        source_index = np.arange(len(samples))
+        samples = np.stack(
+            [np.interp(positions, source_index, samples[:, ch]) for ch in range(channels)],
+            axis=1,
+        )
+
+    if channels == 1:
+        samples = np.repeat(samples, PCM_CHANNELS, axis=1)
+    elif channels > PCM_CHANNELS:
+        samples = samples[:, :PCM_CHANNELS]
+
+    pcm = np.ascontiguousarray(samples, dtype="<i2").tobytes()
+
+    # 末尾をフレーム境界まで無音で埋めておく (再生時のパディングを不要にする)
+    remainder = len(pcm) % FRAME_SIZE
+    if remainder:
+        pcm += b'\x00' * (FRAME_SIZE - remainder)
+    return pcm
+
+class PCMAudioSource(discord.AudioSource):
+    # メモリ上のPCMバッファを20msずつ返すだけのソース (ffmpeg不要)
+    def __init__(self, pcm):
+        self._buffer = memoryview(pcm)
+        self._position = 0
+
+    def read(self):
+        chunk = self._buffer[self._position:self._position + FRAME_SIZE]
+        self._position += FRAME_SIZE
+        return bytes(chunk)
+
+    def is_opus(self):
+        return False
+
+    def cleanup(self):
+        self._buffer = memoryview(b'')
+
+SILENCE_FRAME = b'\x00' * FRAME_SIZE
+
+class StreamingPCMSource(discord.AudioSource):
+    # 文ごとに合成したPCMを発言順に継ぎ目なく返すソース
+    # 次の文の合成が間に合わない間は無音を返し (underruns に記録)、finish() 後に全て読み終えたら終了する
+    def __init__(self):
+        self._chunks = deque()
+        self._buffer = memoryview(b'')
+        self._position = 0
+        self._finished = False
+        self._lock = threading.Lock()
+        self.underruns = 0
+        self.on_cleanup = None
+
+    def feed(self, pcm):
+        with self._lock:
+            self._chunks.append(pcm)
+
+    def finish(self):
+        with self._lock:
+            self._finished = True
+
+    def read(self):
+        with self._lock:
+            if self._position >= len(self._buffer):
+                if self._chunks:
+                    self._buffer = memoryview(self._chunks.popleft())
+                    self._position = 0
+                elif self._finished:
+                    return b''
+                else:
+                    self.underruns += 1
+                    return SILENCE_FRAME
+            chunk = self._buffer[self._position:self._position + FRAME_SIZE]
+            self._position += FRAME_SIZE
+            return bytes(chunk)
+
+    def is_opus(self):
+        return False
+
+    def cleanup(self):
+        with self._lock:
+            self._chunks.clear()
+            self._buffer = memoryview(b'')
+            self._finished = True
+        on_cleanup, self.on_cleanup = self.on_cleanup, None
+        if on_cleanup:
+            on_cleanup()
+
+# ---------------------------------------------------------
+# 合成音声キャッシュ (LRU)
+# ---------------------------------------------------------
+class TTSCache:
+    # キー: (正規化テキスト, スタイルID, 辞書の世代番号)
+    # メモリ上にはPCM、ディスク上にはVOICEVOXが返したWAV(サイズが小さい)を保存する
+    def __init__(self, max_bytes, disk_dir=None, disk_max_bytes=0):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        # 事前合成した定型文 (LRUの追い出し対象外)
+        self.pinned = {}
+        self.pinned_bytes = 0
+        self.dict_generation = 0
+        self.disk_dir = Path(disk_dir) if disk_dir else None
+        self.disk_max_bytes = disk_max_bytes
+        self.disk_lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # キャッシュヒットにより節約できた合成時間 (秒)
+        self.saved_seconds = 0.0
+        if self.disk_dir:
+            self.disk_dir.mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def normalize(text):
+        return " ".join(unicodedata.normalize("NFKC", text).split())
+
+    def make_key(self, text, style_id):
+        return (self.normalize(text), int(style_id), self.dict_generation)
+
+    def get(self, key):
+        entry = self.pinned.get(key)
+        if entry is None:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            self.entries.move_to_end(key)
+        self.hits += 1
+        self.saved_seconds += entry[1]
+        return entry[0]
+
+    def put(self, key, pcm, synth_seconds):
+        # 合成中に辞書が更新された場合、古い読みの音声は保存しない
+        if key[2] != self.dict_generation or len(pcm) > self.max_bytes:
+            return
+        if key in self.entries:
+            self.total_bytes -= len(self.entries.pop(key)[0])
+        self.entries[key] = (pcm, synth_seconds)
+        self.total_bytes += len(pcm)
+        while self.total_bytes > self.max_bytes:
+            _, (old_pcm, _) = self.entries.popitem(last=False)
+            self.total_bytes -= len(old_pcm)
+            self.evictions += 1
+
+    def pin(self, key, pcm, synth_seconds):
+        if key[2] != self.dict_generation:
+            return
+        if key in self.pinned:
+            self.pinned_bytes -= len(self.pinned[key][0])
+        self.pinned[key] = (pcm, synth_seconds)
+        self.pinned_bytes += len(pcm)
+
+    def invalidate(self):
+        # 辞書の登録・削除時に呼ぶ。世代番号を進めて既存の音声をすべて無効化する
+        self.dict_generation += 1
+        self.entries.clear()
+        self.total_bytes = 0
+        self.pinned.clear()
+        self.pinned_bytes = 0
+
+    def _disk_path(self, key):
+        digest = hashlib.sha256(f"{key[1]}\0{key[0]}".encode("utf-8")).hexdigest()
+        return self.disk_dir / f"{digest}.wav"
+
+    # 以下のディスク操作はブロッキングするため、スレッド経由で呼び出すこと
+    def clear_disk(self):
+        if not self.disk_dir:
+            return
+        with self.disk_lock:
+            for path in self.disk_dir.glob("*.wav"):
+                path.unlink(missing_ok=True)
+
+    def load_disk(self, key):
+        if not self.disk_dir:
+            return None
+        with self.disk_lock:
+            if key[2] != self.dict_generation:
+                return None
+            path = self._disk_path(key)
+            try:
+                wav_data = path.read_bytes()
+                os.utime(path)
+            except FileNotFoundError:
+                return None
+        self.disk_hits += 1
+        return wav_data
+
+    def store_disk(self, key, wav_data):
+        if not self.disk_dir:
+            return
+        with self.disk_lock:
+            if key[2] != self.dict_generation:
+                return
+            self._disk_path(key).write_bytes(wav_data)
+            files = [(p, p.stat()) for p in self.disk_dir.glob("*.wav")]
+            disk_bytes = sum(st.st_size for _, st in files)
+            if disk_bytes <= self.disk_max_bytes:
+                return
+            # 更新日時の古い順に、上限の9割まで削除する
+            for path, st in sorted(files, key=lambda item: item[1].st_mtime):
+                if disk_bytes <= self.disk_max_bytes * 0.9:
+                    break
+                path.unlink(missing_ok=True)
+                disk_bytes -= st.st_size
+                self.evictions += 1
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        hit_rate = (self.hits / lookups * 100) if lookups else 0.0
+        return {
+            "entries": len(self.entries),
+            "bytes": self.total_bytes,
+            "pinned": len(self.pinned),
+            "pinned_bytes": self.pinned_bytes,
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": hit_rate,
+            "saved_seconds": self.saved_seconds,
+        }
+
+tts_cache = TTSCache(
+    TTS_CACHE_MAX_MB * 1024 * 1024,
+    disk_dir=(BASE_PATH / TTS_CACHE_DIR) if TTS_CACHE_DIR else None,
+    disk_max_bytes=TTS_CACHE_DISK_MAX_MB * 1024 * 1024,
+)
+
 # ---------------------------------------------------------
 # ミキシング用クラス (音声合成)
 # ---------------------------------------------------------
+# 1フレームあたりのint16サンプル数 (左右チャンネルの合計)
+SAMPLES_PER_FRAME = FRAME_SIZE // 2
+# ゲインは固定小数点 (Q15) で扱う。int16 × ゲインがint32に収まるよう上限は2倍
+GAIN_SHIFT = 15
+MAX_GAIN = 2.0
+FRAME_MS = 20
+
+# ミキサーに入るソースの種類。読み上げ(speech)が鳴っている間は音楽(music)を下げる
+SPEECH = "speech"
+MUSIC = "music"
+
+# フレーム内でゲインを線形に変化させるための係数 (0→1、左右チャンネル分を交互に並べる)
+_ramp_steps = SAMPLES_PER_FRAME // PCM_CHANNELS
+GAIN_RAMP = np.repeat(np.arange(1, _ramp_steps + 1, dtype=np.float32) / _ramp_steps, PCM_CHANNELS)
+
+def pad_frame(chunk):
+    # 最後のフレームの端数は無音で埋める (サンプルの途中で切れたバイトは捨てる)
+    if len(chunk) == FRAME_SIZE:
+        return chunk
+    return chunk[:min(len(chunk), FRAME_SIZE) // 2 * 2].ljust(FRAME_SIZE, b'\x00')
+
+class MixerInput:
+    def __init__(self, source, gain=1.0, kind=SPEECH):
+        self.source = source
+        self.kind = kind
+        # Opusのパケットを返すソース (ミキサーで合成する時だけデコードする)
+        self.opus = source.is_opus()
+        self._decoder = None
+        # Trueにすると次のフレームから再生を止め、再生スレッド側で後始末する (!skip)
+        self.stopped = False
+        self.set_gain(gain)
+
+    def decode(self, packet):
+        if self._decoder is None:
+            self._decoder = discord.opus.Decoder()
+        return self._decoder.decode(packet)
+
+    def set_gain(self, gain):
+        self.gain = min(max(gain, 0.0), MAX_GAIN)
+        gain_q15 = round(self.gain * (1 << GAIN_SHIFT))
+        # フレームごとに numpy のスカラーと比べると遅いため、等倍かどうかは bool で持っておく
+        self.unity = gain_q15 == 1 << GAIN_SHIFT
+        self.gain_q15 = np.int32(gain_q15)
+
 class MixingAudioSource(discord.AudioSource):
-    def __init__(self, main_source=None):
+    # 各ソースをint32のバッファに加算し、最後に一度だけint16へ飽和変換する
+    # read()は20msごとに再生スレッドから呼ばれるため、バッファは使い回して確保を減らす
+    # 音楽は別バッファに集め、読み上げの有無に応じたダッキングをフレーム単位でまとめて掛ける
+    # Opusのソースが等倍で1つだけ鳴っている間は、デコード・再エンコードせずにパケットをそのまま返す
+    # PCMのソースが等倍で1つだけの時も numpy を通さずにチャンクをそのまま返す
+    # (numpy の呼び出しは1回ごとに数µsかかるため、ソースが少ない時の呼び出し回数を減らしている)
+    def __init__(self, main_source=None, master_gain=1.0, duck_level=DUCK_LEVEL,
+                 attack_ms=DUCK_ATTACK_MS, release_ms=DUCK_RELEASE_MS):
         self.sources = []
         self.lock = threading.Lock()
+        self.closed = False
+        self.master_gain = master_gain
+        self.duck_level = duck_level
+        self.duck_gain = 1.0
+        # 1フレームごとに目標ゲインへ近づける割合 (時定数から算出)
+        self._attack_coef = float(np.exp(-FRAME_MS / max(attack_ms, 1)))
+        self._release_coef = float(np.exp(-FRAME_MS / max(release_ms, 1)))
+        self._accumulator = np.zeros(SAMPLES_PER_FRAME, dtype=np.int32)
+        self._music_accumulator = np.zeros(SAMPLES_PER_FRAME, dtype=np.int32)
+        self._gains = np.zeros(SAMPLES_PER_FRAME, dtype=np.float32)
+        self._float_buffer = np.zeros(SAMPLES_PER_FRAME, dtype=np.float32)
+        self._output = np.zeros(SAMPLES_PER_FRAME, dtype=np.int16)
+        self._silence = bytes(FRAME_SIZE)
+        # 直前のread()がOpusのパケットを返したか (再生スレッドはread()の直後にis_opus()で確認する)
+        self._opus = False
         if main_source:
-            self.add_source(main_source)
+            self.add_source(main_source, kind=MUSIC)
 
-    def add_source(self, source):
+    def add_source(self, source, gain=1.0, kind=SPEECH):
+        # 再生を終えたミキサーには追加できない (呼び出し側で新しいミキサーを作る)
+        mixer_input = MixerInput(source, gain, kind)
         with self.lock:
-            self.sources.append(source)
+            if self.closed:
+                return None
+            self.sources.append(mixer_input)
+        return mixer_input
 
-    def read(self):
-        FRAME_SIZE = 3840
-        mixed = None
-        
+    def set_kind_gain(self, kind, gain):
         with self.lock:
-            active_sources = self.sources[:]
-            if not active_sources:
-                return b'\x00' * FRAME_SIZE
+            for mixer_input in self.sources:
+                if mixer_input.kind == kind:
+                    mixer_input.set_gain(gain)
+
+    def _update_duck_gain(self, speech_active):
+        previous = self.duck_gain
+        target = self.duck_level if speech_active else 1.0
+        coef = self._attack_coef if target < previous else self._release_coef
+        current = target + (previous - target) * coef
+        if abs(current - target) < 1e-3:
+            current = target
+        self.duck_gain = current
+        return previous, current
 
-            for source in active_sources:
-                chunk = source.read()
+    def read(self):
+        started = time.perf_counter()
+        data = self._mix()
+        elapsed = time.perf_counter() - started
+        METRIC_MIXER_READ.observe(elapsed)
+        if elapsed > FRAME_MS / 1000:
+            METRIC_MIXER_OVERRUNS.inc()
+        return data
+
+    def _mix(self):
+        with self.lock:
+            active_inputs = self.sources[:]
+            if not active_inputs:
+                # 鳴らすものが無くなったら再生を終える
+                self.closed = True
+                self._opus = False
+                return b''
+
+        self._opus = False
+        if len(active_inputs) == 1 and active_inputs[0].unity and self.master_gain == 1.0:
+            mixer_input = active_inputs[0]
+            speech = mixer_input.kind != MUSIC
+            # ダッキング中の音楽にはゲインを掛ける必要がある (読み上げのPCMはダッキングの影響を受けない)
+            if self.duck_gain == 1.0 or (speech and not mixer_input.opus):
+                chunk = b'' if mixer_input.stopped else mixer_input.source.read()
                 if not chunk:
-                    self.sources.remove(source)
-                    if hasattr(source, 'cleanup'):
-                        source.cleanup()
-                    continue
-                
-                if len(chunk) < FRAME_SIZE:
-                    chunk += b'\x00' * (FRAME_SIZE - len(chunk))
-                
-                try:
-                    if mixed is None:
-                        mixed = chunk
-                    else:
-                        mixed = audioop.add(mixed, chunk, 2)
-                except Exception:
-                    pass
-                    
-        return mixed if mixed is not None else b'\x00' * FRAME_SIZE
+                    self._remove_finished([mixer_input])
+                    self._update_duck_gain(False)
+                    return self._silence
+                if mixer_input.opus:
+                    self._opus = True
+                    return chunk
+                self._update_duck_gain(speech)
+                return pad_frame(chunk)
+
+        accumulator = self._accumulator
+        music_accumulator = self._music_accumulator
+        finished = []
+        # 種類ごとの (チャンク, ソース)
+        speech = ([], [])
+        music = ([], [])
+
+        for mixer_input in active_inputs:
+            chunk = b'' if mixer_input.stopped else mixer_input.source.read()
+            if not chunk:
+                finished.append(mixer_input)
+                continue
+            if mixer_input.opus:
+                chunk = mixer_input.decode(chunk)
+            chunks, mixer_inputs = music if mixer_input.kind == MUSIC else speech
+            chunks.append(pad_frame(chunk))
+            mixer_inputs.append(mixer_input)
+
+        if finished:
+            self._remove_finished(finished)
+
+        speech_count = len(speech[0])
+        music_count = len(music[0])
+        if speech_count:
+            self._sum_chunks(accumulator, *speech)
+        if music_count:
+            self._sum_chunks(music_accumulator, *music)
+
+        previous, current = self._update_duck_gain(speech_count > 0)
+        if not speech_count and not music_count:
+            return self._silence
+
+        if music_count:
+            if previous == current == 1.0:
+                if speech_count:
+                    np.add(accumulator, music_accumulator, out=accumulator)
+                else:
+                    accumulator = music_accumulator
+            else:
+                # 前フレームのゲインから今回のゲインへ線形に変化させ、段差によるノイズを防ぐ
+                np.multiply(GAIN_RAMP, current - previous, out=self._gains)
+                self._gains += previous
+                np.multiply(music_accumulator, self._gains, out=self._float_buffer, casting="same_kind")
+                if speech_count:
+                    np.add(accumulator, self._float_buffer, out=accumulator, casting="unsafe")
+                else:
+                    np.copyto(accumulator, self._float_buffer, casting="unsafe")
+
+        if self.master_gain != 1.0:
+            np.multiply(accumulator, self.master_gain, out=self._float_buffer, casting="same_kind")
+            np.clip(self._float_buffer, -32768, 32767, out=self._float_buffer)
+            np.copyto(self._output, self._float_buffer, casting="unsafe")
+        else:
+            # 飽和するのは大きな音が重なったフレームだけなので、範囲を確かめてから必要な時だけクリップする
+            if accumulator.max() > 32767 or accumulator.min() < -32768:
+                np.clip(accumulator, -32768, 32767, out=accumulator)
+            np.copyto(self._output, accumulator, casting="unsafe")
+        return self._output.tobytes()
+
+    def _sum_chunks(self, destination, chunks, mixer_inputs):
+        # 同じ種類のチャンクを1つの配列に並べ、ゲインの適用と加算をまとめて行う
+        # (ソースごとに numpy を呼ぶと、呼び出しの固定費がソース数に比例して増える)
+        samples = np.frombuffer(b"".join(chunks), dtype="<i2").reshape(len(chunks), SAMPLES_PER_FRAME)
+        if not all(mixer_input.unity for mixer_input in mixer_inputs):
+            gains = np.array([[mixer_input.gain_q15] for mixer_input in mixer_inputs], dtype=np.int32)
+            samples = np.multiply(samples, gains)
+            np.right_shift(samples, GAIN_SHIFT, out=samples)
+        if len(chunks) == 1:
+            np.copyto(destination, samples[0])
+        else:
+            np.add.reduce(samples, axis=0, dtype=np.int32, out=destination)
+
+    def _remove_finished(self, finished):
+        with self.lock:
+            for mixer_input in finished:
+                if mixer_input in self.sources:
+                    self.sources.remove(mixer_input)
+        for mixer_input in finished:
+            mixer_input.source.cleanup()
+
+    def is_opus(self):
+        return self._opus
+
+    def cleanup(self):
+        with self.lock:
+            self.closed = True
+            sources, self.sources = self.sources, []
+        for mixer_input in sources:
+            mixer_input.source.cleanup()
+
+def play_mixed(voice_client, new_source, kind=SPEECH):
+    # 再生は常にミキサー経由で行い、種類ごとの音量とダッキングを適用する
+    session = sessions.get(voice_client.guild.id)
+    volumes = session.volumes if session else DEFAULT_VOLUMES
+    gain = volumes[kind]
+
+    current_source = voice_client.source if (voice_client.is_playing() or voice_client.is_paused()) else None
+    if isinstance(current_source, MixingAudioSource):
+        mixer_input = current_source.add_source(new_source, gain, kind)
+        if mixer_input:
+            return mixer_input
+        # ちょうど再生を終えようとしているミキサーなので止めて作り直す
+        voice_client.stop()
+    elif current_source is not None:
+        # ミキサー以外のソースを再生中なら、それを音楽として取り込む (Opusのソースもミキサー側で扱える)
+        voice_client.pause()
+        mixer = MixingAudioSource(master_gain=volumes["master"])
+        mixer.add_source(current_source, volumes[MUSIC], MUSIC)
+        mixer_input = mixer.add_source(new_source, gain, kind)
+        voice_client.source = mixer
+        voice_client.resume()
+        return mixer_input
+
+    mixer = MixingAudioSource(master_gain=volumes["master"])
+    mixer_input = mixer.add_source(new_source, gain, kind)
+    voice_client.play(mixer)
+    return mixer_input
+
+class NotifyingSource(discord.AudioSource):
+    # 再生終了時(または破棄時)に一度だけコールバックを呼ぶラッパー
+    # exhausted は最後まで読み切ったか (途中で破棄された場合はFalse)
+    def __init__(self, source, after):
+        self.source = source
+        self._after = after
+        self.exhausted = False
+
+    def read(self):
+        data = self.source.read()
+        if not data:
+            self.exhausted = True
+            self._finish()
+        return data
+
+    def is_opus(self):
+        return self.source.is_opus()
+
+    def cleanup(self):
+        self.source.cleanup()
+        self._finish()
+
+    def _finish(self):
+        after, self._after = self._after, None
+        if after:
+            after()
+
+class TimedSource(discord.AudioSource):
+    # 最初のフレームを読んだ時にコールバックを呼ぶラッパー (再生開始までの時間の計測用)
+    # 読んだフレーム数も数える (1フレーム20msなので再生位置がわかる)
+    def __init__(self, source, on_first_frame):
+        self.source = source
+        self._on_first_frame = on_first_frame
+        self.frames = 0
+
+    def read(self):
+        data = self.source.read()
+        if data:
+            self.frames += 1
+            if self._on_first_frame:
+                on_first_frame, self._on_first_frame = self._on_first_frame, None
+                on_first_frame()
+        return data
+
+    def is_opus(self):
+        return self.source.is_opus()
 
     def cleanup(self):
-        for source in self.sources:
-            if hasattr(source, 'cleanup'):
-                source.cleanup()
-
-def play_mixed(voice_client, new_source):
-    if voice_client.is_playing():
-        if isinstance(voice_client.source, MixingAudioSource):
-            voice_client.source.add_source(new_source)
+        self.source.cleanup()
+
+# ---------------------------------------------------------
+# 読み上げキュー (ギルドごとに発言順で再生)
+# ---------------------------------------------------------
+class Utterance:
+    def __init__(self, text, style_id):
+        self.text = text
+        self.style_id = style_id
+        self.enqueued_at = time.perf_counter()
+        self.received_at = message_received_var.get() or self.enqueued_at
+        self.trace_id = trace_id_var.get()
+        self.ready_at = None
+        self.first_audio = None
+        self.task = None
+
+class TTSQueue:
+    # 先頭から lookahead 件を先行して合成し、再生は1件ずつ発言順に行う
+    def __init__(self, session, max_size=10, lookahead=3, policy="drop_oldest"):
+        self.session = session
+        self.max_size = max_size
+        self.lookahead = lookahead
+        self.policy = policy
+        self.pending = deque()
+        self.wakeup = asyncio.Event()
+        self.played = 0
+        self.dropped = 0
+        self.merged = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        # 発言から最初の音声フレームが読まれるまでの時間
+        self.total_first_audio = 0.0
+        self.max_first_audio = 0.0
+        self.player_task = asyncio.create_task(self._run())
+
+    def put(self, text, style_id):
+        if len(self.pending) >= self.max_size:
+            if self.policy == "drop_newest":
+                self.dropped += 1
+                return
+            last = self.pending[-1]
+            if self.policy == "merge" and last.task is None and last.style_id == style_id:
+                last.text = f"{last.text}、{text}"
+                self.merged += 1
+                return
+            # drop_oldest (mergeできない場合も含む)
+            self._discard(self.pending.popleft())
+            self.dropped += 1
+
+        self.pending.append(Utterance(text, style_id))
+        self._fill_lookahead()
+        self.wakeup.set()
+
+    def _fill_lookahead(self):
+        for utterance in itertools.islice(self.pending, self.lookahead):
+            if utterance.task is None:
+                utterance.task = self._create_task(utterance)
+
+    def _create_task(self, utterance):
+        task = asyncio.create_task(self._synthesize(utterance))
+        task.add_done_callback(lambda _: setattr(utterance, "ready_at", time.perf_counter()))
+        return task
+
+    async def _synthesize(self, utterance):
+        # タスクはコンテキストのコピーで動くため、ここで設定したトレースIDは合成中のログだけに付く
+        trace_id_var.set(utterance.trace_id)
+        return await create_tts_source(utterance.text, utterance.style_id, self.session.april_fool)
+
+    def _discard(self, utterance):
+        if utterance.task is None:
+            return
+        if utterance.task.done():
+            # 合成済みの音声は再生せずに破棄する
+            if not utterance.task.cancelled() and utterance.task.exception() is None:
+                utterance.task.result().cleanup()
         else:
-            current_source = voice_client.source
-            voice_client.pause()
-            mixer = MixingAudioSource(current_source)
-            mixer.add_source(new_source)
-            voice_client.source = mixer
-            voice_client.resume()
+            utterance.task.cancel()
+
+    async def _run(self):
+        while True:
+            while not self.pending:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+
+            utterance = self.pending.popleft()
+            if utterance.task is None:
+                utterance.task = self._create_task(utterance)
+            self._fill_lookahead()
+
+            try:
+                await self._play(utterance)
+            except Exception as e:
+                logging.error(f"TTS Error ({self.session.guild.name}): {e}")
+                await self.session.notify("ズモモエラー！！")
+
+    async def _play(self, utterance):
+        trace_id_var.set(utterance.trace_id)
+        source = await utterance.task
+
+        voice_client = self.session.voice_client
+        if not voice_client or not voice_client.is_connected():
+            source.cleanup()
+            return
+
+        wait = time.perf_counter() - utterance.enqueued_at
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+        self.played += 1
+
+        # 再生スレッドから終了通知を受け取ってから次の発言へ進む
+        loop = asyncio.get_running_loop()
+        finished = loop.create_future()
+        def notify_finished():
+            loop.call_soon_threadsafe(lambda: finished.done() or finished.set_result(None))
+
+        def record_first_audio():
+            # 再生スレッドから呼ばれる
+            now = time.perf_counter()
+            first_audio = now - utterance.enqueued_at
+            self.total_first_audio += first_audio
+            self.max_first_audio = max(self.max_first_audio, first_audio)
+            utterance.first_audio = first_audio
+            METRIC_TTS_FIRST_AUDIO.observe(now - utterance.received_at)
+
+        notifying_source = NotifyingSource(TimedSource(source, record_first_audio), notify_finished)
+        try:
+            play_mixed(voice_client, notifying_source)
+        except Exception:
+            notifying_source.cleanup()
+            raise
+        await finished
+
+        if TRACE_LOGGING:
+            logging.info(
+                f"TTS trace ({self.session.guild.name}): 合成完了まで {(utterance.ready_at or 0) - utterance.received_at:.3f}秒 / "
+                f"最初の音声まで {(utterance.first_audio or 0) + utterance.enqueued_at - utterance.received_at:.3f}秒 "
+                f"({len(utterance.text)}文字)"
+            )
+        if isinstance(source, StreamingPCMSource):
+            logging.info(
+                f"TTS timing ({self.session.guild.name}): {len(utterance.text)}文字 / "
+                f"最初の音声まで {utterance.first_audio or 0:.2f}秒 / 合成待ちの無音 {source.underruns}フレーム"
+            )
+
+    def stats(self):
+        return {
+            "depth": len(self.pending),
+            "played": self.played,
+            "dropped": self.dropped,
+            "merged": self.merged,
+            "avg_wait": (self.total_wait / self.played) if self.played else 0.0,
+            "max_wait": self.max_wait,
+            "avg_first_audio": (self.total_first_audio / self.played) if self.played else 0.0,
+            "max_first_audio": self.max_first_audio,
+        }
+
+    def clear(self):
+        while self.pending:
+            self._discard(self.pending.popleft())
+
+    def close(self):
+        self.player_task.cancel()
+        self.clear()
+
+# ---------------------------------------------------------
+# ギルドごとのセッション (複数サーバーの同時接続)
+# ---------------------------------------------------------
+class GuildSession:
+    # 1つのボイス接続に紐づく状態 (読み上げ先チャンネル・キュー・設定) をまとめて持つ
+    def __init__(self, guild, text_channel):
+        self.guild = guild
+        self.text_channel = text_channel
+        self.april_fool = AprilFool
+        self.volumes = {**DEFAULT_VOLUMES, **settings_store.get_guild_setting(guild.id, "volumes", {})}
+        self.voice_channel_id = guild.voice_client.channel.id if guild.voice_client else None
+        self.closed = False
+        self.checkpoint_handle = None
+        # 管理者の「切断」やチャンネルの削除で外から切断された (この場合は復元しない)
+        self.disconnected_externally = False
+        self.tts_queue = TTSQueue(self, max_size=TTS_QUEUE_MAX, lookahead=TTS_LOOKAHEAD, policy=TTS_QUEUE_POLICY)
+        self.music_queue = MusicQueue(self, max_size=MUSIC_QUEUE_MAX)
+
+    @property
+    def voice_client(self):
+        return self.guild.voice_client
+
+    @property
+    def connected(self):
+        voice_client = self.voice_client
+        return voice_client is not None and voice_client.is_connected()
+
+    @property
+    def mixer(self):
+        voice_client = self.voice_client
+        if voice_client and isinstance(voice_client.source, MixingAudioSource):
+            return voice_client.source
+        return None
+
+    def set_volume(self, target, level):
+        self.volumes[target] = level
+        mixer = self.mixer
+        if mixer is None:
+            return
+        if target == "master":
+            mixer.master_gain = level
+        else:
+            mixer.set_kind_gain(target, level)
+
+    async def notify(self, content):
+        # 読み上げ先チャンネルへの通知。送信に失敗しても (権限不足・チャンネルの削除・Discordの障害) 再生キューは止めない
+        try:
+            await self.text_channel.send(content)
+        except Exception as e:
+            logging.warning(f"Notify Error ({self.guild.name}): {e}")
+
+    def snapshot(self):
+        # 再起動・切断後の復元用 (読み上げ待ちの発言は古くなるため残さない)
+        music_queue = self.music_queue
+        current = None
+        if music_queue.current:
+            current = {**music_queue.current.state(), "position": round(music_queue.position, 1)}
+        return {
+            "voice_channel_id": self.voice_channel_id,
+            "text_channel_id": self.text_channel.id,
+            "current": current,
+            "queue": [track.state() for track in music_queue.tracks],
+        }
+
+    def checkpoint(self):
+        # 状態が変わるたびに呼ばれるため、短い間の変更はまとめて1回だけ書き込む
+        if not SESSION_RESUME or self.closed or self.checkpoint_handle or self.voice_channel_id is None:
+            return
+        self.checkpoint_handle = asyncio.get_running_loop().call_later(1.0, self._write_checkpoint)
+
+    def _write_checkpoint(self):
+        self.checkpoint_handle = None
+        if not self.closed:
+            asyncio.create_task(self._save_checkpoint(self.snapshot()))
+
+    async def _save_checkpoint(self, state):
+        try:
+            await settings_store.save_voice_session(self.guild.id, state)
+        except Exception as e:
+            logging.error(f"Session checkpoint error ({self.guild.name}): {e}")
+
+    def close(self):
+        self.closed = True
+        if self.checkpoint_handle:
+            self.checkpoint_handle.cancel()
+            self.checkpoint_handle = None
+        self.tts_queue.close()
+        self.music_queue.close()
+
+# 音量の既定値 (1.0 = 100%)
+DEFAULT_VOLUMES = {
+    "master": config.get("master_volume", 1.0),
+    MUSIC: config.get("music_volume", 1.0),
+    SPEECH: config.get("speech_volume", 1.0),
+}
+
+sessions = {}
+
+def open_session(guild, text_channel):
+    session = sessions.get(guild.id)
+    if session is None:
+        session = GuildSession(guild, text_channel)
+        sessions[guild.id] = session
     else:
-        voice_client.play(new_source)
+        session.text_channel = text_channel
+        if guild.voice_client:
+            session.voice_channel_id = guild.voice_client.channel.id
+        # 再接続した場合は、接続を待っていた再生キューを動かす
+        session.music_queue.wakeup.set()
+    session.checkpoint()
+    return session
+
+def close_session(guild):
+    session = sessions.pop(guild.id, None)
+    if session:
+        session.close()
+    # 自分から切断した場合は復元しない
+    if guild.id in settings_store.voice_sessions:
+        asyncio.create_task(settings_store.delete_voice_session(guild.id))
 
 # ---------------------------------------------------------
-# Bot設定
+# yt-dlp抽出 (専用スレッドと再生用URLのキャッシュ)
+# ---------------------------------------------------------
+YTDL_STREAM_OPTS = {
+    "format": "bestaudio/best",
+    "quiet": True,
+    "noplaylist": True,
+    "extract_flat": False,
+    "no_warnings": True
+}
+
+# !play で受け付けたURL用。プレイリストは各曲を解決せずに一覧 (URLとタイトル) だけを取得する
+YTDL_REQUEST_OPTS = {
+    **YTDL_STREAM_OPTS,
+    "extract_flat": "in_playlist",
+    "playlistend": MUSIC_QUEUE_MAX,
+}
+
+ytdl_executor = ThreadPoolExecutor(max_workers=YTDL_WORKERS, thread_name_prefix="ytdl")
+ytdl_local = threading.local()
+
+def get_stream_ytdl():
+    # YoutubeDLはスレッドセーフではないため、抽出スレッドごとに1つ作って使い回す
+    # (yt-dlpの読み込みもここで行うため、初回の !play でもイベントループは止まらない)
+    ydl = getattr(ytdl_local, "ydl", None)
+    if ydl is None:
+        import yt_dlp
+        ydl = yt_dlp.YoutubeDL(YTDL_STREAM_OPTS)
+        ytdl_local.ydl = ydl
+    return ydl
+
+def get_request_ytdl():
+    ydl = getattr(ytdl_local, "request_ydl", None)
+    if ydl is None:
+        import yt_dlp
+        ydl = yt_dlp.YoutubeDL(YTDL_REQUEST_OPTS)
+        ytdl_local.request_ydl = ydl
+    return ydl
+
+def parse_stream_expiry(stream_url):
+    # 署名付きURLに埋め込まれた有効期限 (UNIX時刻) を読み取る。読めなければNone
+    parsed = urllib.parse.urlparse(stream_url)
+    query = urllib.parse.parse_qs(parsed.query)
+    for key in ["expire", "Expires", "exp"]:
+        value = query.get(key, [""])[0]
+        if value.isdigit():
+            return int(value)
+    # googlevideoのマニフェスト形式 (/expire/1700000000/)
+    match = re.search(r"/expire/(\d+)", parsed.path)
+    if match:
+        return int(match.group(1))
+    # S3形式 (X-Amz-Date + X-Amz-Expires)
+    amz_date = query.get("X-Amz-Date", [""])[0]
+    amz_expires = query.get("X-Amz-Expires", [""])[0]
+    if amz_date and amz_expires.isdigit():
+        try:
+            signed_at = datetime.strptime(amz_date, "%Y%m%dT%H%M%SZ").replace(tzinfo=timezone.utc)
+            return int(signed_at.timestamp()) + int(amz_expires)
+        except ValueError:
+            pass
+    return None
+
+class StreamCache:
+    # ページURL → 再生用URLとHTTPヘッダー。期限切れ間近(margin秒前)のものは使わない
+    def __init__(self, max_entries, default_ttl, margin=60):
+        self.max_entries = max_entries
+        self.default_ttl = default_ttl
+        self.margin = margin
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, page_url):
+        entry = self.entries.get(page_url)
+        if entry is None:
+            self.misses += 1
+            return None
+        info, expires_at = entry
+        if expires_at - self.margin <= time.time():
+            del self.entries[page_url]
+            self.misses += 1
+            return None
+        self.entries.move_to_end(page_url)
+        self.hits += 1
+        return info
+
+    def put(self, page_url, info):
+        expires_at = parse_stream_expiry(info["url"]) or (time.time() + self.default_ttl)
+        self.entries[page_url] = (info, expires_at)
+        self.entries.move_to_end(page_url)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+stream_cache = StreamCache(STREAM_CACHE_SIZE, STREAM_CACHE_TTL)
+
+def create_music_source(info, ffmpeg_opts):
+    # Opusで配信されている場合はffmpegでコンテナだけ詰め替え (codec copy)、それ以外はffmpeg側でOpusへ変換する
+    # どちらもPython側のエンコードが不要になり、読み上げと重なる間だけミキサーがデコードする
+    if not OPUS_PASSTHROUGH:
+        return discord.FFmpegPCMAudio(info["url"], **ffmpeg_opts)
+    codec = "copy" if (info.get("acodec") or "").startswith("opus") else None
+    return discord.FFmpegOpusAudio(info["url"], codec=codec, **ffmpeg_opts)
+
+async def resolve_stream(page_url):
+    # 戻り値: (再生情報, 抽出にかかった秒数。キャッシュヒット時は0)
+    info = stream_cache.get(page_url)
+    if info is not None:
+        return info, 0.0
+
+    started = time.perf_counter()
+    loop = asyncio.get_running_loop()
+    data = await loop.run_in_executor(ytdl_executor, lambda: get_stream_ytdl().extract_info(page_url, download=False))
+    if "entries" in data:
+        data = data["entries"][0]
+
+    info = make_stream_info(data)
+    stream_cache.put(page_url, info)
+    elapsed = time.perf_counter() - started
+    METRIC_YTDL_EXTRACT.observe(elapsed)
+    return info, elapsed
+
+def make_stream_info(data):
+    return {
+        "url": data["url"],
+        "http_headers": data.get("http_headers", {}),
+        "title": data.get("title"),
+        "acodec": data.get("acodec"),
+    }
+
+async def resolve_play_request(page_url):
+    # 戻り値: [(ページURL, タイトル), ...]
+    # 単体の動画はこの1回の抽出で再生用URLまで取得できるため、そのままキャッシュに入れておく
+    info = stream_cache.get(page_url)
+    if info is not None:
+        return [(page_url, info["title"])]
+
+    started = time.perf_counter()
+    loop = asyncio.get_running_loop()
+    data = await loop.run_in_executor(ytdl_executor, lambda: get_request_ytdl().extract_info(page_url, download=False))
+    METRIC_YTDL_EXTRACT.observe(time.perf_counter() - started)
+    if "entries" not in data:
+        stream_cache.put(page_url, make_stream_info(data))
+        return [(page_url, data.get("title"))]
+
+    tracks = []
+    for entry in data["entries"]:
+        if not entry:
+            continue
+        url = entry.get("webpage_url") or entry.get("url")
+        if url:
+            tracks.append((url, entry.get("title")))
+    return tracks
+
+def build_stream_ffmpeg_opts(info, start=0.0):
+    # 配信元が要求するHTTPヘッダーをffmpegにも渡す (start: 途中から再生する場合の開始秒)
+    headers = ""
+    for key, value in info.get("http_headers", {}).items():
+        headers += f"{key}: {value}\r\n"
+    seek = f"-ss {start:.1f} " if start > 0 else ""
+    return {
+        "before_options": f"{seek}-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5 -headers {repr(headers)}",
+        "options": "-vn"
+    }
+
+# ---------------------------------------------------------
+# 再生キュー (!play の曲をギルドごとに順番に再生)
 # ---------------------------------------------------------
-intents = discord.Intents.all()
-bot = commands.Bot(command_prefix="!", intents=intents, help_command=None)
+class Track:
+    # start: 再生を始める位置 (秒)。切断・再起動で途中から再開する場合に使う
+    def __init__(self, url, title=None, requested_by=None, start=0.0):
+        self.url = url
+        self.title = title
+        self.requested_by = requested_by
+        self.start = start
+        self.prefetch_task = None
+
+    @property
+    def label(self):
+        return self.title or self.url
+
+    def state(self):
+        return {"url": self.url, "title": self.title, "requested_by": self.requested_by, "start": self.start}
+
+    def prefetch(self):
+        # 再生用URLを先に取得してキャッシュに入れておく (結果は再生時に resolve_stream から取り出す)
+        if self.prefetch_task is None:
+            self.prefetch_task = asyncio.create_task(resolve_stream(self.url))
+            self.prefetch_task.add_done_callback(lambda task: task.cancelled() or task.exception())
+        return self.prefetch_task
+
+class MusicQueue:
+    # 1曲ずつ順番に再生し、再生を始めた時点で次の曲の再生用URLを取得しておく
+    # (大きなプレイリストでも、先に全曲を解決することはしない)
+    def __init__(self, session, max_size=100):
+        self.session = session
+        self.max_size = max_size
+        self.tracks = deque()
+        self.current = None
+        self.current_input = None
+        self.current_source = None
+        self.wakeup = asyncio.Event()
+        self.player_task = asyncio.create_task(self._run())
+
+    @property
+    def active(self):
+        return self.current is not None or bool(self.tracks)
+
+    @property
+    def position(self):
+        # 再生中の曲の再生位置 (秒)
+        if self.current is None:
+            return 0.0
+        frames = self.current_source.frames if self.current_source else 0
+        return self.current.start + frames * FRAME_MS / 1000
+
+    def add(self, tracks):
+        # 戻り値: 追加できた曲数
+        room = max(0, self.max_size - len(self.tracks))
+        added = tracks[:room]
+        self.tracks.extend(added)
+        if added:
+            # 再生中なら次の曲を、待機中なら最初の曲をすぐに取得し始める
+            self.tracks[0].prefetch()
+            self.wakeup.set()
+            self.session.checkpoint()
+        return len(added)
+
+    async def _run(self):
+        while True:
+            # ボイス接続が切れている間は、再接続されるまで次の曲へ進まない
+            while not self.tracks or not self.session.connected:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+
+            track = self.tracks.popleft()
+            self.current = track
+            try:
+                await self._play(track)
+            except Exception as e:
+                logging.error(f"Music Error ({self.session.guild.name}): {e}")
+                await self.session.notify(f"再生に失敗しました: {track.label}")
+            finally:
+                self.current = None
+                self.current_input = None
+                self.current_source = None
+                self.session.checkpoint()
+
+    async def _play(self, track):
+        started = time.perf_counter()
+        if track.prefetch_task is not None and not track.prefetch_task.done():
+            await asyncio.wait({track.prefetch_task})
+        info, extract_seconds = await resolve_stream(track.url)
+        track.title = track.title or info["title"]
+
+        if self.current is not track:
+            return
+        if not self.session.connected:
+            self.tracks.appendleft(track)
+            return
+        voice_client = self.session.voice_client
+        if self.tracks:
+            self.tracks[0].prefetch()
+
+        loop = asyncio.get_running_loop()
+        finished = loop.create_future()
+        def notify_finished():
+            loop.call_soon_threadsafe(lambda: finished.done() or finished.set_result(None))
+
+        # 抽出時間と、曲の再生開始までの時間を分けて記録する (先読み済みなら抽出はキャッシュ)
+        def log_first_frame():
+            cache_state = "キャッシュ" if extract_seconds == 0.0 else f"{extract_seconds:.2f}秒"
+            logging.info(f"Play timing: 抽出 {cache_state} / 最初の音声まで {time.perf_counter() - started:.2f}秒 ({track.url})")
+
+        source = create_music_source(info, build_stream_ffmpeg_opts(info, track.start))
+        self.current_source = TimedSource(source, log_first_frame)
+        notifying_source = NotifyingSource(self.current_source, notify_finished)
+        try:
+            self.current_input = play_mixed(voice_client, notifying_source, kind=MUSIC)
+        except Exception:
+            notifying_source.cleanup()
+            raise
+        if self.current_input is None:
+            notifying_source.cleanup()
+            return
+        self.session.checkpoint()
+        await finished
+
+        # 最後まで再生せずに止まった (!skip / !stop 以外 = ボイス接続が切れた) 場合は、続きから再生できるよう先頭に戻す
+        if not notifying_source.exhausted and not self.current_input.stopped:
+            self.tracks.appendleft(Track(track.url, track.title, track.requested_by, start=self.position))
+            logging.info(f"Music interrupted ({self.session.guild.name}): {self.position:.1f}秒から再開します")
+
+    def skip(self):
+        # 再生中の曲を止める (次の曲へ進むのはプレイヤー側)。抽出中なら再生せずに次へ進む
+        if self.current is None:
+            return False
+        if self.current_input is not None:
+            self.current_input.stopped = True
+        else:
+            self.current = None
+        return True
 
-active_text_channel = None
-user_character = {}
+    def clear(self):
+        for track in self.tracks:
+            if track.prefetch_task is not None:
+                track.prefetch_task.cancel()
+        self.tracks.clear()
+        self.session.checkpoint()
+
+    def close(self):
+        self.player_task.cancel()
+        self.clear()
+        self.skip()
+
+# ---------------------------------------------------------
+# 保存ジョブ管理 (!save をバックグラウンドで実行)
+# ---------------------------------------------------------
+JOB_STATUS_LABELS = {
+    "queued": "待機中",
+    "downloading": "ダウンロード中",
+    "processing": "変換中",
+    "done": "完了",
+    "failed": "失敗",
+    "cancelled": "キャンセル",
+}
+
+class DownloadJob:
+    def __init__(self, job_id, url, kind, filename, ext, ydl_opts, requested_by, index_key=None):
+        self.id = job_id
+        self.url = url
+        self.kind = kind
+        self.filename = filename
+        self.ext = ext
+        self.ydl_opts = ydl_opts
+        self.requested_by = requested_by
+        # 保存済みファイルの索引に登録するキー (URLから作るキーと、抽出後に分かる動画IDのキー)
+        self.index_keys = [index_key] if index_key else []
+        self.status = "queued"
+        self.downloaded_bytes = 0
+        self.total_bytes = None
+        self.speed = None
+        self.cancel_event = threading.Event()
+        self.future = None
+        # yt-dlpが実際に書き出したファイル (形式の都合で拡張子が ext と異なることがある)
+        self.saved_path = None
+        # 同じURL・形式を依頼したチャンネル (完了時に全員へ通知する)
+        self.channels = []
+        self.status_message = None
+
+    @property
+    def key(self):
+        return (self.url, self.kind)
+
+    @property
+    def target_dir(self):
+        return AUDIO_DIR if self.kind == "audio" else VIDEO_DIR
+
+    @property
+    def active(self):
+        return self.status in ("queued", "downloading", "processing")
+
+    def describe(self):
+        text = f"#{self.id} [{JOB_STATUS_LABELS[self.status]}] {self.kind}: <{self.url}>"
+        if self.status == "downloading":
+            if self.total_bytes:
+                text += f" {self.downloaded_bytes / self.total_bytes * 100:.0f}%"
+            text += f" ({self.downloaded_bytes / 1024 / 1024:.1f} MB"
+            if self.speed:
+                text += f", {self.speed / 1024 / 1024:.1f} MB/s"
+            text += ")"
+        return text
+
+    # 以下は作業スレッドから呼ばれる (yt-dlpのフック)
+    def progress_hook(self, d):
+        if self.cancel_event.is_set():
+            from yt_dlp.utils import DownloadCancelled
+            raise DownloadCancelled("ユーザーによりキャンセルされました")
+        if d["status"] == "downloading":
+            self.status = "downloading"
+            self.downloaded_bytes = d.get("downloaded_bytes") or 0
+            self.total_bytes = d.get("total_bytes") or d.get("total_bytes_estimate")
+            self.speed = d.get("speed")
+        elif d["status"] == "finished":
+            self.saved_path = Path(d.get("info_dict", {}).get("filepath") or d["filename"])
+
+    def postprocessor_hook(self, d):
+        if self.cancel_event.is_set():
+            from yt_dlp.utils import DownloadCancelled
+            raise DownloadCancelled("ユーザーによりキャンセルされました")
+        if d["status"] == "started":
+            self.status = "processing"
+
+    def run(self):
+        # yt-dlpの読み込みも作業スレッドで行う
+        import yt_dlp
+        from yt_dlp.utils import DownloadCancelled
+        if self.cancel_event.is_set():
+            raise DownloadCancelled("ユーザーによりキャンセルされました")
+        ydl_opts = dict(self.ydl_opts)
+        ydl_opts["progress_hooks"] = [self.progress_hook]
+        ydl_opts["postprocessor_hooks"] = [self.postprocessor_hook]
+        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+            info = ydl.extract_info(self.url, download=True)
+        # 結合・変換の後の最終的なファイル (進捗フックで分かるのは変換前のファイル)
+        downloads = (info or {}).get("requested_downloads") or []
+        if downloads and downloads[-1].get("filepath"):
+            self.saved_path = Path(downloads[-1]["filepath"])
+        if info and info.get("extractor_key") and info.get("id") and self.index_keys:
+            source_id = f"{info['extractor_key'].lower()}:{info['id']}"
+            self.index_keys.append(make_saved_key(source_id, self.kind, self.ydl_opts))
+
+    def remove_partial_files(self):
+        for path in self.target_dir.glob(f"{self.filename}.*"):
+            path.unlink(missing_ok=True)
+
+class DownloadManager:
+    # ダウンロードは専用スレッドで行う (FFmpegでの変換はyt-dlpが別プロセスとして起動する)
+    def __init__(self, workers, history=20, update_interval=3.0):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="save")
+        self.jobs = OrderedDict()
+        self.history = history
+        self.update_interval = update_interval
+        self.next_id = 1
+
+    def find_active(self, key):
+        for job in self.jobs.values():
+            if job.active and job.key == key:
+                return job
+        return None
+
+    def submit(self, url, kind, filename, ext, ydl_opts, requested_by, index_key=None):
+        job = DownloadJob(self.next_id, url, kind, filename, ext, ydl_opts, requested_by, index_key)
+        self.next_id += 1
+        self.jobs[job.id] = job
+        # 終わったジョブは直近のものだけ残す
+        finished = [job_id for job_id, old in self.jobs.items() if not old.active]
+        for job_id in finished[:max(0, len(finished) - self.history)]:
+            del self.jobs[job_id]
+        return job
+
+    def cancel(self, job_id):
+        job = self.jobs.get(job_id)
+        if job is None or not job.active:
+            return False
+        # 作業スレッド側でフックから中断する (待機中のジョブは開始時に中断される)
+        job.cancel_event.set()
+        return True
+
+    async def run(self, job):
+        started = time.perf_counter()
+        loop = asyncio.get_running_loop()
+        job.future = loop.run_in_executor(self.executor, job.run)
+        last_text = None
+        while not job.future.done():
+            await asyncio.wait({job.future}, timeout=self.update_interval)
+            text = job.describe()
+            if job.status_message and text != last_text and not job.future.done():
+                last_text = text
+                try:
+                    await job.status_message.edit(content=text)
+                except discord.HTTPException as e:
+                    logging.warning(f"Save status update failed: {e}")
+
+        try:
+            await job.future
+            job.status = "done"
+        except Exception as e:
+            # キャンセル時はフックから DownloadCancelled が投げられる (yt-dlpが別の例外に包んで投げることもある)
+            if job.cancel_event.is_set():
+                job.status = "cancelled"
+            else:
+                job.status = "failed"
+                logging.error(f"Save command error: {e}")
+
+        message = None
+        if job.status == "done":
+            # 容量上限による削除で、他のダウンロードの途中のファイルを消さないようにする
+            busy = {other.filename for other in self.jobs.values() if other.active and other is not job}
+            try:
+                message = await asyncio.to_thread(finalize_saved_file, job, busy)
+            except Exception as e:
+                job.status = "failed"
+                logging.error(f"Save finalize error: {e}")
+
+        METRIC_DOWNLOAD.observe(time.perf_counter() - started, kind=job.kind, status=job.status)
+        if job.status != "done":
+            await asyncio.to_thread(job.remove_partial_files)
+        if job.status_message:
+            try:
+                await job.status_message.edit(content=job.describe())
+            except discord.HTTPException:
+                pass
+
+        if job.status == "cancelled":
+            message = f"ダウンロード #{job.id} をキャンセルしました。"
+        elif job.status == "failed":
+            message = "ズモモエラー！！保存エラーが出たぞ！人間！対応しろ！"
+        # 1つのチャンネルに送れなくても、他の依頼者には知らせる
+        for channel in job.channels:
+            try:
+                await channel.send(message)
+            except discord.HTTPException as e:
+                logging.warning(f"Save result send failed: {e}")
+
+    def shutdown(self):
+        for job in self.jobs.values():
+            job.cancel_event.set()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+def finalize_saved_file(job, busy_filenames=()):
+    saved_path = job.saved_path or job.target_dir / f"{job.filename}.{job.ext}"
+
+    # Nginxが読み取れるようにファイルのパーミッションを変更 (644)
+    try:
+        os.chmod(saved_path, 0o644)
+    except Exception as e:
+        logging.warning(f"Permission change failed: {e}")
+
+    # 中身が同じファイルが既にあれば、新しい方は消して既存のファイルを返す
+    saved_name = saved_index.register(job.index_keys, job.kind, saved_path)
+    # 保存は済んでいるため、古いファイルの削除に失敗しても共有用のURLは返す
+    try:
+        saved_index.evict(keep={f"{job.kind}/{saved_name}"}, busy_filenames=busy_filenames)
+    except Exception as e:
+        logging.warning(f"Saved file eviction failed: {e}")
+    return share_message(job.kind, saved_name)
+
+def share_message(kind, saved_name):
+    if DEVELOPER_MODE:
+        # .env から共有用URLのベースのみ取得
+        env_url_key = f"SHARE_{kind.upper()}_URL"
+        share_url_base = os.getenv(env_url_key)
+
+        if share_url_base:
+            # URLを結合して表示 (末尾のスラッシュ有無を考慮)
+            share_url = share_url_base.rstrip('/') + f"/{saved_name}"
+            return f"以下のURLからダウンロードできます。\n{share_url}"
+        logging.warning(f"ENV variable {env_url_key} not found.")
+        return "ダウンロード完了。（公開用URL設定が見つかりませんでした）"
+    return "ダウンロード完了。サーバー内に保存されました。"
+
+# ---------------------------------------------------------
+# 保存済みファイルの索引 (同じ動画の重複保存を防ぐ)
+# ---------------------------------------------------------
+# 共有URLに付いてくる追跡用パラメータ (同じ動画として扱うために取り除く)
+TRACKING_PARAMS = {"si", "feature", "pp", "t", "start", "fbclid", "gclid", "igshid", "ref", "s"}
+
+def normalize_source_url(url):
+    parsed = urllib.parse.urlparse(url.strip())
+    host = parsed.netloc.lower()
+    for prefix in ["www.", "m.", "music.", "mobile."]:
+        if host.startswith(prefix):
+            host = host[len(prefix):]
+    query = urllib.parse.parse_qs(parsed.query)
+
+    # YouTubeは形式が違っても動画IDで同一視する
+    if host == "youtu.be":
+        return f"youtube:{parsed.path.strip('/').split('/')[0]}"
+    if host == "youtube.com":
+        if "v" in query:
+            return f"youtube:{query['v'][0]}"
+        match = re.match(r"/(?:shorts|live|embed)/([\w-]+)", parsed.path)
+        if match:
+            return f"youtube:{match.group(1)}"
+    # Twitter/Xは投稿IDで同一視する
+    if host in ["twitter.com", "x.com"]:
+        match = re.search(r"/status/(\d+)", parsed.path)
+        if match:
+            return f"twitter:{match.group(1)}"
+
+    kept = sorted(
+        (key, value) for key, values in query.items()
+        if key not in TRACKING_PARAMS and not key.startswith("utm_")
+        for value in values
+    )
+    path = parsed.path.rstrip("/") or "/"
+    return f"{host}{path}" + (f"?{urllib.parse.urlencode(kept)}" if kept else "")
+
+def make_saved_key(source_id, kind, ydl_opts):
+    # (動画の識別子, 保存形式, 画質) を1つの文字列にする
+    quality = ydl_opts.get("format", "")
+    for postprocessor in ydl_opts.get("postprocessors", []):
+        quality += f"|{postprocessor.get('preferredcodec')}-{postprocessor.get('preferredquality')}"
+    return f"{source_id}#{kind}#{quality}"
+
+def hash_file(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+class SavedFileIndex:
+    # 索引は data/saved_index.json に保存する。ファイル操作を伴うためスレッド経由で呼び出すこと
+    # files: "audio/xxxx.mp3" → {sha256, size, created, last_access}
+    # keys: 保存キー → "audio/xxxx.mp3"
+    def __init__(self, path, quota_bytes, max_age_days):
+        self.path = path
+        self.quota_bytes = quota_bytes
+        self.max_age_days = max_age_days
+        self.lock = threading.Lock()
+        self.files = {}
+        self.keys = {}
+        if path.exists():
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    data = json.load(f)
+                self.files = data.get("files", {})
+                self.keys = data.get("keys", {})
+            except (json.JSONDecodeError, OSError) as e:
+                logging.warning(f"保存ファイル索引の読み込みに失敗しました: {e}")
+
+    def _save(self):
+        # 書きかけのファイルが残らないよう、一時ファイルに書いてから置き換える
+        temp_path = self.path.with_suffix(".tmp")
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump({"files": self.files, "keys": self.keys}, f, ensure_ascii=False)
+        os.replace(temp_path, self.path)
+
+    @staticmethod
+    def _file_path(record_name):
+        kind, name = record_name.split("/", 1)
+        return (AUDIO_DIR if kind == "audio" else VIDEO_DIR) / name
+
+    def _forget(self, record_name):
+        self.files.pop(record_name, None)
+        for key in [key for key, value in self.keys.items() if value == record_name]:
+            del self.keys[key]
+
+    def lookup(self, key):
+        with self.lock:
+            record_name = self.keys.get(key)
+            if record_name is None:
+                return None
+            if not self._file_path(record_name).exists():
+                self._forget(record_name)
+                self._save()
+                return None
+            self.files[record_name]["last_access"] = time.time()
+            self._save()
+            return record_name.split("/", 1)[1]
+
+    def register(self, keys, kind, saved_path):
+        digest = hash_file(saved_path)
+        with self.lock:
+            record_name = f"{kind}/{saved_path.name}"
+            for existing_name, record in self.files.items():
+                if record["sha256"] == digest and existing_name.startswith(f"{kind}/") and self._file_path(existing_name).exists():
+                    saved_path.unlink(missing_ok=True)
+                    record_name = existing_name
+                    break
+            else:
+                now = time.time()
+                self.files[record_name] = {
+                    "sha256": digest,
+                    "size": saved_path.stat().st_size,
+                    "created": now,
+                    "last_access": now,
+                }
+            self.files[record_name]["last_access"] = time.time()
+            for key in keys:
+                self.keys[key] = record_name
+            self._save()
+        return record_name.split("/", 1)[1]
+
+    def evict(self, keep=(), busy_filenames=()):
+        # 期限切れのファイルを消し、容量上限を超えていれば最終利用の古い順に消す
+        # 索引に無いファイル (以前のバージョンで保存したもの) は更新日時を最終利用として扱う
+        # keep: 消さないファイル ("audio/xxxx.mp3"、登録したばかりで共有用のURLを送るもの)
+        # busy_filenames: ダウンロード中のジョブのファイル名 (拡張子なし)。書きかけ・結合前のファイルは消さない
+        with self.lock:
+            candidates = []
+            for kind, directory in [("audio", AUDIO_DIR), ("video", VIDEO_DIR)]:
+                for path in directory.iterdir():
+                    if not path.is_file() or path.name.startswith(".") or path.suffix in (".part", ".ytdl"):
+                        continue
+                    if path.name.split(".", 1)[0] in busy_filenames:
+                        continue
+                    record_name = f"{kind}/{path.name}"
+                    stat = path.stat()
+                    record = self.files.get(record_name)
+                    last_access = record["last_access"] if record else stat.st_mtime
+                    candidates.append((last_access, stat.st_size, record_name, path))
+
+            candidates.sort()
+            total_bytes = sum(size for _, size, _, _ in candidates)
+            expire_before = time.time() - self.max_age_days * 86400 if self.max_age_days else None
+            removed = []
+            for last_access, size, record_name, path in candidates:
+                expired = expire_before is not None and last_access < expire_before
+                if not expired and total_bytes <= self.quota_bytes:
+                    break
+                # 残すファイルも容量には数え、代わりに他のファイルを消す
+                if record_name in keep:
+                    continue
+                path.unlink(missing_ok=True)
+                self._forget(record_name)
+                total_bytes -= size
+                removed.append(record_name)
+
+            if removed:
+                self._save()
+                logging.info(f"保存ファイルを{len(removed)}件削除しました (容量上限・保持期限)")
+        return removed
+
+saved_index = SavedFileIndex(SAVED_INDEX_PATH, SAVED_QUOTA_MB * 1024 * 1024, SAVED_MAX_AGE_DAYS)
+
+# ---------------------------------------------------------
+# メンバー名の索引 (!set の対象検索)
+# ---------------------------------------------------------
+# メンション (<@123> / <@!123>) またはユーザーIDそのもの
+MEMBER_ID_PATTERN = re.compile(r"^(?:<@!?(\d+)>|(\d{15,20}))$")
+
+def normalize_member_key(name):
+    # 全角・半角や大文字・小文字の違いを無視して照合する
+    return unicodedata.normalize("NFKC", name).casefold()
+
+class MemberIndex:
+    # メンバーオブジェクトの代わりに (ユーザー名, グローバル表示名, ニックネーム) だけを持ち、
+    # 正規化した名前 → ユーザーID の辞書と、前方一致用のソート済みの名前一覧で引けるようにする
+    # (大きなサーバーでも軽く済むよう、名前が1人にしか使われていなければIDを、複数ならIDのタプルを持つ)
+    def __init__(self):
+        self.guilds = {}
+
+    def _guild(self, guild_id):
+        index = self.guilds.get(guild_id)
+        if index is None:
+            index = self.guilds[guild_id] = {"entries": {}, "keys": {}, "sorted": [], "complete": False}
+        return index
+
+    def is_complete(self, guild_id):
+        index = self.guilds.get(guild_id)
+        return bool(index and index["complete"])
+
+    def load(self, guild_id, members):
+        # 一括登録: 名前一覧のソートは最後に1回だけ行う
+        index = self._guild(guild_id)
+        for member in members:
+            self._add(index, member, keep_sorted=False)
+        index["sorted"] = sorted(index["keys"])
+        index["complete"] = True
+
+    def add(self, member):
+        # Webhookの発言などメンバーではない送信者は対象外
+        if not isinstance(member, discord.Member) or member.bot:
+            return
+        self._add(self._guild(member.guild.id), member, keep_sorted=True)
+
+    def _add(self, index, member, keep_sorted):
+        entry = (member.name, member.global_name, member.nick)
+        old_entry = index["entries"].get(member.id)
+        if old_entry == entry:
+            return
+        if old_entry is not None:
+            self._unlink(index, member.id, old_entry)
+        self._link(index, member.id, entry, keep_sorted)
+
+    def remove(self, guild_id, member_id):
+        index = self.guilds.get(guild_id)
+        if not index:
+            return
+        entry = index["entries"].pop(member_id, None)
+        if entry is not None:
+            self._unlink(index, member_id, entry)
+
+    def update_user(self, user):
+        # ユーザー名・グローバル表示名の変更は、そのユーザーがいる全サーバーに反映する
+        for index in self.guilds.values():
+            entry = index["entries"].get(user.id)
+            if entry is None or entry[:2] == (user.name, user.global_name):
+                continue
+            self._unlink(index, user.id, entry)
+            self._link(index, user.id, (user.name, user.global_name, entry[2]), keep_sorted=True)
+
+    def forget(self, guild_id):
+        self.guilds.pop(guild_id, None)
+
+    def _link(self, index, member_id, entry, keep_sorted):
+        index["entries"][member_id] = entry
+        keys = index["keys"]
+        for name in entry:
+            if not name:
+                continue
+            key = normalize_member_key(name)
+            if key == name:
+                key = name
+            ids = keys.get(key)
+            if ids is None:
+                keys[key] = member_id
+                if keep_sorted:
+                    bisect.insort(index["sorted"], key)
+            elif isinstance(ids, int):
+                if ids != member_id:
+                    keys[key] = (ids, member_id)
+            elif member_id not in ids:
+                keys[key] = ids + (member_id,)
+
+    def _unlink(self, index, member_id, entry):
+        keys = index["keys"]
+        for name in entry:
+            if not name:
+                continue
+            key = normalize_member_key(name)
+            ids = keys.get(key)
+            if isinstance(ids, tuple):
+                remaining = tuple(other_id for other_id in ids if other_id != member_id)
+                keys[key] = remaining[0] if len(remaining) == 1 else remaining
+            elif ids == member_id:
+                del keys[key]
+                position = bisect.bisect_left(index["sorted"], key)
+                if position < len(index["sorted"]) and index["sorted"][position] == key:
+                    del index["sorted"][position]
+
+    def display_name(self, guild_id, member_id):
+        index = self.guilds.get(guild_id)
+        entry = index["entries"].get(member_id) if index else None
+        if entry is None:
+            return None
+        name, global_name, nick = entry
+        return nick or global_name or name
+
+    def search(self, guild_id, query, limit=5):
+        # 戻り値: 候補のユーザーIDのリスト (完全一致 → 前方一致 → あいまい一致 の順に、最初に見つかった段階のもの)
+        index = self.guilds.get(guild_id)
+        if not index:
+            return []
+        keys = index["keys"]
+        sorted_keys = index["sorted"]
+        key = normalize_member_key(query)
+        if key in keys:
+            return self._collect(keys, [key], limit)
+
+        start = bisect.bisect_left(sorted_keys, key)
+        end = start
+        while end < len(sorted_keys) and end - start < limit and sorted_keys[end].startswith(key):
+            end += 1
+        if end > start:
+            return self._collect(keys, sorted_keys[start:end], limit)
+
+        # あいまい一致は、先頭の文字が同じで長さの近い名前だけを比べる (全件と比べると大きなサーバーで遅い)
+        head = key[:1]
+        start = bisect.bisect_left(sorted_keys, head)
+        end = bisect.bisect_left(sorted_keys, head + "\U0010ffff")
+        pool = [name for name in sorted_keys[start:end] if abs(len(name) - len(key)) <= 2]
+        return self._collect(keys, difflib.get_close_matches(key, pool, n=limit, cutoff=0.75), limit)
+
+    def _collect(self, keys, matched_keys, limit):
+        found = []
+        for matched_key in matched_keys:
+            ids = keys[matched_key]
+            for member_id in (ids,) if isinstance(ids, int) else ids:
+                if member_id not in found:
+                    found.append(member_id)
+        return found[:limit]
+
+member_index = MemberIndex()
+
+async def preload_member_index(guilds):
+    # 大きなサーバーでも取得したメンバーはキャッシュせず、索引だけを作る
+    for guild in guilds:
+        if member_index.is_complete(guild.id):
+            continue
+        started = time.perf_counter()
+        try:
+            members = await guild.chunk(cache=False)
+        except Exception as e:
+            logging.error(f"Member index error ({guild.name}): {e}")
+            continue
+        member_index.load(guild.id, (member for member in members if not member.bot))
+        logging.info(f"メンバー名の索引を作成しました ({guild.name}): {len(members)}人 / {time.perf_counter() - started:.2f}秒")
+
+async def resolve_member(ctx, target_name):
+    # 戻り値: [(ユーザーID, 表示名), ...] (見つからなければ空、複数なら候補)
+    guild = ctx.guild
+    match = MEMBER_ID_PATTERN.match(target_name)
+    if match:
+        member_id = int(match.group(1) or match.group(2))
+        for member in ctx.message.mentions:
+            if member.id == member_id:
+                return [(member.id, member.display_name)]
+        name = member_index.display_name(guild.id, member_id)
+        if name:
+            return [(member_id, name)]
+        member = guild.get_member(member_id)
+        if member is None:
+            try:
+                member = await guild.fetch_member(member_id)
+            except discord.NotFound:
+                return []
+        return [(member.id, member.display_name)]
+
+    member_ids = member_index.search(guild.id, target_name)
+    if not member_ids:
+        # 索引にない (作成前・名前の変更を受け取れていない) 場合は、Discordに名前の前方一致で問い合わせる
+        members = await guild.query_members(target_name, limit=5, cache=False)
+        for member in members:
+            member_index.add(member)
+        member_ids = member_index.search(guild.id, target_name)
+    return [(member_id, member_index.display_name(guild.id, member_id)) for member_id in member_ids]
+
+# ---------------------------------------------------------
+# 設定ストア (SQLite)
+# ---------------------------------------------------------
+class SettingsStore:
+    # ユーザーごとのキャラクター・辞書・ギルドごとの設定を保存する
+    # 起動時に全件をメモリへ読み込み、読み取りはメモリから、書き込みは専用スレッドで行う
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS user_character (
+            user_id TEXT PRIMARY KEY,
+            style_id INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS user_dict (
+            word TEXT PRIMARY KEY,
+            uuid TEXT NOT NULL,
+            pronunciation TEXT,
+            accent_type INTEGER NOT NULL DEFAULT 0,
+            priority INTEGER NOT NULL DEFAULT 5
+        );
+        CREATE TABLE IF NOT EXISTS guild_settings (
+            guild_id INTEGER NOT NULL,
+            key TEXT NOT NULL,
+            value TEXT NOT NULL,
+            PRIMARY KEY (guild_id, key)
+        );
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS voice_sessions (
+            guild_id INTEGER PRIMARY KEY,
+            state TEXT NOT NULL,
+            updated_at REAL NOT NULL
+        );
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="settings")
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(self.SCHEMA)
+        self._migrate()
+        self._import_legacy_json()
+
+        self.user_styles = dict(self.connection.execute("SELECT user_id, style_id FROM user_character"))
+        self.user_dict = {
+            word: {"uuid": word_uuid, "pronunciation": pronunciation, "accent_type": accent_type, "priority": priority}
+            for word, word_uuid, pronunciation, accent_type, priority
+            in self.connection.execute("SELECT word, uuid, pronunciation, accent_type, priority FROM user_dict")
+        }
+        self.guild_settings = {}
+        for guild_id, key, value in self.connection.execute("SELECT guild_id, key, value FROM guild_settings"):
+            self.guild_settings.setdefault(guild_id, {})[key] = json.loads(value)
+        # 前回終了時 (または切断時) のボイスセッション: {guild_id: (state, 保存時刻)}
+        self.voice_sessions = {
+            guild_id: (json.loads(state), updated_at)
+            for guild_id, state, updated_at in self.connection.execute("SELECT guild_id, state, updated_at FROM voice_sessions")
+        }
+
+    def _migrate(self):
+        # 以前のバージョンで作ったデータベースに、後から追加した列を足す
+        columns = [row[1] for row in self.connection.execute("PRAGMA table_info(user_dict)")]
+        if "priority" not in columns:
+            self.connection.execute("ALTER TABLE user_dict ADD COLUMN priority INTEGER NOT NULL DEFAULT 5")
+
+    def _import_legacy_json(self):
+        # 以前のバージョンのJSONファイルを一度だけ取り込む
+        if self.connection.execute("SELECT 1 FROM meta WHERE key = 'json_imported'").fetchone():
+            return
+
+        def read_json(path):
+            if not path.exists():
+                return {}
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    return json.load(f)
+            except json.JSONDecodeError as e:
+                logging.warning(f"{path.name} の読み込みに失敗しました: {e}")
+                return {}
+
+        user_characters = read_json(USER_CHAR_PATH)
+        dictionary = read_json(DICT_PATH)
+        with self.connection:
+            self.connection.execute("BEGIN")
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO user_character (user_id, style_id) VALUES (?, ?)",
+                [(str(user_id), int(style_id)) for user_id, style_id in user_characters.items()],
+            )
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO user_dict (word, uuid) VALUES (?, ?)",
+                list(dictionary.items()),
+            )
+            self.connection.execute("INSERT INTO meta (key, value) VALUES ('json_imported', ?)", (datetime.now().isoformat(),))
+        logging.info(f"JSONから設定を取り込みました: キャラクター {len(user_characters)}件 / 辞書 {len(dictionary)}件")
+
+    async def _write(self, sql, params=()):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self.executor, self.connection.execute, sql, params)
+
+    def get_user_style(self, user_id, default):
+        return self.user_styles.get(str(user_id), default)
+
+    async def set_user_style(self, user_id, style_id):
+        self.user_styles[str(user_id)] = style_id
+        await self._write(
+            "INSERT OR REPLACE INTO user_character (user_id, style_id) VALUES (?, ?)",
+            (str(user_id), style_id),
+        )
+
+    async def set_dict_word(self, word, word_uuid, pronunciation, accent_type=0, priority=5):
+        self.user_dict[word] = {"uuid": word_uuid, "pronunciation": pronunciation, "accent_type": accent_type, "priority": priority}
+        await self._write(
+            "INSERT OR REPLACE INTO user_dict (word, uuid, pronunciation, accent_type, priority) VALUES (?, ?, ?, ?, ?)",
+            (word, word_uuid, pronunciation, accent_type, priority),
+        )
+
+    async def set_dict_words(self, entries):
+        # entries: [(word, uuid, pronunciation, accent_type, priority), ...]
+        for word, word_uuid, pronunciation, accent_type, priority in entries:
+            self.user_dict[word] = {"uuid": word_uuid, "pronunciation": pronunciation, "accent_type": accent_type, "priority": priority}
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(
+            self.executor,
+            self._write_many,
+            "INSERT OR REPLACE INTO user_dict (word, uuid, pronunciation, accent_type, priority) VALUES (?, ?, ?, ?, ?)",
+            entries,
+        )
+
+    def _write_many(self, sql, rows):
+        with self.connection:
+            self.connection.execute("BEGIN")
+            self.connection.executemany(sql, rows)
+
+    async def delete_dict_word(self, word):
+        self.user_dict.pop(word, None)
+        await self._write("DELETE FROM user_dict WHERE word = ?", (word,))
+
+    def get_guild_setting(self, guild_id, key, default=None):
+        return self.guild_settings.get(guild_id, {}).get(key, default)
+
+    async def set_guild_setting(self, guild_id, key, value):
+        self.guild_settings.setdefault(guild_id, {})[key] = value
+        await self._write(
+            "INSERT OR REPLACE INTO guild_settings (guild_id, key, value) VALUES (?, ?, ?)",
+            (guild_id, key, json.dumps(value)),
+        )
+
+    async def save_voice_session(self, guild_id, state):
+        updated_at = time.time()
+        self.voice_sessions[guild_id] = (state, updated_at)
+        await self._write(
+            "INSERT OR REPLACE INTO voice_sessions (guild_id, state, updated_at) VALUES (?, ?, ?)",
+            (guild_id, json.dumps(state, ensure_ascii=False), updated_at),
+        )
+
+    async def delete_voice_session(self, guild_id):
+        self.voice_sessions.pop(guild_id, None)
+        await self._write("DELETE FROM voice_sessions WHERE guild_id = ?", (guild_id,))
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        self.connection.close()
+
+settings_store = SettingsStore(SETTINGS_DB_PATH)
+
+download_manager = DownloadManager(SAVE_WORKERS)
+
+# 取得時に各オブジェクトの状態から計算するメトリクス
+metrics.counter("agora_tts_cache_requests_total", "合成音声キャッシュの参照数 (result: hit / disk_hit / miss)", lambda: [
+    ({"result": "hit"}, tts_cache.hits),
+    ({"result": "disk_hit"}, tts_cache.disk_hits),
+    ({"result": "miss"}, tts_cache.misses),
+])
+metrics.gauge("agora_tts_cache_bytes", "合成音声キャッシュ (メモリ) の使用量", lambda: tts_cache.total_bytes + tts_cache.pinned_bytes)
+metrics.counter("agora_stream_cache_requests_total", "再生用URLキャッシュの参照数", lambda: [
+    ({"result": "hit"}, stream_cache.hits),
+    ({"result": "miss"}, stream_cache.misses),
+])
+metrics.gauge("agora_sessions", "接続中のボイスチャンネル数", lambda: len(sessions))
+metrics.gauge("agora_tts_queue_depth", "読み上げ待ちの発言数 (全サーバーの合計)", lambda: sum(
+    len(session.tts_queue.pending) for session in list(sessions.values())
+))
+metrics.gauge("agora_mixer_sources", "ミキサーで再生中のソース数 (全サーバーの合計)", lambda: sum(
+    len(session.mixer.sources) for session in list(sessions.values()) if session.mixer
+))
+metrics.gauge("agora_voicevox_in_flight", "VOICEVOXで処理中・待機中のリクエスト数", lambda: [
+    ({"engine": node.base_url}, node.in_flight) for node in voicevox.nodes
+])
+metrics.gauge("agora_voicevox_up", "VOICEVOXエンジンが振り分け対象か (1: 正常 / 0: 停止・切り離し中)", lambda: [
+    ({"engine": node.base_url}, int(node.is_available(time.monotonic()))) for node in voicevox.nodes
+])
+metrics.gauge("agora_downloads_active", "実行中・待機中のダウンロード数", lambda: sum(
+    1 for job in list(download_manager.jobs.values()) if job.active
+))
+
+# ---------------------------------------------------------
+# Bot設定
+# ---------------------------------------------------------
+class AgoraBot(commands.Bot):
+    async def setup_hook(self):
+        # ログイン (トークンの確認) が終わった直後に呼ばれる
+        mark_startup_phase("login")
+        loop_watchdog.start()
+        if METRICS_PORT:
+            await start_metrics_server()
+
+    async def close(self):
+        # 終了時にVOICEVOXとのコネクションプールと抽出・保存スレッド、監視スレッドを閉じる
+        loop_watchdog.stop()
+        await voicevox.close()
+        ytdl_executor.shutdown(wait=False, cancel_futures=True)
+        download_manager.shutdown()
+        await super().close()
+        settings_store.close()
+
+# 必要なイベントだけを受け取る (プレゼンス等は受け取らない)。
+# メンバーはボイスチャンネルにいる人だけをキャッシュし、名前の検索は member_index で行う
+intents = discord.Intents.none()
+intents.guilds = True
+intents.guild_messages = True
+intents.dm_messages = True
+intents.message_content = True
+intents.voice_states = True
+intents.members = True
+bot = AgoraBot(
+    command_prefix="!",
+    intents=intents,
+    help_command=None,
+    member_cache_flags=discord.MemberCacheFlags(voice=True, joined=False),
+    chunk_guilds_at_startup=False,
+)
 
 today = datetime.now()
 AprilFool = (today.month == 4 and today.day == 1)
 
 async def update_status():
-    if active_text_channel is None:
+    if not sessions:
         if MAINTENANCE_MODE:
             await bot.change_presence(status=discord.Status.dnd, activity=discord.Game(name="メンテナンス中"))
         else:
@@ -160,8 +2714,10 @@ async def update_status():
     else:
         if MAINTENANCE_MODE:
              await bot.change_presence(status=discord.Status.dnd, activity=discord.Game(name="メンテナンス中"))
-        else:
+        elif len(sessions) == 1:
              await bot.change_presence(activity=discord.Game(name="VC接続中"))
+        else:
+             await bot.change_presence(activity=discord.Game(name=f"VC接続中 ({len(sessions)}サーバー)"))
 
 def classify_attachment(filename):
     extension = filename.split(".")[-1].lower()
@@ -171,6 +2727,426 @@ def classify_attachment(filename):
     if extension in ["wav", "mp3", "aac", "flac"]: return "音声"
     return "ファイル"
 
+# ---------------------------------------------------------
+# 定型文の事前合成 (ウォームアップ)
+# ---------------------------------------------------------
+# デフォルトキャラクターで読み上げるシステムメッセージ
+ANNOUNCE_PHRASES = [
+    "接続しました",
+    "再接続しました",
+    "リンク先の音声を再生します",
+    "添付された音声ファイルを再生します",
+]
+# 発言者のキャラクターで読み上げる置き換え文
+CHAT_PHRASES = [
+    "リンク省略",
+    "センシティブ発言",
+    "音声ファイル添付",
+    *[f"{file_type}ファイル添付" for file_type in ["画像", "動画", "ドキュメント", "ファイル"]],
+]
+
+warmup_task = None
+
+async def warmup_phrases():
+    started = time.perf_counter()
+    default_id = CHARACTER_MAP[DEFAULT_CHARACTER]
+
+    # よく使われているキャラクターにも置き換え文を用意しておく
+    usage = Counter(style_id for style_id in settings_store.user_styles.values() if style_id != default_id)
+    style_ids = [style_id for style_id, _ in usage.most_common(WARMUP_TOP_CHARACTERS)]
+
+    jobs = [(phrase, default_id) for phrase in ANNOUNCE_PHRASES + CHAT_PHRASES]
+    jobs += [(phrase, style_id) for style_id in style_ids for phrase in CHAT_PHRASES]
+
+    failed = 0
+    for phrase, style_id in jobs:
+        try:
+            await synthesize_pcm(phrase, style_id, pin=True)
+        except Exception as e:
+            failed += 1
+            logging.warning(f"Warmup failed ({phrase}, {style_id}): {e}")
+
+    elapsed = time.perf_counter() - started
+    stats = tts_cache.stats()
+    logging.info(
+        f"定型文の事前合成が完了しました: {stats['pinned']}件 / "
+        f"{stats['pinned_bytes'] / 1024 / 1024:.1f} MB / {elapsed:.2f}秒 (失敗 {failed}件)"
+    )
+
+async def on_dictionary_changed():
+    # 読みが変わるため、合成済みの音声を捨てて定型文を作り直す
+    tts_cache.invalidate()
+    await asyncio.to_thread(tts_cache.clear_disk)
+    schedule_warmup()
+
+def schedule_warmup():
+    # 実行中のウォームアップがあれば止めてからやり直す (辞書更新時など)
+    global warmup_task
+    if warmup_task and not warmup_task.done():
+        warmup_task.cancel()
+    warmup_task = asyncio.create_task(warmup_phrases())
+
+# ---------------------------------------------------------
+# 読み上げテキストの整形
+# ---------------------------------------------------------
+# 1回の走査で置換できるよう、読み上げに不要な要素をまとめて1つの正規表現にする (先に書いたものが優先)
+NORMALIZE_PATTERN = re.compile(r"""
+      (?P<codeblock>```.*?(?:```|$))
+    | (?P<spoiler>\|\|.+?\|\|)
+    | (?P<url>https?://\S+)
+    | (?P<emoji><a?:(?P<emoji_name>\w+):\d+>)
+    | (?P<user><@!?(?P<user_id>\d+)>)
+    | (?P<role><@&(?P<role_id>\d+)>)
+    | (?P<channel><\#(?P<channel_id>\d+)>)
+    | (?P<timestamp><t:(?P<unix_time>-?\d+)(?::[tTdDfFR])?>)
+    | (?P<markup>\*\*|__|~~|`)
+    | (?P<unicode_emoji>[\U0001F000-\U0001FAFF\u2600-\u27BF\uFE0F\u200D]+)
+    | (?P<repeat>(?P<char>[^\d\s])(?P=char){%d,})
+    | (?P<space>\s+)
+""" % TTS_REPEAT_MAX, re.VERBOSE | re.DOTALL)
+
+def _normalize_replacement(match, guild):
+    kind = match.lastgroup
+    if kind == "codeblock":
+        return "コード省略"
+    if kind == "spoiler":
+        return "センシティブ発言"
+    if kind == "url":
+        return "リンク省略"
+    if kind == "emoji":
+        return match.group("emoji_name") if TTS_EMOJI == "name" else ""
+    if kind == "user":
+        if not guild:
+            return "誰か"
+        member_id = int(match.group("user_id"))
+        member = guild.get_member(member_id)
+        if member:
+            return member.display_name
+        return member_index.display_name(guild.id, member_id) or "誰か"
+    if kind == "role":
+        role = guild.get_role(int(match.group("role_id"))) if guild else None
+        return role.name if role else "ロール"
+    if kind == "channel":
+        channel = guild.get_channel(int(match.group("channel_id"))) if guild else None
+        return channel.name if channel else "チャンネル"
+    if kind == "timestamp":
+        try:
+            moment = datetime.fromtimestamp(int(match.group("unix_time")))
+        except (OverflowError, OSError, ValueError):
+            return ""
+        return f"{moment.month}月{moment.day}日{moment.hour}時{moment.minute}分"
+    if kind == "repeat":
+        return match.group("char") * TTS_REPEAT_MAX
+    if kind == "space":
+        # 改行は文の区切りとして残す
+        return "\n" if "\n" in match.group() else " "
+    return ""
+
+def normalize_tts_text(text, guild=None, max_length=TTS_MAX_LENGTH):
+    # URL・メンション・絵文字などを読み上げ用に置き換える
+    # 最大文字数に達した時点で走査を打ち切るため、長文でもVOICEVOXに送る量と処理時間が一定に収まる
+    parts = []
+    length = 0
+    position = 0
+    truncated = False
+    for match in NORMALIZE_PATTERN.finditer(text):
+        if match.start() > position:
+            parts.append(text[position:match.start()])
+            length += match.start() - position
+        replacement = _normalize_replacement(match, guild)
+        parts.append(replacement)
+        length += len(replacement)
+        position = match.end()
+        if length > max_length:
+            truncated = True
+            break
+    else:
+        parts.append(text[position:])
+
+    result = "".join(parts).strip()
+    if truncated or len(result) > max_length:
+        result = result[:max_length].rstrip() + " 以下略"
+    return result
+
+# ---------------------------------------------------------
+# ユーザー辞書の一括登録・同期
+# ---------------------------------------------------------
+KATAKANA_PATTERN = re.compile(r"^[ァ-ヴー]+$")
+DICT_IMPORT_CHUNK = 500
+# 辞書の変更 (エンジンへの登録と手元への保存) と同期が交互に進まないようにする
+# (登録の途中で同期すると、まだ手元に無い単語をエンジンから消してしまう)
+dict_lock = asyncio.Lock()
+
+def parse_dictionary_file(filename, text):
+    # 戻り値: ([(単語, 読み, アクセント型, 優先度), ...], エラー行のリスト)
+    # CSV: 単語,読み[,アクセント型[,優先度]] (見出し行は任意)
+    # JSON: [{"surface", "pronunciation", "accent_type", "priority"}, ...] / {単語: 読み} / VOICEVOXのエクスポート形式
+    rows = []
+    if filename.lower().endswith(".json"):
+        data = json.loads(text)
+        if isinstance(data, dict):
+            for key, value in data.items():
+                if isinstance(value, dict):
+                    rows.append((value.get("surface", key), value.get("pronunciation"), value.get("accent_type", 0), value.get("priority", 5)))
+                else:
+                    rows.append((key, value, 0, 5))
+        else:
+            for item in data:
+                rows.append((item.get("surface"), item.get("pronunciation"), item.get("accent_type", 0), item.get("priority", 5)))
+    else:
+        for record in csv.reader(StringIO(text)):
+            if not record or record[0].strip().lower() in ["surface", "word", "単語"]:
+                continue
+            record = [field.strip() for field in record] + ["", ""]
+            rows.append((record[0], record[1], record[2] or 0, record[3] or 5))
+
+    entries = []
+    errors = []
+    for surface, pronunciation, accent_type, priority in rows:
+        try:
+            accent_type = int(accent_type)
+            priority = int(priority)
+        except (TypeError, ValueError):
+            errors.append(str(surface))
+            continue
+        if not surface or not pronunciation or not KATAKANA_PATTERN.match(pronunciation) \
+                or accent_type < 0 or not 0 <= priority <= 10:
+            errors.append(str(surface))
+            continue
+        entries.append((surface, pronunciation, accent_type, priority))
+    return entries, errors
+
+async def import_dictionary_entries(entries):
+    # 既存の単語は同じUUIDで上書きし、VOICEVOXへはまとめて登録する
+    # 同じ単語がファイル内に複数あれば最後の行を使う (行ごとにUUIDを振ると、手元に残らない分がエンジンに残ってしまう)
+    # 戻り値: 登録した単語数
+    entries = {entry[0]: entry for entry in entries}.values()
+    async with dict_lock:
+        rows = []
+        for surface, pronunciation, accent_type, priority in entries:
+            existing = settings_store.user_dict.get(surface)
+            word_uuid = existing["uuid"] if existing else str(uuid.uuid4())
+            rows.append((surface, word_uuid, pronunciation, accent_type, priority))
+
+        for start in range(0, len(rows), DICT_IMPORT_CHUNK):
+            chunk = rows[start:start + DICT_IMPORT_CHUNK]
+            await voicevox.import_user_dict({
+                word_uuid: build_user_dict_word(surface, pronunciation, accent_type, priority)
+                for surface, word_uuid, pronunciation, accent_type, priority in chunk
+            })
+            await settings_store.set_dict_words(chunk)
+    return len(rows)
+
+async def sync_user_dict(node):
+    async with dict_lock:
+        await _sync_user_dict(node)
+
+async def _sync_user_dict(node):
+    # VOICEVOXのコンテナが作り直されても辞書が消えないよう、手元の辞書との差分だけを登録し直す
+    # 停止中に !delete された単語はそのエンジンに残っているため、手元に無い単語はエンジンから消す
+    started = time.perf_counter()
+    node.needs_dict_sync = False
+    remote = await node.get_user_dict()
+
+    local_uuids = {entry["uuid"] for entry in settings_store.user_dict.values()}
+    stale = [word_uuid for word_uuid in remote if word_uuid not in local_uuids]
+    for word_uuid in stale:
+        try:
+            await node.delete_user_dict_word(word_uuid)
+        except aiohttp.ClientResponseError as e:
+            # 同期の途中で既に消えている
+            if e.status not in (404, 422):
+                raise
+
+    missing = {}
+    backfill = []
+    unrecoverable = 0
+    for word, entry in settings_store.user_dict.items():
+        remote_word = remote.get(entry["uuid"])
+        if remote_word is None:
+            if entry["pronunciation"]:
+                missing[entry["uuid"]] = build_user_dict_word(word, entry["pronunciation"], entry["accent_type"], entry["priority"])
+            else:
+                # 読みを保存していなかった頃の単語は復元できない
+                unrecoverable += 1
+        elif not entry["pronunciation"]:
+            backfill.append((word, entry["uuid"], remote_word["pronunciation"], remote_word["accent_type"], remote_word.get("priority", 5)))
+
+    for start in range(0, len(missing), DICT_IMPORT_CHUNK):
+        chunk = dict(itertools.islice(missing.items(), start, start + DICT_IMPORT_CHUNK))
+        await node.import_user_dict(chunk)
+    if backfill:
+        await settings_store.set_dict_words(backfill)
+    if missing or stale:
+        tts_cache.invalidate()
+        await asyncio.to_thread(tts_cache.clear_disk)
+
+    logging.info(
+        f"辞書を同期しました ({node.base_url}): 登録 {len(missing)}件 / 削除 {len(stale)}件 / 読みの補完 {len(backfill)}件 / 復元不可 {unrecoverable}件 "
+        f"(手元 {len(settings_store.user_dict)}件 / エンジン {len(remote)}件) / {time.perf_counter() - started:.2f}秒"
+    )
+
+startup_tasks_started = False
+
+async def resync_engine(node):
+    try:
+        await sync_user_dict(node)
+    except Exception as e:
+        node.needs_dict_sync = True
+        logging.error(f"Dictionary sync error ({node.base_url}): {e}")
+
+async def run_startup_tasks():
+    # 応答するエンジンの辞書の同期が終わってから定型文を事前合成する (読みが変わる可能性があるため)
+    await voicevox.check_health()
+    await asyncio.gather(*(resync_engine(node) for node in voicevox.nodes if node.healthy))
+    voicevox.on_recovered = lambda node: asyncio.create_task(resync_engine(node))
+    voicevox.start_health_checks()
+    schedule_warmup()
+    if SESSION_RESUME:
+        asyncio.create_task(checkpoint_sessions())
+
+# ---------------------------------------------------------
+# セッションの復元 (再起動・ボイス接続の切断後)
+# ---------------------------------------------------------
+# ボイス接続が切れてから、discord.py自身の再接続を待つ秒数
+VOICE_RECOVERY_GRACE = 3.0
+
+recovery_tasks = {}
+
+class AgoraVoiceClient(discord.VoiceClient):
+    # チャンネルなしのボイス状態が届いた時、discord.py自身の再接続・切断によるもの (予期したもの) かどうかを記録する。
+    # この判定はdiscord.pyの処理の中で消えてしまうため、処理に渡す前に見ておく
+    # (イベントの on_voice_state_update より先に呼ばれる)
+    async def on_voice_state_update(self, data):
+        if data["channel_id"] is None and not self._connection._expecting_disconnect:
+            session = sessions.get(self.guild.id)
+            if session is not None:
+                session.disconnected_externally = True
+        await super().on_voice_state_update(data)
+
+def start_recovery(guild_id, coroutine):
+    # ギルドごとに同時に1つだけ復元を行う
+    task = recovery_tasks.get(guild_id)
+    if task is not None and not task.done():
+        coroutine.close()
+        return
+    recovery_tasks[guild_id] = asyncio.create_task(coroutine)
+
+def has_listeners(voice_channel):
+    return any(not member.bot for member in voice_channel.members)
+
+async def reconnect_voice(guild, voice_channel):
+    # 戻り値: 接続できたか (失敗したら間隔を空けて SESSION_RESUME_ATTEMPTS 回まで試す)
+    for attempt in range(SESSION_RESUME_ATTEMPTS):
+        try:
+            voice_client = guild.voice_client
+            if voice_client and not voice_client.is_connected():
+                await voice_client.disconnect(force=True)
+            if guild.voice_client:
+                await guild.voice_client.move_to(voice_channel)
+            else:
+                await voice_channel.connect(cls=AgoraVoiceClient)
+            return True
+        except Exception as e:
+            logging.warning(f"Voice reconnect error ({guild.name}, {attempt + 1}/{SESSION_RESUME_ATTEMPTS}): {e}")
+            await asyncio.sleep(2 ** attempt)
+    return False
+
+async def restore_session(guild, state, reason, started):
+    voice_channel = guild.get_channel(state["voice_channel_id"])
+    text_channel = guild.get_channel(state["text_channel_id"])
+    # チャンネルが消えた・誰もいなくなった場合は復元しない
+    if voice_channel is None or text_channel is None or not has_listeners(voice_channel):
+        close_session(guild)
+        await update_status()
+        return
+
+    if not await reconnect_voice(guild, voice_channel):
+        close_session(guild)
+        await update_status()
+        await text_channel.send("ボイスチャンネルに再接続できませんでした。`!join` で接続し直してください。")
+        return
+
+    # 切断からの復旧ならキューはメモリに残っている。再起動後は保存した曲を続きから並べ直す
+    restarted = guild.id not in sessions
+    session = open_session(guild, text_channel)
+    if restarted:
+        tracks = []
+        current = state.get("current")
+        if current:
+            tracks.append(Track(current["url"], current["title"], current["requested_by"], start=current.get("position", 0.0)))
+        tracks.extend(Track(**entry) for entry in state.get("queue", []))
+        session.music_queue.add(tracks)
+
+    elapsed = time.perf_counter() - started
+    METRIC_SESSION_RECOVERY.observe(elapsed, reason=reason)
+    logging.info(f"セッションを復元しました ({guild.name}, {reason}): {elapsed:.2f}秒 / 再生キュー {len(session.music_queue.tracks)}曲")
+    await update_status()
+    await generate_and_play_tts(guild.voice_client, "再接続しました", CHARACTER_MAP[DEFAULT_CHARACTER])
+
+async def restore_sessions():
+    # on_ready (再起動後・Gatewayへの再接続後) に、接続していないセッションをまとめて復元する
+    guild_ids = list(dict.fromkeys([*settings_store.voice_sessions, *sessions]))
+    for guild_id in guild_ids:
+        guild = bot.get_guild(guild_id)
+        session = sessions.get(guild_id)
+        if guild is None:
+            await settings_store.delete_voice_session(guild_id)
+            continue
+        if session is not None:
+            if not session.connected:
+                start_recovery(guild_id, restore_session(guild, session.snapshot(), "gateway", time.perf_counter()))
+            continue
+        state, updated_at = settings_store.voice_sessions[guild_id]
+        age = time.time() - updated_at
+        if age > SESSION_MAX_AGE:
+            logging.info(f"前回のセッションは古いため復元しません ({guild.name}): 前回の保存から {age:.0f}秒")
+            await settings_store.delete_voice_session(guild_id)
+            continue
+        logging.info(f"前回のセッションを復元します ({guild.name}): 前回の保存から {age:.0f}秒")
+        start_recovery(guild_id, restore_session(guild, state, "restart", STARTUP_STARTED))
+
+async def recover_voice(guild):
+    # discord.py自身が再接続を試みている間は任せ、諦めて接続を破棄した (guild.voice_client がなくなった) 場合だけ接続し直す
+    started = time.perf_counter()
+    while True:
+        await asyncio.sleep(VOICE_RECOVERY_GRACE)
+        session = sessions.get(guild.id)
+        if session is None or session.connected or bot.is_closed():
+            return
+        if guild.voice_client is None:
+            break
+    await restore_session(guild, session.snapshot(), "disconnect", started)
+
+async def on_own_voice_state_update(guild, before, after):
+    session = sessions.get(guild.id)
+    if session is None:
+        return
+    if after.channel is not None:
+        # 管理者に移動された場合など
+        if session.voice_channel_id != after.channel.id:
+            session.voice_channel_id = after.channel.id
+            session.checkpoint()
+        return
+    # 外から切断された場合は、切断されたままにする (保存したセッションも消す)
+    if session.disconnected_externally:
+        logging.info(f"ボイスチャンネルから切断されました ({guild.name})")
+        close_session(guild)
+        await update_status()
+        return
+    # !leave や自動切断では先にセッションを閉じるため、ここに来るのはdiscord.py自身の再接続の途中か、再接続の失敗
+    if SESSION_RESUME and not bot.is_closed():
+        logging.warning(f"ボイス接続が切れました ({guild.name})")
+        start_recovery(guild.id, recover_voice(guild))
+
+async def checkpoint_sessions():
+    # 再生中の曲の位置を定期的に保存する (キューなどの変化はその都度 GuildSession.checkpoint で保存する)
+    while True:
+        await asyncio.sleep(SESSION_CHECKPOINT_INTERVAL)
+        for session in list(sessions.values()):
+            if session.music_queue.current_input is not None:
+                session.checkpoint()
+
 # ---------------------------------------------------------
 # イベント
 # ---------------------------------------------------------
@@ -180,6 +3156,47 @@ async def on_ready():
     if MAINTENANCE_MODE:
         logging.warning("現在メンテナンスモードで動作しています。")
     await update_status()
+    # on_readyは再接続のたびに呼ばれるため、初回のみ辞書の同期と事前合成を行う
+    global startup_tasks_started
+    if not startup_tasks_started:
+        startup_tasks_started = True
+        mark_startup_phase("ready")
+        for phase, seconds in startup_phases:
+            METRIC_STARTUP.set(seconds, phase=phase)
+        timings = " / ".join(f"{phase} {seconds:.2f}秒" for phase, seconds in startup_phases)
+        logging.info(f"起動時間: {timings} (合計 {time.perf_counter() - STARTUP_STARTED:.2f}秒)")
+        asyncio.create_task(run_startup_tasks())
+        asyncio.create_task(asyncio.to_thread(saved_index.evict))
+    # メンテナンス中は復元せず、保存したセッションはそのまま残しておく
+    if SESSION_RESUME and not MAINTENANCE_MODE:
+        await restore_sessions()
+    if MEMBER_INDEX_PRELOAD:
+        asyncio.create_task(preload_member_index(bot.guilds))
+
+@bot.event
+async def on_guild_join(guild):
+    if MEMBER_INDEX_PRELOAD:
+        asyncio.create_task(preload_member_index([guild]))
+
+@bot.event
+async def on_guild_remove(guild):
+    member_index.forget(guild.id)
+
+@bot.event
+async def on_member_join(member):
+    member_index.add(member)
+
+@bot.event
+async def on_member_update(before, after):
+    member_index.add(after)
+
+@bot.event
+async def on_user_update(before, after):
+    member_index.update_user(after)
+
+@bot.event
+async def on_raw_member_remove(payload):
+    member_index.remove(payload.guild_id, payload.user.id)
 
 @bot.event
 async def on_message(message):
@@ -199,92 +3216,174 @@ async def on_message(message):
     # 以下、通常時の処理
     await bot.process_commands(message)
 
-    if (not message.guild or 
-        active_text_channel != message.channel):
+    if not message.guild:
+        return
+
+    # キャッシュしていないメンバーの名前の変更は届かないため、発言のたびに索引を最新にしておく
+    member_index.add(message.author)
+
+    session = sessions.get(message.guild.id)
+    if not session or session.text_channel != message.channel:
         return
     
-    if not (message.guild.voice_client and message.guild.voice_client.is_connected()):
+    if not (session.voice_client and session.voice_client.is_connected()):
         return
 
     if message.content.startswith(bot.command_prefix):
         return
 
+    # ここから先のログと、読み上げキューに積んだ発言にトレースIDを付ける
+    trace_id_var.set(new_trace_id())
+    message_received_var.set(time.perf_counter())
     tts_text = ""
     try:
         if message.attachments:
             for attachment in message.attachments:
                 file_type = classify_attachment(attachment.filename)
                 if file_type == "音声":
-                    if AUDIOPLAY:
+                    audioplay = settings_store.get_guild_setting(message.guild.id, "audioplay", AUDIOPLAY)
+                    if audioplay and attachment.size <= ATTACHMENT_MAX_MB * 1024 * 1024:
                         tts_text = "添付された音声ファイルを再生します"
-                        await generate_and_play_tts(message.guild.voice_client, tts_text, CHARACTER_MAP[DEFAULT_CHARACTER])
-                        await play_audio_from_url(message.guild.voice_client, attachment.url)
+                        await generate_and_play_tts(session.voice_client, tts_text, CHARACTER_MAP[DEFAULT_CHARACTER])
+                        await play_audio_from_url(session.voice_client, attachment.url)
                         return
                     else:
+                        if audioplay:
+                            await message.channel.send(f"音声ファイルが大きすぎるため再生できません。(上限 {ATTACHMENT_MAX_MB} MB)")
                         tts_text = "音声ファイル添付"
                 else:
                     tts_text = f"{file_type}ファイル添付"
-        elif any(word.startswith("http") for word in message.content.split()):
-            tts_text = "リンク省略"
-        elif any(word.startswith("||") for word in message.content.split()):
-            tts_text = "センシティブ発言"
         else:
-            tts_text = message.content
+            tts_text = normalize_tts_text(message.content, message.guild)
 
         if not tts_text:
             return
 
-        user_id = str(message.author.id)
-        style_id = user_character.get(user_id, CHARACTER_MAP[DEFAULT_CHARACTER])
+        style_id = settings_store.get_user_style(message.author.id, CHARACTER_MAP[DEFAULT_CHARACTER])
         
-        await generate_and_play_tts(message.guild.voice_client, tts_text, style_id)
+        await generate_and_play_tts(session.voice_client, tts_text, style_id)
 
     except Exception as e:
         logging.error(f"on_message Error: {e}")
 
-async def generate_and_play_tts(voice_client, text, character_id):
-    if not voice_client or not voice_client.is_connected():
-        return
-
-    temp_filename = f"tts_{uuid.uuid4()}.wav"
-    temp_path = BASE_PATH / temp_filename
-
-    try:
-        if AprilFool:
-            tts = gTTS(text, lang="en")
-            tts.save(str(temp_path))
+async def synthesize_pcm(text, character_id, pin=False):
+    # キャッシュ(メモリ → ディスク)を確認し、無ければVOICEVOXで合成する
+    key = tts_cache.make_key(text, character_id)
+    pcm = tts_cache.get(key)
+    if pcm is not None:
+        return pcm
+
+    started = time.perf_counter()
+    wav_data = await asyncio.to_thread(tts_cache.load_disk, key)
+    from_disk = wav_data is not None
+    if not from_disk:
+        tts_cache.misses += 1
+        wav_data = await voicevox.synthesize(key[0], character_id)
+    pcm = await asyncio.to_thread(wav_to_pcm, wav_data)
+
+    if pin:
+        tts_cache.pin(key, pcm, time.perf_counter() - started)
+    else:
+        tts_cache.put(key, pcm, time.perf_counter() - started)
+    if not from_disk:
+        await asyncio.to_thread(tts_cache.store_disk, key, wav_data)
+    return pcm
+
+def write_gtts(text, fp):
+    # エイプリルフールの日にしか使わないため、gTTSは初回の呼び出し時に (作業スレッドで) 読み込む
+    from gtts import gTTS
+    gTTS(text, lang="en").write_to_fp(fp)
+
+async def create_tts_source(text, character_id, april_fool=False):
+    if april_fool:
+        # gTTSはMP3を返すため、メモリ上のデータをパイプでffmpegに渡してデコードする
+        mp3_data = BytesIO()
+        await asyncio.to_thread(write_gtts, text, mp3_data)
+        mp3_data.seek(0)
+        return discord.FFmpegPCMAudio(mp3_data, pipe=True)
+
+    chunks = split_sentences(text) if TTS_STREAMING else [text]
+    if len(chunks) <= 1:
+        pcm = await synthesize_pcm(text, character_id)
+        return PCMAudioSource(pcm)
+    return await create_streaming_source(chunks, character_id)
+
+SENTENCE_PATTERN = re.compile(r"[^。！？!?\n]*(?:[。！？!?]+|\n+|$)")
+
+def split_sentences(text, min_length=TTS_CHUNK_MIN_LENGTH):
+    # 。！？と改行で区切る (VOICEVOXへのリクエスト数が増えすぎないよう、短い文は次の文と結合する)
+    chunks = []
+    for sentence in SENTENCE_PATTERN.findall(text):
+        sentence = sentence.strip()
+        if not sentence:
+            continue
+        if chunks and len(chunks[-1]) < min_length:
+            separator = "" if chunks[-1][-1] in "。！？!?、" else "、"
+            chunks[-1] = f"{chunks[-1]}{separator}{sentence}"
         else:
-            encoded_text = urllib.parse.quote(text)
-            query_res = requests.post(f"{VOICEVOX_URL}/audio_query?text={encoded_text}&speaker={character_id}")
-            query_res.raise_for_status()
-            audio_query = query_res.json()
-
-            syn_res = requests.post(f"{VOICEVOX_URL}/synthesis?speaker={character_id}&enable_interrogative_upspeak=true", json=audio_query)
-            syn_res.raise_for_status()
-            
-            with open(temp_path, 'wb') as f:
-                f.write(syn_res.content)
-        
-        source = discord.FFmpegPCMAudio(str(temp_path))
-        play_mixed(voice_client, source)
+            chunks.append(sentence)
+    return chunks
 
+async def create_streaming_source(chunks, character_id):
+    # 全ての文の合成を一度に開始し (同時数はVOICEVOXクライアント側で制限)、最初の文が揃った時点でソースを返す
+    tasks = [asyncio.create_task(synthesize_pcm(chunk, character_id)) for chunk in chunks]
+    try:
+        first_pcm = await tasks[0]
+    except BaseException:
+        _cancel_tasks(tasks)
+        raise
+
+    source = StreamingPCMSource()
+    source.feed(first_pcm)
+    feeder = asyncio.create_task(_feed_streaming_source(source, tasks[1:]))
+    # 再生スレッドや読み上げキューから破棄された場合は残りの合成を止める
+    loop = asyncio.get_running_loop()
+    source.on_cleanup = lambda: loop.call_soon_threadsafe(feeder.cancel)
+    return source
+
+async def _feed_streaming_source(source, tasks):
+    try:
+        for task in tasks:
+            source.feed(await task)
+    except asyncio.CancelledError:
+        raise
     except Exception as e:
-        logging.error(f"TTS Error: {e}")
-        if active_text_channel:
-            await active_text_channel.send("ズモモエラー！！")
+        # 途中の文で失敗した場合は、そこまでの音声で打ち切る
+        logging.error(f"Streaming TTS Error: {e}")
+    finally:
+        _cancel_tasks(tasks)
+        source.finish()
+
+def _cancel_tasks(tasks):
+    for task in tasks:
+        if not task.done():
+            task.cancel()
+        elif not task.cancelled():
+            # 未取得の例外の警告を出さないよう結果を回収しておく
+            task.exception()
+
+async def generate_and_play_tts(voice_client, text, character_id):
+    # 合成・再生は読み上げキューが発言順に行う
+    if not voice_client or not voice_client.is_connected():
+        return
+    session = sessions.get(voice_client.guild.id)
+    if session:
+        session.tts_queue.put(text, character_id)
 
 async def play_audio_from_url(voice_client, url):
+    session = sessions.get(voice_client.guild.id)
     try:
-        res = requests.get(url, stream=True)
-        res.raise_for_status()
-        audio_data = BytesIO(res.content)
-        
-        source = discord.FFmpegPCMAudio(audio_data, pipe=True)
-        play_mixed(voice_client, source)
+        # ダウンロードはせず、ffmpegにCDNのURLを直接読ませて届いた分から再生する
+        ffmpeg_opts = {
+            "before_options": "-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5 -probesize 64k -analyzeduration 0",
+            "options": f"-vn -t {ATTACHMENT_MAX_SECONDS}",
+        }
+        source = discord.FFmpegPCMAudio(url, **ffmpeg_opts)
+        play_mixed(voice_client, source, kind=MUSIC)
 
     except Exception as e:
-        if active_text_channel:
-            await active_text_channel.send(f"ズモモエラー！！音声再生エラーだ！")
+        if session:
+            await session.text_channel.send(f"ズモモエラー！！音声再生エラーだ！")
         logging.error(f"Audio URL Playback Error: {e}")
 
 # ---------------------------------------------------------
@@ -292,21 +3391,12 @@ async def play_audio_from_url(voice_client, url):
 # ---------------------------------------------------------
 @bot.command()
 async def join(ctx):
-    global active_text_channel
-    global user_character
-    
     if not ctx.author.voice:
         await ctx.send("ボイスチャンネルに接続してからコマンドを実行してください。")
         return
 
     target_channel = ctx.author.voice.channel
 
-    for vc in bot.voice_clients:
-        if vc.guild != ctx.guild:
-            await ctx.send(f"現在、別のサーバーで使用中のため接続できません。")
-            logging.info(f"Join refused: Active in {vc.guild.name}")
-            return
-
     try:
         voice_client = ctx.guild.voice_client
 
@@ -317,19 +3407,10 @@ async def join(ctx):
             else:
                 await ctx.send(f"既に「{target_channel.name}」に接続しています。")
         else:
-            await target_channel.connect()
+            await target_channel.connect(cls=AgoraVoiceClient)
             await ctx.send(f"ボイスチャンネル「 {target_channel.name} 」に接続しました！ｷﾀ━━━━(ﾟ∀ﾟ)━━━━!!")
 
-        active_text_channel = ctx.channel
-        
-        if USER_CHAR_PATH.exists():
-            try:
-                with open(USER_CHAR_PATH, "r", encoding="utf-8") as f:
-                    user_character = json.load(f)
-            except json.JSONDecodeError:
-                user_character = {}
-        else:
-            user_character = {}
+        open_session(ctx.guild, ctx.channel)
 
         await update_status()
         await generate_and_play_tts(ctx.guild.voice_client, "接続しました", CHARACTER_MAP[DEFAULT_CHARACTER])
@@ -340,11 +3421,10 @@ async def join(ctx):
 
 @bot.command()
 async def leave(ctx):
-    global active_text_channel
     if ctx.voice_client:
+        close_session(ctx.guild)
         await ctx.voice_client.disconnect()
         await ctx.send("切断しました！─=≡Σ((( つ•̀ω•́)つ")
-        active_text_channel = None
         await update_status()
     else:
         await ctx.send("Botはボイスチャンネルに接続していません。")
@@ -352,26 +3432,51 @@ async def leave(ctx):
 @bot.command()
 async def stop(ctx):
     if ctx.voice_client:
+        if ctx.guild.id in sessions:
+            sessions[ctx.guild.id].tts_queue.clear()
+            sessions[ctx.guild.id].music_queue.clear()
+            sessions[ctx.guild.id].music_queue.skip()
         ctx.voice_client.stop()
         await ctx.send("再生を停止しました。")
     else:
         await ctx.send("再生中の音声がありません。")
 
+@bot.command()
+async def volume(ctx, *args):
+    session = sessions.get(ctx.guild.id)
+    if not session:
+        await ctx.send("Botはボイスチャンネルに接続していません。")
+        return
+
+    # `!volume 80` は全体音量、`!volume music 50` は種類ごとの音量
+    targets = {"master": "全体", MUSIC: "音楽", SPEECH: "読み上げ"}
+    if len(args) == 1:
+        target, level = "master", args[0]
+    elif len(args) == 2:
+        target, level = args
+    else:
+        current = " / ".join(f"{label}: {int(session.volumes[key] * 100)}%" for key, label in targets.items())
+        await ctx.send(f"現在の音量 {current}")
+        return
+
+    if target not in targets or not level.isdigit() or not 0 <= int(level) <= MAX_GAIN * 100:
+        await ctx.send(f"使い方: `!volume [master|music|speech] <0〜{int(MAX_GAIN * 100)}>`")
+        return
+
+    session.set_volume(target, int(level) / 100)
+    await settings_store.set_guild_setting(ctx.guild.id, "volumes", session.volumes)
+    await ctx.send(f"{targets[target]}の音量を{int(level)}%に設定しました。")
+
 @bot.command()
 async def audioplay(ctx, state: str):
-    global AUDIOPLAY
     state_bool = state.lower() == "true"
     if state.lower() not in ["true", "false"]:
         await ctx.send("無効な設定です。")
         return
 
     try:
-        with open(CONFIG_PATH, encoding="utf-8") as f:
-            data = yaml.safe_load(f)
-        data["audioplay"] = state_bool
-        AUDIOPLAY = state_bool
-        with open(CONFIG_PATH, mode="w", encoding="utf-8") as f:
-            yaml.safe_dump(data, f, allow_unicode=True, indent=4)
+        # サーバーごとの設定として保存する (config.yamlのaudioplayは既定値)
+        await settings_store.set_guild_setting(ctx.guild.id, "audioplay", state_bool)
         msg = "再生する" if state_bool else "再生しない"
         await ctx.send(f"音声ファイルの再生設定を「{msg}」に変更しました。")
     except Exception as e:
@@ -379,40 +3484,36 @@ async def audioplay(ctx, state: str):
 
 @bot.command()
 async def set(ctx, target_name: str, character_name: str):
-    global user_character
-
     # 1. キャラクター名の存在確認
     if character_name not in CHARACTER_MAP:
         await ctx.send(f"キャラクター名「{character_name}」は存在しません。`!char` で一覧を確認してください。")
         return
 
     # 2. ユーザー（メンバー）の検索
-    # サーバー内のメンバーから、表示名(display_name) または ユーザー名(name) が一致する人を探す
-    target_member = discord.utils.find(
-        lambda m: m.display_name == target_name or m.name == target_name, 
-        ctx.guild.members
-    )
+    # メンション・ユーザーID・名前 (表示名 / ユーザー名。完全一致 → 前方一致 → あいまい一致) で探す
+    try:
+        candidates = await resolve_member(ctx, target_name)
+    except Exception as e:
+        await ctx.send("ユーザーの検索に失敗しました。")
+        logging.error(f"Member search error: {e}")
+        return
 
-    if not target_member:
+    if not candidates:
         await ctx.send(f"ユーザー「{target_name}」が見つかりませんでした。\n※名前にスペースが含まれる場合は `\"名前\"` のように引用符で囲ってください。")
         return
+    if len(candidates) > 1:
+        names = "\n".join(f"・{name} (`{member_id}`)" for member_id, name in candidates)
+        await ctx.send(f"「{target_name}」に当てはまるユーザーが複数います。メンションかユーザーIDで指定してください。\n{names}")
+        return
+    target_id, target_display_name = candidates[0]
 
     # 3. 設定の保存
     try:
-        if USER_CHAR_PATH.exists():
-            with open(USER_CHAR_PATH, "r", encoding="utf-8") as f:
-                user_character = json.load(f)
-        else:
-            user_character = {}
-
         # 見つかったメンバーのIDをキーにして保存
-        user_character[str(target_member.id)] = CHARACTER_MAP[character_name]
-        
-        with open(USER_CHAR_PATH, "w", encoding="utf-8") as f:
-            json.dump(user_character, f, ensure_ascii=False, indent=4)
+        await settings_store.set_user_style(target_id, CHARACTER_MAP[character_name])
         
-        await ctx.send(f"{target_member.display_name} さんのキャラクターを「{character_name}」に設定しました。")
-        logging.info(f"Set character for {target_member.display_name}: {character_name}")
+        await ctx.send(f"{target_display_name} さんのキャラクターを「{character_name}」に設定しました。")
+        logging.info(f"Set character for {target_display_name}: {character_name}")
 
     except Exception as e:
         await ctx.send("設定の保存に失敗しました。")
@@ -426,22 +3527,76 @@ async def char(ctx):
     embed = discord.Embed(title="使用可能なキャラクター一覧", description=char_list, color=0x00ff00)
     await ctx.send(embed=embed)
 
+@bot.command()
+async def cache(ctx):
+    stats = tts_cache.stats()
+    description = (
+        f"エントリ数: {stats['entries']} ({stats['bytes'] / 1024 / 1024:.1f} MB)\n"
+        f"事前合成済み定型文: {stats['pinned']} ({stats['pinned_bytes'] / 1024 / 1024:.1f} MB)\n"
+        f"ヒット: {stats['hits']} / ディスクヒット: {stats['disk_hits']} / ミス: {stats['misses']}\n"
+        f"ヒット率: {stats['hit_rate']:.1f}%\n"
+        f"追い出し: {stats['evictions']}\n"
+        f"節約した合成時間: {stats['saved_seconds']:.1f} 秒"
+    )
+    embed = discord.Embed(title="読み上げキャッシュ統計", description=description, color=0x00ff00)
+    await ctx.send(embed=embed)
+
+@bot.command()
+async def ttsqueue(ctx):
+    session = sessions.get(ctx.guild.id)
+    if not session:
+        await ctx.send("Botはボイスチャンネルに接続していません。")
+        return
+    tts_queue = session.tts_queue
+    stats = tts_queue.stats()
+    description = (
+        f"待機中: {stats['depth']} / 上限 {tts_queue.max_size} ({tts_queue.policy})\n"
+        f"再生済み: {stats['played']} / 破棄: {stats['dropped']} / 結合: {stats['merged']}\n"
+        f"待ち時間: 平均 {stats['avg_wait']:.2f} 秒 / 最大 {stats['max_wait']:.2f} 秒\n"
+        f"最初の音声まで: 平均 {stats['avg_first_audio']:.2f} 秒 / 最大 {stats['max_first_audio']:.2f} 秒"
+    )
+    embed = discord.Embed(title="読み上げキュー統計", description=description, color=0x00ff00)
+    await ctx.send(embed=embed)
+
+@bot.command()
+async def engines(ctx):
+    now = time.monotonic()
+    lines = []
+    for node in voicevox.nodes:
+        if not node.healthy:
+            state = "停止"
+        elif not node.is_available(now):
+            state = f"切り離し中 (残り {node.open_until - now:.0f} 秒)"
+        else:
+            state = "正常"
+        lines.append(
+            f"**{node.base_url}** (重み {node.weight}): {state}\n"
+            f"処理中: {node.in_flight} / リクエスト: {node.requests} / 失敗: {node.failures} / version: {node.version or '-'}"
+        )
+    embed = discord.Embed(title="VOICEVOXエンジン", description="\n".join(lines), color=0x00ff00)
+    await ctx.send(embed=embed)
+
+@bot.command()
+async def stalls(ctx):
+    sites = loop_watchdog.top_sites()
+    if not sites:
+        await ctx.send(f"イベントループの停止 ({STALL_THRESHOLD_MS}ms以上) は記録されていません。")
+        return
+    lines = [
+        f"`{site}`: {count}回 / 合計 {total:.2f} 秒 / 最大 {longest:.2f} 秒"
+        for site, (count, total, longest) in sites
+    ]
+    embed = discord.Embed(title=f"イベントループの停止 ({STALL_THRESHOLD_MS}ms以上)", description="\n".join(lines), color=0x00ff00)
+    await ctx.send(embed=embed)
+
 @bot.command()
 async def add(ctx, word: str, pronunciation: str):
     try:
-        if DICT_PATH.exists():
-            with open(DICT_PATH, "r", encoding="utf-8") as f:
-                data = json.load(f)
-        else:
-            data = {}
-
-        new_data = {"surface": word, "pronunciation": pronunciation, "accent_type": 0}
-        res = requests.post(f"{VOICEVOX_URL}/user_dict_word", params=new_data)
-        res.raise_for_status()
-        uuid_val = json.loads(res.text)
-        data[word] = uuid_val
-        with open(DICT_PATH, "w", encoding="utf-8") as f:
-            json.dump(data, f, ensure_ascii=False, indent=4)
+        async with dict_lock:
+            existing = settings_store.user_dict.get(word)
+            uuid_val = await voicevox.add_user_dict_word(word, pronunciation, 0, existing["uuid"] if existing else None)
+            await settings_store.set_dict_word(word, uuid_val, pronunciation, 0)
+        await on_dictionary_changed()
         await ctx.send(f"`{word}` を `{pronunciation}`として登録しました。")
     except Exception as e:
         await ctx.send("ズモモエラー！！辞書エラーが出たぞ！人間！対応しろ！")
@@ -450,24 +3605,54 @@ async def add(ctx, word: str, pronunciation: str):
 @bot.command()
 async def delete(ctx, word: str):
     try:
-        if not DICT_PATH.exists():
-            await ctx.send(f"`{word}` は辞書に存在しません。")
-            return
-        with open(DICT_PATH, "r", encoding="utf-8") as f:
-            data = json.load(f)
-        if word not in data:
+        entry = settings_store.user_dict.get(word)
+        if entry is None:
             await ctx.send(f"`{word}` は辞書に存在しません。")
             return
-        res = requests.delete(f"{VOICEVOX_URL}/user_dict_word/{data[word]}")
-        res.raise_for_status()
-        del data[word]
-        with open(DICT_PATH, "w", encoding="utf-8") as f:
-            json.dump(data, f, ensure_ascii=False, indent=4)
+        async with dict_lock:
+            await voicevox.delete_user_dict_word(entry["uuid"])
+            await settings_store.delete_dict_word(word)
+        await on_dictionary_changed()
         await ctx.send(f"`{word}` を辞書から削除しました。")
     except Exception as e:
         await ctx.send("ズモモエラー！！辞書エラーが出たぞ！人間！対応しろ！")
         logging.error(f"Delete dictionary error: {e}")
 
+@bot.command()
+async def dictimport(ctx):
+    if not ctx.message.attachments:
+        await ctx.send("CSVまたはJSONファイルを添付してください。(CSV: `単語,カタカナ読み,アクセント型,優先度`)")
+        return
+
+    attachment = ctx.message.attachments[0]
+    async with ctx.typing():
+        try:
+            started = time.perf_counter()
+            text = (await attachment.read()).decode("utf-8-sig")
+            entries, errors = await asyncio.to_thread(parse_dictionary_file, attachment.filename, text)
+            count = 0
+            if entries:
+                count = await import_dictionary_entries(entries)
+                await on_dictionary_changed()
+
+            message = f"{count}件の単語を登録しました。({time.perf_counter() - started:.1f}秒)"
+            if errors:
+                message += f"\n読み込めなかった行: {len(errors)}件 (例: {', '.join(errors[:5])})"
+            await ctx.send(message)
+        except Exception as e:
+            await ctx.send("ズモモエラー！！辞書エラーが出たぞ！人間！対応しろ！")
+            logging.error(f"Dictionary import error: {e}")
+
+@bot.command()
+async def dictexport(ctx):
+    output = StringIO()
+    writer = csv.writer(output)
+    writer.writerow(["surface", "pronunciation", "accent_type", "priority"])
+    for word, entry in sorted(settings_store.user_dict.items()):
+        writer.writerow([word, entry["pronunciation"] or "", entry["accent_type"], entry["priority"]])
+    data = BytesIO(output.getvalue().encode("utf-8-sig"))
+    await ctx.send(f"{len(settings_store.user_dict)}件の単語を書き出しました。", file=discord.File(data, filename="user_dict.csv"))
+
 @bot.command()
 async def save(ctx, param: str, url: str):
     filename = str(uuid.uuid4())
@@ -521,40 +3706,43 @@ async def save(ctx, param: str, url: str):
         await ctx.send("video または audio を指定してください。")
         return
 
-    await ctx.send(f"ダウンロードを開始しました...")
+    kind = "audio" if target_dir == AUDIO_DIR else "video"
 
-    async with ctx.typing():
-        try:
-            # ダウンロード実行
-            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                ydl.download([url])
-            
-            saved_path = f"{target_dir}/{filename}.{ext}"
+    # 同じ動画・形式・画質を保存済みなら、ダウンロードせずに既存のファイルを返す
+    index_key = make_saved_key(normalize_source_url(url), kind, ydl_opts)
+    saved_name = await asyncio.to_thread(saved_index.lookup, index_key)
+    if saved_name:
+        await ctx.send(share_message(kind, saved_name))
+        return
 
-            # Nginxが読み取れるようにファイルのパーミッションを変更 (644)
-            try:
-                os.chmod(saved_path, 0o644)
-            except Exception as e:
-                logging.warning(f"Permission change failed: {e}")
-            
-            if DEVELOPER_MODE:
-                # .env から共有用URLのベースのみ取得
-                env_url_key = f"SHARE_{param.upper()}_URL"
-                share_url_base = os.getenv(env_url_key)
-
-                if share_url_base:
-                    # URLを結合して表示 (末尾のスラッシュ有無を考慮)
-                    share_url = share_url_base.rstrip('/') + f"/{filename}.{ext}"
-                    await ctx.send(f"以下のURLからダウンロードできます。\n{share_url}")
-                else:
-                    logging.warning(f"ENV variable {env_url_key} not found.")
-                    await ctx.send("ダウンロード完了。（公開用URL設定が見つかりませんでした）")
-            else:
-                await ctx.send(f"ダウンロード完了。サーバー内に保存されました。")
+    # 同じURL・形式のダウンロードが進行中なら、そのジョブの完了通知に相乗りする
+    job = download_manager.find_active((url, kind))
+    if job:
+        if ctx.channel not in job.channels:
+            job.channels.append(ctx.channel)
+        await ctx.send(f"同じダウンロードが進行中です。完了したらお知らせします。\n{job.describe()}")
+        return
 
-        except Exception as e:
-            await active_text_channel.send("ズモモエラー！！保存エラーが出たぞ！人間！対応しろ！")
-            logging.error(f"Save command error: {e}")
+    job = download_manager.submit(url, kind, filename, ext, ydl_opts, ctx.author.id, index_key)
+    job.channels.append(ctx.channel)
+    job.status_message = await ctx.send(job.describe())
+    asyncio.create_task(download_manager.run(job))
+
+@bot.command()
+async def jobs(ctx):
+    if not download_manager.jobs:
+        await ctx.send("ダウンロードジョブはありません。")
+        return
+    lines = [job.describe() for job in reversed(download_manager.jobs.values())]
+    embed = discord.Embed(title="ダウンロードジョブ一覧", description="\n".join(lines), color=0x00ff00)
+    await ctx.send(embed=embed)
+
+@bot.command()
+async def cancel(ctx, job_id: int):
+    if download_manager.cancel(job_id):
+        await ctx.send(f"ダウンロード #{job_id} のキャンセルを要求しました。")
+    else:
+        await ctx.send(f"実行中のダウンロード #{job_id} は見つかりませんでした。")
 
 @bot.command()
 async def play(ctx, url):
@@ -562,47 +3750,78 @@ async def play(ctx, url):
         await ctx.send("先にボイスチャンネルに接続してください。")
         return
 
+    session = sessions.get(ctx.guild.id)
+    if not session:
+        await ctx.send("Botはボイスチャンネルに接続していません。")
+        return
+
     async with ctx.typing():
         try:
-            ydl_opts = {
-                "format": "bestaudio/best",
-                "quiet": True,
-                "noplaylist": True,
-                "extract_flat": False,
-                "no_warnings": True
-            }
-            loop = asyncio.get_event_loop()
-            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                data = await loop.run_in_executor(None, lambda: ydl.extract_info(url, download=False))
-            
-            if "entries" in data: 
-                data = data["entries"][0]
-            
-            # HTTPヘッダーを構築
-            headers = ""
-            if "http_headers" in data:
-                for key, value in data["http_headers"].items():
-                    headers += f"{key}: {value}\r\n"
-            
-            ffmpeg_opts = {
-                "before_options": f"-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5 -headers {repr(headers)}",
-                "options": "-vn"
-            }
-            
-            await generate_and_play_tts(ctx.voice_client, "リンク先の音声を再生します", CHARACTER_MAP[DEFAULT_CHARACTER])
-            
-            source = discord.FFmpegPCMAudio(data["url"], **ffmpeg_opts)
-            play_mixed(ctx.voice_client, source)
-            
+            entries = await resolve_play_request(url)
+            if not entries:
+                await ctx.send("再生できる曲が見つかりませんでした。")
+                return
+
+            music_queue = session.music_queue
+            was_active = music_queue.active
+            added = music_queue.add([Track(page_url, title, ctx.author.display_name) for page_url, title in entries])
+
+            if not was_active and added:
+                await generate_and_play_tts(ctx.voice_client, "リンク先の音声を再生します", CHARACTER_MAP[DEFAULT_CHARACTER])
+            if added == 0:
+                await ctx.send(f"再生キューがいっぱいです。(上限 {music_queue.max_size} 曲)")
+            elif len(entries) > 1:
+                await ctx.send(f"プレイリストから {added} 曲をキューに追加しました。")
+            elif was_active:
+                await ctx.send(f"キューに追加しました ({len(music_queue.tracks)}曲目): {entries[0][1] or url}")
+
         except Exception as e:
             await ctx.send("再生に失敗しました。")
             logging.error(f"Play command error: {e}")
 
+@bot.command()
+async def skip(ctx):
+    session = sessions.get(ctx.guild.id)
+    if not session or not session.music_queue.skip():
+        await ctx.send("再生中の曲がありません。")
+        return
+    await ctx.send("スキップしました。")
+
+@bot.command(name="queue")
+async def show_queue(ctx):
+    session = sessions.get(ctx.guild.id)
+    if not session or not session.music_queue.active:
+        await ctx.send("再生キューは空です。")
+        return
+    music_queue = session.music_queue
+    lines = []
+    if music_queue.current:
+        lines.append(f"▶ {music_queue.current.label}")
+    for index, track in enumerate(itertools.islice(music_queue.tracks, 10), start=1):
+        lines.append(f"{index}. {track.label}")
+    if len(music_queue.tracks) > 10:
+        lines.append(f"...ほか {len(music_queue.tracks) - 10} 曲")
+    embed = discord.Embed(title="再生キュー", description="\n".join(lines), color=0x00ff00)
+    await ctx.send(embed=embed)
+
+@bot.command()
+async def clear(ctx):
+    session = sessions.get(ctx.guild.id)
+    if not session or not session.music_queue.tracks:
+        await ctx.send("再生キューは空です。")
+        return
+    count = len(session.music_queue.tracks)
+    session.music_queue.clear()
+    await ctx.send(f"再生待ちの {count} 曲を削除しました。")
+
 @bot.command()
 async def fool(ctx, state: str):
-    global AprilFool
-    if state == "true": AprilFool = True; await ctx.send(":parrot: :thumbsup:")
-    elif state == "false": AprilFool = False; await ctx.send(":angry:")
+    session = sessions.get(ctx.guild.id)
+    if not session:
+        await ctx.send("Botはボイスチャンネルに接続していません。")
+        return
+    if state == "true": session.april_fool = True; await ctx.send(":parrot: :thumbsup:")
+    elif state == "false": session.april_fool = False; await ctx.send(":angry:")
 
 @bot.command()
 async def help(ctx):
@@ -615,23 +3834,47 @@ async def help(ctx):
 
     `!stop`: 再生中の音声を停止
 
+    `!volume [master|music|speech] <0〜200>`: 音量を変更 (引数なしで現在の音量を表示)
+
     `!audioplay <true|false>`: 添付された音声ファイルの再生設定を変更
         true: 再生する
         false: 再生しない
 
-    `!set <ユーザー名> <キャラクター名>`: あなたのキャラクターを設定
+    `!set <ユーザー名> <キャラクター名>`: 指定ユーザーのキャラクターを設定 (メンション・ユーザーIDも可)
 
     `!char`: 使用可能なキャラクター名の一覧を表示
 
+    `!cache`: 読み上げキャッシュの統計を表示
+
+    `!ttsqueue`: 読み上げキューの統計を表示
+
+    `!engines`: VOICEVOXエンジンの状態を表示
+
+    `!stalls`: イベントループを止めた処理の一覧を表示
+
     `!add <単語> <カタカナ読み>`: 辞書に単語の読み方を登録
 
     `!delete <単語>`: 辞書から単語の読み方を削除
 
+    `!dictimport`: 添付したCSV/JSONファイルの単語を辞書に一括登録
+
+    `!dictexport`: 辞書をCSVファイルで書き出し
+
     `!save <video|audio> <url>`: YouTubeから音声・動画をダウンロード
         audio: 音声をダウンロード
         video: 動画をダウンロード
 
-    `!play <url>`: YouTubeの音声を再生します
+    `!jobs`: ダウンロードジョブの一覧と進捗を表示
+
+    `!cancel <ジョブ番号>`: ダウンロードをキャンセル
+
+    `!play <url>`: YouTubeの音声を再生キューに追加します (プレイリスト対応)
+
+    `!skip`: 再生中の曲を飛ばします
+
+    `!queue`: 再生キューを表示
+
+    `!clear`: 再生待ちの曲を削除
 
     `!help`: このヘルプを表示
     """
@@ -639,20 +3882,23 @@ async def help(ctx):
 
 @bot.event
 async def on_voice_state_update(member, before, after):
-    global active_text_channel
-    if member.bot: return
+    if member.bot:
+        if bot.user and member.id == bot.user.id:
+            await on_own_voice_state_update(member.guild, before, after)
+        return
+    member_index.add(member)
     try:
         if before.channel is None and after.channel is not None:
-            if active_text_channel and after.channel.guild.voice_client:
+            if after.channel.guild.id in sessions and after.channel.guild.voice_client:
                  if after.channel == after.channel.guild.voice_client.channel:
                     await generate_and_play_tts(after.channel.guild.voice_client, f"{member.display_name}さんが入室しました", CHARACTER_MAP[DEFAULT_CHARACTER])
         if before.channel is not None and after.channel is None:
-            if active_text_channel and before.channel.guild.voice_client:
+            if before.channel.guild.id in sessions and before.channel.guild.voice_client:
                 if before.channel == before.channel.guild.voice_client.channel:
                     members = [m for m in before.channel.members if not m.bot]
                     if len(members) == 0:
+                        close_session(before.channel.guild)
                         await before.channel.guild.voice_client.disconnect()
-                        active_text_channel = None
                         await update_status()
                     else:
                         await generate_and_play_tts(before.channel.guild.voice_client, f"{member.display_name}さんが退室しました", CHARACTER_MAP[DEFAULT_CHARACTER])
@@ -664,6 +3910,7 @@ async def on_command_error(ctx, error):
     logging.error(f"Command Error: {error}")
 
 if __name__ == "__main__":
+    mark_startup_phase("setup")
     try:
         bot.run(TOKEN)
     except Exception as e: